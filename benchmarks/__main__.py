@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+import crossplane
+from crossplane import binary
+from crossplane.__main__ import minify
+from crossplane.builder import build_files
+from crossplane.compat import timer, available_json_backends, get_json_backend
+
+from .generate import SCALES, generate
+
+
+def _count_directives(block):
+    count = 0
+    for stmt in block:
+        count += 1
+        if 'block' in stmt:
+            count += _count_directives(stmt['block'])
+    return count
+
+
+def _benchmarks(main, tmpdir):
+    """
+    Makes the functions that are timed for a config tree
+
+    :returns: a list of (name, function) tuples
+    """
+    payload = crossplane.parse(main, comments=True)
+    fnames = [config['file'] for config in payload['config']]
+
+    # build_files would overwrite the tree if the file names were absolute
+    relative = {'config': []}
+    for config in payload['config']:
+        config = dict(config, file=os.path.relpath(config['file'], os.path.dirname(main)))
+        relative['config'].append(config)
+
+    packed = binary.dumps(payload)
+
+    def _lex():
+        for fname in fnames:
+            for token in crossplane.lex(fname):
+                pass
+
+    def _build():
+        for config in payload['config']:
+            crossplane.build(config['parsed'])
+
+    def _build_files():
+        build_files(relative, dirname=os.path.join(tmpdir, 'build'))
+
+    def _format():
+        for fname in fnames:
+            crossplane.format(fname)
+
+    def _minify():
+        for fname in fnames:
+            minify(fname, os.path.join(tmpdir, 'minified.conf'))
+
+    def _json_benchmarks(backend):
+        encoded = backend.dumps(payload)
+        return [
+            ('dump_' + backend.name, lambda: backend.dumps(payload)),
+            ('load_' + backend.name, lambda: backend.loads(encoded)),
+        ]
+
+    # the payload is dumped and loaded with each json library installed
+    json_benchmarks = []
+    for name in available_json_backends():
+        json_benchmarks.extend(_json_benchmarks(get_json_backend(name)))
+
+    return [
+        ('lex', _lex),
+        ('parse', lambda: crossplane.parse(main)),
+        ('parse_combine', lambda: crossplane.parse(main, combine=True)),
+        ('parse_comments', lambda: crossplane.parse(main, comments=True)),
+        ('build', _build),
+        ('build_files', _build_files),
+        ('format', _format),
+        ('minify', _minify),
+    ] + json_benchmarks + [
+        ('dump_bin', lambda: binary.dumps(payload)),
+        ('load_bin', lambda: binary.loads(packed)),
+    ]
+
+
+def _peak_memory(func):
+    """Returns the most memory in bytes allocated while func ran"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(scale='small', repeat=3, only=None, dirname=None, out=sys.stdout):
+    """
+    Generates a config tree, then times crossplane's operations on it
+
+    :returns: dict of results that can be dumped as JSON
+    """
+    tmpdir = tempfile.mkdtemp(prefix='crossplane-bench-')
+    try:
+        main = generate(dirname or os.path.join(tmpdir, 'tree'), **SCALES[scale])
+        payload = crossplane.parse(main)
+        size = sum(os.path.getsize(config['file']) for config in payload['config'])
+        directives = sum(_count_directives(config['parsed']) for config in payload['config'])
+
+        results = {
+            'crossplane': crossplane.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'scale': scale,
+            'files': len(payload['config']),
+            'bytes': size,
+            'directives': directives,
+            'benchmarks': {}
+        }
+
+        print('%d files, %.1f MB, %d directives' % (results['files'], size / 1e6, directives), file=out)
+        print('%-16s %10s %10s %14s %12s' % ('benchmark', 'seconds', 'MB/s', 'directives/s', 'peak MB'), file=out)
+
+        for name, func in _benchmarks(main, tmpdir):
+            if only and name not in only:
+                continue
+
+            # the best time is the one least affected by everything else
+            seconds = float('inf')
+            for i in range(repeat):
+                start = timer()
+                func()
+                seconds = min(seconds, timer() - start)
+
+            peak = _peak_memory(func)
+            results['benchmarks'][name] = {
+                'seconds': seconds,
+                'mb_per_s': size / 1e6 / seconds,
+                'directives_per_s': directives / seconds,
+                'peak_memory': peak
+            }
+
+            print('%-16s %10.3f %10.2f %14.0f %12s' % (
+                name, seconds, size / 1e6 / seconds, directives / seconds,
+                '-' if peak is None else '%.1f' % (peak / 1e6)), file=out)
+
+        return results
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def compare(old, new, threshold):
+    """
+    Finds benchmarks that got slower or used more memory than allowed
+
+    :param threshold: float; allowed increase, like 0.1 for 10%
+    :returns: list of strings describing the regressions
+    """
+    regressions = []
+    for name, result in sorted(new['benchmarks'].items()):
+        if name not in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]
+        for key, label in (('seconds', 'time'), ('peak_memory', 'peak memory')):
+            if not before.get(key) or not result.get(key):
+                continue
+            change = result[key] / before[key] - 1
+            if change > threshold:
+                regressions.append('%s %s went up %.1f%%' % (name, label, change * 100))
+    return regressions
+
+
+def parse_args(args=None):
+    parser = ArgumentParser(
+        prog='python -m benchmarks',
+        description='times crossplane on generated nginx configs'
+    )
+    parser.add_argument('-s', '--scale', choices=sorted(SCALES), default='small',
+        help='size of the generated config tree')
+    parser.add_argument('-r', '--repeat', type=int, default=3, metavar='NUM',
+        help='times each benchmark is run (the best time is kept)')
+    parser.add_argument('--only', metavar='NAMES',
+        help='comma-separated list of benchmarks to run')
+    parser.add_argument('-d', '--dir', dest='dirname', metavar='PATH',
+        help='write the generated config tree here and keep it')
+    parser.add_argument('-o', '--out', type=str, metavar='PATH',
+        help='write the results to this JSON file')
+    parser.add_argument('-c', '--compare', metavar='PATH',
+        help='JSON file of earlier results to check for regressions')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, metavar='PCT',
+        help='percent increase in time or memory that fails the comparison')
+    return parser.parse_args(args=args)
+
+
+def main():
+    args = parse_args()
+    only = args.only.split(',') if args.only else None
+    results = run(scale=args.scale, repeat=args.repeat, only=only, dirname=args.dirname)
+
+    if args.out is not None:
+        with io.open(args.out, 'w', encoding='utf-8') as fp:
+            fp.write(u'%s\n' % json.dumps(results, indent=4, sort_keys=True))
+
+    if args.compare is not None:
+        with io.open(args.compare, encoding='utf-8') as fp:
+            old = json.load(fp)
+        regressions = compare(old, results, args.threshold / 100)
+        for regression in regressions:
+            print('regression: ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import random
+
+# sizes of the generated config tree for each scale
+SCALES = {
+    'small': {'sites': 10, 'servers': 10, 'depth': 3, 'maps': 2, 'map_size': 500},
+    'medium': {'sites': 50, 'servers': 40, 'depth': 4, 'maps': 5, 'map_size': 5000},
+    'large': {'sites': 200, 'servers': 50, 'depth': 5, 'maps': 10, 'map_size': 20000},
+}
+
+MAIN_CONF = u'''\
+# main config generated for crossplane benchmarks
+user nginx;
+worker_processes auto;
+error_log /var/log/nginx/error.log warn;
+pid /var/run/nginx.pid;
+
+events {
+    worker_connections 1024;  # per worker
+}
+
+http {
+    include mime.types;
+    default_type application/octet-stream;
+    log_format main '$remote_addr - $remote_user [$time_local] "$request" '
+                    '$status $body_bytes_sent "$http_referer" '
+                    '"$http_user_agent" "$http_x_forwarded_for"';
+    access_log /var/log/nginx/access.log main;
+    sendfile on;
+    keepalive_timeout 65;
+    gzip on;
+    gzip_types text/plain text/css application/json application/javascript;
+
+    include maps/*.conf;
+    include upstreams.conf;
+    include sites/*.conf;
+}
+
+stream {
+    upstream dns {
+        server 10.0.0.1:53;
+        server 10.0.0.2:53;
+    }
+
+    server {
+        listen 53 udp;
+        proxy_pass dns;
+    }
+}
+'''
+
+MIME_TYPES = [
+    ('text/html', 'html htm shtml'),
+    ('text/css', 'css'),
+    ('text/xml', 'xml'),
+    ('image/gif', 'gif'),
+    ('image/jpeg', 'jpeg jpg'),
+    ('application/javascript', 'js'),
+    ('application/json', 'json'),
+    ('image/png', 'png'),
+    ('image/svg+xml', 'svg svgz'),
+    ('font/woff', 'woff'),
+    ('application/pdf', 'pdf'),
+    ('application/zip', 'zip'),
+]
+
+
+def _write(path, text):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with io.open(path, 'w', encoding='utf-8') as fp:
+        fp.write(text)
+
+
+def _mime_types():
+    lines = [u'types {']
+    for mime, exts in MIME_TYPES:
+        lines.append(u'    %s %s;' % (mime, exts))
+    lines.append(u'}')
+    return u'\n'.join(lines) + u'\n'
+
+
+def _upstreams(count, rand):
+    lines = []
+    for i in range(count):
+        lines.append(u'upstream backend%d {' % i)
+        lines.append(u'    least_conn;')
+        for j in range(rand.randint(2, 6)):
+            lines.append(u'    server 10.%d.%d.%d:8080 weight=%d max_fails=3;' % (
+                i // 250, i % 250, j + 1, rand.randint(1, 5)))
+        lines.append(u'    keepalive 32;')
+        lines.append(u'}')
+    return u'\n'.join(lines) + u'\n'
+
+
+def _map(index, size, rand):
+    lines = [
+        u'# lookup table %d' % index,
+        u'map $http_host $site_group%d {' % index,
+        u'    default "";',
+        u'    hostnames;',
+    ]
+    for i in range(size):
+        lines.append(u'    site%d-%d.example.com group%d;' % (index, i, rand.randint(0, 99)))
+    lines.append(u'}')
+    return u'\n'.join(lines) + u'\n'
+
+
+def _locations(lines, prefix, depth, margin, upstreams, rand):
+    """Adds nested location blocks that are depth levels deep"""
+    for i in range(rand.randint(1, 3)):
+        path = u'%s/p%d' % (prefix, i)
+        lines.append(u'%slocation %s {' % (margin, path))
+        lines.append(u'%s    # proxy %s to the backends' % (margin, path))
+        lines.append(u'%s    proxy_pass http://backend%d;' % (margin, rand.randrange(upstreams)))
+        lines.append(u'%s    proxy_set_header Host $host;' % margin)
+        lines.append(u'%s    proxy_set_header X-Real-IP $remote_addr;' % margin)
+        lines.append(u'%s    proxy_read_timeout %ds;' % (margin, rand.randint(5, 120)))
+        if rand.random() < 0.2:
+            lines.append(u'%s    if ($request_method = POST) {' % margin)
+            lines.append(u'%s        return 405;' % margin)
+            lines.append(u'%s    }' % margin)
+        if depth > 1:
+            _locations(lines, path, depth - 1, margin + u'    ', upstreams, rand)
+        lines.append(u'%s}' % margin)
+
+
+def _site(index, servers, depth, upstreams, rand):
+    lines = [u'# site %d' % index, u'']
+    for i in range(servers):
+        name = u'site%d-%d.example.com' % (index, i)
+        lines.append(u'server {')
+        lines.append(u'    listen 80;')
+        lines.append(u'    listen [::]:80;  # ipv6')
+        lines.append(u'    server_name %s www.%s;' % (name, name))
+        lines.append(u'    root /var/www/%s;' % name)
+        lines.append(u'    access_log /var/log/nginx/%s.access.log main;' % name)
+        lines.append(u'    add_header X-Frame-Options "SAMEORIGIN" always;')
+        lines.append(u'')
+        lines.append(u'    location / {')
+        lines.append(u'        try_files $uri $uri/ /index.html =404;')
+        lines.append(u'    }')
+        _locations(lines, u'', depth, u'    ', upstreams, rand)
+        if rand.random() < 0.25:
+            lines.append(u'    location = /lua {')
+            lines.append(u'        content_by_lua_block {')
+            lines.append(u'            local args = ngx.req.get_uri_args()')
+            lines.append(u'            if args.name then')
+            lines.append(u'                ngx.say("hello, ", args.name, "!")')
+            lines.append(u'            else')
+            lines.append(u'                ngx.say("{\\"status\\": \\"ok\\"}")')
+            lines.append(u'            end')
+            lines.append(u'        }')
+            lines.append(u'    }')
+        lines.append(u'}')
+        lines.append(u'')
+    return u'\n'.join(lines)
+
+
+def generate(dirname, sites=10, servers=10, depth=3, maps=2, map_size=500,
+        upstreams=50, seed=0):
+    """
+    Writes a synthetic nginx config tree for benchmarks
+
+    The main config includes a mime.types file, globbed map and site files,
+    and a file of upstreams. Site files hold server blocks with nested
+    locations, comments, if blocks and lua blocks.
+
+    :param dirname: string; directory that the config files are written to
+    :param sites: int; number of site files included with a glob
+    :param servers: int; number of server blocks in each site file
+    :param depth: int; how deep location blocks are nested
+    :param maps: int; number of map files included with a glob
+    :param map_size: int; number of entries in each map block
+    :param upstreams: int; number of upstream blocks
+    :param seed: int; random seed, so the same arguments write the same tree
+    :returns: name of the main config file
+    """
+    rand = random.Random(seed)
+    main = os.path.join(dirname, 'nginx.conf')
+    _write(main, MAIN_CONF)
+    _write(os.path.join(dirname, 'mime.types'), _mime_types())
+    _write(os.path.join(dirname, 'upstreams.conf'), _upstreams(upstreams, rand))
+
+    for i in range(maps):
+        path = os.path.join(dirname, 'maps', 'map%03d.conf' % i)
+        _write(path, _map(i, map_size, rand))
+
+    for i in range(sites):
+        path = os.path.join(dirname, 'sites', 'site%03d.conf' % i)
+        _write(path, _site(i, servers, depth, upstreams, rand))
+
+    return main
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
-from .parser import parse
+from .parser import parse, reparse, iterparse
 from .lexer import lex
 from .builder import build
 from .formatter import format
 from .ext.lua import LuaBlockPlugin
 
-__all__ = ['parse', 'lex', 'build', 'format']
+__all__ = ['parse', 'reparse', 'iterparse', 'lex', 'build', 'format']
 
 __title__ = 'crossplane'
 __summary__ = 'Reliable and fast NGINX configuration file parser.'
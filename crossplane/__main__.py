@@ -2,16 +2,20 @@
 # -*- coding: utf-8 -*-
 import io
 import os
+import signal
 import sys
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from traceback import format_exception
 
 from . import __version__
-from .lexer import lex as lex_file
+from .lexer import lex_buffer
 from .parser import parse as parse_file
-from .builder import build as build_string, build_files, _enquote, DELIMITERS
-from .formatter import format as format_file
-from .compat import json, input
+from .builder import build_to, build_files, _enquote, DELIMITERS
+from .formatter import _parse_for_format
+from .records import dump as dump_records
+from .binary import MAGIC, dump as dump_binary, load as load_binary
+from .compat import json, input, PY2, JSON_BACKENDS, get_json_backend
+from .server import Server, ServerError, call as call_server, SOCKET_ENV
 
 
 def _prompt_yes():
@@ -21,21 +25,84 @@ def _prompt_yes():
         sys.exit(1)
 
 
-def _dump_payload(obj, fp, indent):
+def _json_encoder(indent):
     kwargs = {'indent': indent}
     if indent is None:
         kwargs['separators'] = ',', ':'
-    fp.write(json.dumps(obj, **kwargs) + u'\n')
+    return json.JSONEncoder(**kwargs)
+
+
+def _dump_payload(obj, fp, indent, encoded=(), backend=None):
+    """
+    Writes a json payload to a file object a piece at a time
+
+    The output is exactly what json.dumps would make, but lists at the top
+    of the payload (like "config") are written one item at a time, so the
+    whole payload is never turned into one big string.
+
+    :param encoded: keys of lists in obj whose items are already json text
+    :param backend: JSONBackend from crossplane.compat that the items of
+        those lists are dumped with (everything else is dumped with the
+        json module, since things like "stats" have floats)
+    """
+    encoder = _json_encoder(indent)
+    dumps = encoder.encode
+    if backend is not None:
+        dumps = lambda item: backend.dumps(item, indent)
+
+    def _newline(level):
+        return u'' if indent is None else u'\n' + u' ' * (indent * level)
+
+    def _indent(text, level):
+        # json strings never contain newlines, so they're all indentation
+        if indent is not None:
+            text = text.replace(u'\n', _newline(level))
+        return u'' + text  # json makes str objects in python 2
+
+    def _write_list(items, level, is_encoded=False):
+        if not items:
+            fp.write(u'[]')
+            return
+        separator = u'['
+        for item in items:
+            text = item if is_encoded else dumps(item)
+            fp.write(separator + _newline(level + 1) + _indent(text, level + 1))
+            separator = encoder.item_separator
+        fp.write(_newline(level) + u']')
+
+    if isinstance(obj, dict) and obj:
+        separator = u'{'
+        for key, value in obj.items():
+            fp.write(separator + _newline(1) + encoder.encode(key) + encoder.key_separator)
+            if isinstance(value, list):
+                _write_list(value, 1, key in encoded)
+            else:
+                fp.write(_indent(encoder.encode(value), 1))
+            separator = encoder.item_separator
+        fp.write(_newline(0) + u'}\n')
+    elif isinstance(obj, list):
+        _write_list(obj, 0)
+        fp.write(u'\n')
+    else:
+        fp.write(encoder.encode(obj) + u'\n')
 
 
-def parse(filename, out, indent=None, catch=None, tb_onerror=None, ignore='',
-          single=False, comments=False, strict=False, combine=False):
+def _binary_stdout():
+    return sys.stdout if PY2 else sys.stdout.buffer
+
+
+def _format_traceback(e):
+    exc = sys.exc_info() + (10,)
+    return ''.join(format_exception(*exc)).rstrip()
 
-    ignore = ignore.split(',') if ignore else []
 
-    def callback(e):
-        exc = sys.exc_info() + (10,)
-        return ''.join(format_exception(*exc)).rstrip()
+def parse(filename, out=None, indent=None, catch=None, tb_onerror=None, ignore='',
+          single=False, comments=False, strict=False, combine=False,
+          use_mmap=False, jobs=None, cache_dir=None, profile=False,
+          output_format='json', per_directive=False, json_backend=None,
+          cache=None, resolver=None):
+
+    ignore = ignore.split(',') if ignore else []
 
     kwargs = {
         'catch_errors': catch,
@@ -43,46 +110,78 @@ def parse(filename, out, indent=None, catch=None, tb_onerror=None, ignore='',
         'combine': combine,
         'single': single,
         'comments': comments,
-        'strict': strict
+        'strict': strict,
+        'use_mmap': use_mmap,
+        'workers': jobs,
+        'cache_dir': cache_dir,
+        'profile': profile,
+        'resolver': resolver
     }
 
+    # a server's cache is used like --cache-dir, but its counts aren't shown
+    if cache is not None and cache_dir is None:
+        kwargs['cache'] = cache
+
     if tb_onerror:
-        kwargs['onerror'] = callback
+        kwargs['onerror'] = _format_traceback
+
+    if output_format == 'bin':
+        payload = parse_file(filename, **kwargs)
+        if cache_dir is None:
+            payload.pop('cache', None)
+        o = _binary_stdout() if out is None else io.open(out, 'wb')
+        try:
+            dump_binary(payload, o)
+        finally:
+            o.close()
+        return
 
-    payload = parse_file(filename, **kwargs)
     o = sys.stdout if out is None else io.open(out, 'w', encoding='utf-8')
     try:
-        _dump_payload(payload, o, indent=indent)
+        if output_format == 'ndjson':
+            dump_records(filename, o, directives=per_directive, json_backend=json_backend, **kwargs)
+            return
+
+        # config entries are turned into json as soon as they're parsed
+        backend = get_json_backend(json_backend)
+        encoded = ()
+        if not combine:
+            kwargs['serialize'] = lambda config: backend.dumps(config, indent)
+            encoded = ('config',)
+
+        payload = parse_file(filename, **kwargs)
+        if cache_dir is None:
+            payload.pop('cache', None)
+        _dump_payload(payload, o, indent=indent, encoded=encoded, backend=backend)
     finally:
         o.close()
 
 
 def build(filename, dirname=None, force=False, indent=4, tabs=False,
-          header=True, stdout=False, verbose=False):
+          header=True, stdout=False, verbose=False, jobs=None,
+          skip_unchanged=False, json_backend=None):
 
     if dirname is None:
         dirname = os.getcwd()
 
-    # read the json payload from the specified file
-    with open(filename, 'r') as fp:
-        payload = json.load(fp)
+    # read the json or binary payload from the specified file
+    with io.open(filename, 'rb') as fp:
+        binary = fp.read(len(MAGIC)) == MAGIC
+        if binary:
+            fp.seek(0)
+            payload = load_binary(fp)
+    if not binary:
+        with open(filename, 'r') as fp:
+            payload = get_json_backend(json_backend).load(fp)
 
-    # find which files from the json payload will overwrite existing files
-    if not force and not stdout:
-        existing = []
-        for config in payload['config']:
-            path = config['file']
-            if not os.path.isabs(path):
-                path = os.path.join(dirname, path)
-            if os.path.exists(path):
-                existing.append(path)
-        # ask the user if it's okay to overwrite existing files
-        if existing:
-            print('building {} would overwrite these files:'.format(filename))
-            print('\n'.join(existing))
-            if not _prompt_yes():
-                print('not overwritten')
-                return
+    kwargs = {
+        'dirname': dirname,
+        'indent': indent,
+        'tabs': tabs,
+        'header': header,
+        'workers': jobs,
+        'skip_unchanged': skip_unchanged
+    }
 
     # if stdout is set then just print each file after another like nginx -T
     if stdout:
@@ -91,37 +190,57 @@ def build(filename, dirname=None, force=False, indent=4, tabs=False,
             if not os.path.isabs(path):
                 path = os.path.join(dirname, path)
             parsed = config['parsed']
-            output = build_string(parsed, indent=indent, tabs=tabs, header=header)
-            output = output.rstrip() + '\n'
-            print('# ' + path + '\n' + output)
+            sys.stdout.write('# ' + path + '\n')
+            build_to(sys.stdout, parsed, indent=indent, tabs=tabs, header=header, rstrip=True)
+            sys.stdout.write('\n')
         return
 
+    # ask the user if it's okay to overwrite existing files (with
+    # skip_unchanged or jobs, only the ones that would change)
+    def _confirm(existing):
+        print('building {} would overwrite these files:'.format(filename))
+        print('\n'.join(existing))
+        return _prompt_yes()
+
     # build the nginx configuration file from the json payload
-    build_files(payload, dirname=dirname, indent=indent, tabs=tabs, header=header)
+    results = build_files(payload, confirm=None if force else _confirm, **kwargs)
+    if results is None:
+        print('not overwritten')
+        return
 
     # if verbose print the paths of the config files that were created
     if verbose:
+        written = set(results['created'] + results['written'])
         for config in payload['config']:
             path = config['file']
             if not os.path.isabs(path):
                 path = os.path.join(dirname, path)
-            print('wrote to ' + path)
+            if path in written:
+                written.remove(path)  # files included more than once are written once
+                print('wrote to ' + path)
+
+    if skip_unchanged or jobs is not None:
+        print('{} written, {} unchanged, {} created'.format(
+            len(results['written']), len(results['unchanged']), len(results['created'])))
 
 
-def lex(filename, out, indent=None, line_numbers=False):
-    payload = list(lex_file(filename))
+def lex(filename, out=None, indent=None, line_numbers=False, use_mmap=False,
+        json_backend=None):
+    tokens = lex_buffer(filename, use_mmap=use_mmap)
+    if tokens.error is not None:
+        raise tokens.error
     if line_numbers:
-        payload = [(token, lineno) for token, lineno, quoted in payload]
+        payload = list(zip(tokens.tokens, tokens.lines))
     else:
-        payload = [token for token, lineno, quoted in payload]
+        payload = tokens.tokens
     o = sys.stdout if out is None else io.open(out, 'w', encoding='utf-8')
     try:
-        _dump_payload(payload, o, indent=indent)
+        _dump_payload(payload, o, indent=indent, backend=get_json_backend(json_backend))
     finally:
         o.close()
 
 
-def minify(filename, out):
+def minify(filename, out=None):
     payload = parse_file(
         filename,
         single=True,
@@ -152,15 +271,76 @@ def minify(filename, out):
         o.close()
 
 
-def format(filename, out, indent=4, tabs=False):
-    output = format_file(filename, indent=indent, tabs=tabs)
+def format(filename, out=None, indent=4, tabs=False):
+    parsed = _parse_for_format(filename)
     o = sys.stdout if out is None else io.open(out, 'w', encoding='utf-8')
     try:
-        o.write(output + u'\n')
+        build_to(o, parsed, indent=indent, tabs=tabs)
+        o.write(u'\n')
     finally:
         o.close()
 
 
+def _make_server(path=None, cache_size=64):
+    server = Server(path=path, max_cache_size=cache_size * 1024 * 1024)
+
+    def _parse(**kwargs):
+        return parse(cache=server.cache, resolver=server.resolver(), **kwargs)
+
+    server.commands.update(parse=_parse, build=build, lex=lex, minify=minify, format=format)
+    return server
+
+
+def serve(path=None, cache_size=64):
+    server = _make_server(path, cache_size)
+    server.bind()
+    print('listening on ' + server.path)
+    sys.stdout.flush()
+
+    # the socket is removed when the server stops, even if it's killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.terminate())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+# commands that are run by a server instead if one is running
+_SERVED = ('parse', 'build', 'lex', 'minify', 'format')
+
+
+def _run_in_server(func, kwargs):
+    """Runs a command in a crossplane server, or returns False if it can't"""
+    # only servers that were asked for are used
+    path = os.environ.get(SOCKET_ENV)
+    if not path or func.__name__ not in _SERVED:
+        return False
+
+    # the server can't ask if it's okay to overwrite files
+    if func is build and not (kwargs['force'] or kwargs['stdout']):
+        return False
+
+    try:
+        response = call_server(func.__name__, kwargs, path=path)
+    except EnvironmentError:
+        return False  # no server that's ours, or it didn't take the request
+    except ServerError as e:
+        sys.stderr.write('%s\n' % e)  # running it here too could run it twice
+        sys.exit(1)
+    if response['status'] == 'refused':
+        return False
+
+    sys.stdout.flush()
+    o = _binary_stdout()
+    o.write(response['output'])
+    o.flush()
+    if 'error' in response:
+        sys.stderr.write(response['error'])
+    if response['exit']:
+        sys.exit(response['exit'])
+    return True
+
+
 class _SubparserHelpFormatter(RawDescriptionHelpFormatter):
     def _format_action(self, action):
         line = super(RawDescriptionHelpFormatter, self)._format_action(action)
@@ -202,8 +382,15 @@ def parse_args(args=None):
     p.add_argument('--single-file', action='store_true', dest='single', help='do not include other config files')
     p.add_argument('--include-comments', action='store_true', dest='comments', help='include comments in json')
     p.add_argument('--strict', action='store_true', help='raise errors for unknown directives')
-
-    p = create_subparser(build, 'builds an nginx config from a json payload')
+    p.add_argument('--mmap', action='store_true', dest='use_mmap', help='lex memory-mapped bytes of config files')
+    p.add_argument('-j', '--jobs', type=int, metavar='NUM', help='parse included files with NUM processes')
+    p.add_argument('--cache-dir', metavar='PATH', help='cache parsed files in this directory')
+    p.add_argument('--profile', action='store_true', help='include parse times and counts in json')
+    p.add_argument('--format', choices=('json', 'ndjson', 'bin'), default='json', dest='output_format', help='write json, json lines or a binary payload')
+    p.add_argument('--per-directive', action='store_true', help='with ndjson, write a line per directive instead')
+    p.add_argument('--json-backend', choices=JSON_BACKENDS, metavar='NAME', help='json library to use (default: fastest)')
+
+    p = create_subparser(build, 'builds an nginx config from a json or binary payload')
     p.add_argument('filename', help='the file with the config payload')
     p.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     p.add_argument('-d', '--dir', metavar='PATH', default=None, dest='dirname', help='the base directory to build in')
@@ -213,12 +400,17 @@ def parse_args(args=None):
     g.add_argument('-t', '--tabs', action='store_true', help='indent with tabs instead of spaces')
     p.add_argument('--no-headers', action='store_false', dest='header', help='do not write header to configs')
     p.add_argument('--stdout', action='store_true', help='write configs to stdout instead')
+    p.add_argument('-j', '--jobs', type=int, metavar='NUM', help='build files with NUM threads')
+    p.add_argument('--skip-unchanged', action='store_true', help='only write files whose contents changed')
+    p.add_argument('--json-backend', choices=JSON_BACKENDS, metavar='NAME', help='json library to use (default: fastest)')
 
     p = create_subparser(lex, 'lexes tokens from an nginx config file')
     p.add_argument('filename', help='the nginx config file')
     p.add_argument('-o', '--out', type=str, help='write output to a file')
     p.add_argument('-i', '--indent', type=int, metavar='NUM', help='number of spaces to indent output')
     p.add_argument('-n', '--line-numbers', action='store_true', help='include line numbers in json payload')
+    p.add_argument('--mmap', action='store_true', dest='use_mmap', help='lex memory-mapped bytes of config file')
+    p.add_argument('--json-backend', choices=JSON_BACKENDS, metavar='NAME', help='json library to use (default: fastest)')
 
     p = create_subparser(minify, 'removes all whitespace from an nginx config')
     p.add_argument('filename', help='the nginx config file')
@@ -231,6 +423,10 @@ def parse_args(args=None):
     g.add_argument('-i', '--indent', type=int, metavar='NUM', help='number of spaces to indent output', default=4)
     g.add_argument('-t', '--tabs', action='store_true', help='indent with tabs instead of spaces')
 
+    p = create_subparser(serve, 'answers the other commands over a unix domain socket')
+    p.add_argument('-s', '--socket', metavar='PATH', dest='path', help='the socket to listen on (default: $CROSSPLANE_SOCKET, or one in $XDG_RUNTIME_DIR or the temp dir)')
+    p.add_argument('--cache-size', type=int, metavar='MB', default=64, help='megabytes of parsed files to keep in memory')
+
     def help(command):
         if command not in parser._actions[-1].choices:
             parser.error('unknown command %r' % command)
@@ -246,13 +442,20 @@ def parse_args(args=None):
     if not parsed.__dict__:
         parser.error('too few arguments')
 
+    if getattr(parsed, 'json_backend', None) is not None:
+        try:
+            get_json_backend(parsed.json_backend)
+        except ImportError:
+            parser.error('json backend %r is not installed' % parsed.json_backend)
+
     return parsed
 
 
 def main():
     kwargs = parse_args().__dict__
     func = kwargs.pop('_subcommand')
-    func(**kwargs)
+    if not _run_in_server(func, kwargs):
+        func(**kwargs)
 
 
 if __name__ == '__main__':
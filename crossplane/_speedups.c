@@ -0,0 +1,280 @@
+/*
+ * Compiled version of crossplane.lexer._ChunkLexer._scan
+ *
+ * This has to produce exactly the same tokens as the regex loop in _scan,
+ * and stop in exactly the same places so that _ChunkLexer._step() can take
+ * over from it. Anything that _scan leaves to _step() is left to it here too.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+static PyObject *special_tokens[3];  /* "{", "}" and ";" */
+static PyObject *escaped_quotes[2];  /* "\\\"" and "\\'" */
+static PyObject *quotes[2];  /* "\"" and "'" */
+
+#define IS_SPECIAL(c) ((c) == '{' || (c) == '}' || (c) == ';')
+
+static PyObject *
+special_token(Py_UCS4 c)
+{
+    PyObject *token = special_tokens[c == '{' ? 0 : c == '}' ? 1 : 2];
+    Py_INCREF(token);
+    return token;
+}
+
+/* appends a (token, line, quoted) tuple to the list, stealing the token */
+static int
+append_token(PyObject *tokens, PyObject *token, Py_ssize_t line, int quoted)
+{
+    PyObject *item;
+    int rc;
+
+    if (token == NULL)
+        return -1;
+    item = Py_BuildValue("(NnO)", token, line, quoted ? Py_True : Py_False);
+    if (item == NULL)
+        return -1;
+    rc = PyList_Append(tokens, item);
+    Py_DECREF(item);
+    return rc;
+}
+
+static PyObject *
+scan(PyObject *self, PyObject *args)
+{
+    PyObject *buf, *externals, *tokens, *token;
+    Py_ssize_t pos, line, limit, len, p, start, end, token_line, newlines;
+    int directive, external = 0, kind, contains, escaped_quote;
+    const void *data;
+    Py_UCS4 c, quote, term;
+
+    if (!PyArg_ParseTuple(args, "UnnnpO:scan", &buf, &pos, &line, &limit,
+                          &directive, &externals))
+        return NULL;
+
+#if PY_VERSION_HEX < 0x030C0000
+    if (PyUnicode_READY(buf) < 0)
+        return NULL;
+#endif
+    kind = PyUnicode_KIND(buf);
+    data = PyUnicode_DATA(buf);
+    len = PyUnicode_GET_LENGTH(buf);
+
+#define AT(i) PyUnicode_READ(kind, data, (i))
+
+    tokens = PyList_New(0);
+    if (tokens == NULL)
+        return NULL;
+
+    for (;;) {
+        /* disregard whitespace between tokens */
+        token_line = line;
+        p = pos;
+        while (p < len && Py_UNICODE_ISSPACE(c = AT(p))) {
+            token_line += c == '\n';
+            p++;
+        }
+        if (p >= len)
+            break;
+        c = AT(p);
+
+        /* comments run until the end of the line (which is left out) */
+        if (c == '#') {
+            start = p;
+            while (p < len) {
+                c = AT(p);
+                if (c == '\n')
+                    break;
+                if (c == '\\') {
+                    if (p + 1 >= len || AT(p + 1) == '\n')
+                        break;
+                    p += 2;
+                }
+                else {
+                    p++;
+                }
+            }
+            end = p;
+            if (p < len && AT(p) == '\\')
+                p++;
+            if (p >= len || AT(p) != '\n' || p + 1 >= limit)
+                break;
+            token = PyUnicode_Substring(buf, start, end);
+            if (append_token(tokens, token, token_line, 0) < 0)
+                goto error;
+            pos = p + 1;
+            line = token_line + 1;
+            continue;
+        }
+
+        /* if a quote is found, the whole string is the token */
+        if (c == '"' || c == '\'') {
+            quote = c;
+            start = ++p;
+            newlines = 0;
+            escaped_quote = 0;
+            while (p < len && (c = AT(p)) != quote) {
+                if (c == '\\') {
+                    if (p + 1 >= len) {
+                        p = len;  /* a backslash can't end the string */
+                        break;
+                    }
+                    c = AT(p + 1);
+                    escaped_quote |= c == quote;
+                    p++;
+                }
+                newlines += c == '\n';
+                p++;
+            }
+            if (p >= len || p + 1 >= limit)
+                break;
+            token = PyUnicode_Substring(buf, start, p);
+            if (token != NULL && escaped_quote) {
+                PyObject *replaced = PyUnicode_Replace(
+                    token, escaped_quotes[quote == '\''], quotes[quote == '\''], -1);
+                Py_DECREF(token);
+                token = replaced;
+            }
+            if (token == NULL)
+                goto error;
+            pos = p + 1;
+            line = token_line + newlines;
+        }
+
+        /* handle special characters that are treated like full tokens */
+        else if (IS_SPECIAL(c)) {
+            if (p + 1 >= limit)
+                break;
+            if (append_token(tokens, special_token(c), token_line, 0) < 0)
+                goto error;
+            pos = p + 1;
+            line = token_line;
+            directive = 1;
+            continue;
+        }
+
+        /* otherwise read an unquoted token until whitespace or a special */
+        else {
+            start = p;
+            newlines = 0;
+            for (;;) {
+                if (p >= len)
+                    goto done;
+                c = AT(p);
+                if (c == '\\') {
+                    if (p + 1 >= len)
+                        goto done;
+                    newlines += AT(p + 1) == '\n';
+                    p += 2;
+                    continue;
+                }
+                if (Py_UNICODE_ISSPACE(c) || IS_SPECIAL(c))
+                    break;
+                newlines += c == '\n';
+                p++;
+            }
+            term = Py_UNICODE_ISSPACE(c) ? c : 0;
+            end = term ? p + 1 : p;
+            if (end >= limit)
+                break;
+
+            /* parameter expansion and escaped newlines need special care */
+            if (AT(start) == '\\' && AT(start + 1) == '\n')
+                break;
+            if (!term && AT(p - 1) == '$' && c == '{')
+                break;
+
+            token = PyUnicode_Substring(buf, start, p);
+            if (token == NULL)
+                goto error;
+            Py_INCREF(token);
+            if (append_token(tokens, token, token_line, 0) < 0) {
+                Py_DECREF(token);
+                goto error;
+            }
+            pos = end;
+            line = token_line + newlines;
+            if (!term) {
+                Py_DECREF(token);
+                if (append_token(tokens, special_token(c), line, 0) < 0)
+                    goto error;
+                pos++;
+                directive = 1;
+                continue;
+            }
+            line += term == '\n';
+
+            if (directive) {
+                contains = PySequence_Contains(externals, token);
+                Py_DECREF(token);
+                if (contains < 0)
+                    goto error;
+                if (contains) {
+                    external = 1;
+                    goto done;
+                }
+            }
+            else {
+                Py_DECREF(token);
+            }
+            directive = 0;
+            continue;
+        }
+
+        /* quoted tokens end up here */
+        if (append_token(tokens, token, token_line, 1) < 0)
+            goto error;
+        if (directive) {
+            token = PyList_GET_ITEM(tokens, PyList_GET_SIZE(tokens) - 1);
+            contains = PySequence_Contains(externals, PyTuple_GET_ITEM(token, 0));
+            if (contains < 0)
+                goto error;
+            if (contains) {
+                external = 1;
+                goto done;
+            }
+        }
+        directive = 0;
+    }
+
+#undef AT
+
+done:
+    return Py_BuildValue("(NnnNN)", tokens, pos, line,
+                         PyBool_FromLong(directive), PyBool_FromLong(external));
+
+error:
+    Py_DECREF(tokens);
+    return NULL;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"scan", scan, METH_VARARGS,
+     "scan(buf, pos, line, limit, directive, externals)\n\n"
+     "Lexes as many tokens as possible from the buffer, like _ChunkLexer._scan"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "crossplane._speedups",
+    "Compiled parts of the crossplane lexer",
+    -1,
+    speedups_methods
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    special_tokens[0] = PyUnicode_InternFromString("{");
+    special_tokens[1] = PyUnicode_InternFromString("}");
+    special_tokens[2] = PyUnicode_InternFromString(";");
+    escaped_quotes[0] = PyUnicode_FromString("\\\"");
+    escaped_quotes[1] = PyUnicode_FromString("\\'");
+    quotes[0] = PyUnicode_InternFromString("\"");
+    quotes[1] = PyUnicode_InternFromString("'");
+    if (!special_tokens[0] || !special_tokens[1] || !special_tokens[2] ||
+            !escaped_quotes[0] || !escaped_quotes[1] || !quotes[0] || !quotes[1])
+        return NULL;
+    return PyModule_Create(&speedups_module);
+}
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing nginx configs from asyncio code
+
+This module is python 3 only (it uses async def), so python 2 installs
+leave it out.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+from .parser import parse as parse_file
+
+# number of files that are read and parsed at the same time by default
+DEFAULT_CONCURRENCY = 4
+
+
+class _FileExecutor(object):
+    """Hands files to an executor until the parse they're for is stopped"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = []
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        with self.lock:
+            if self.stopped:
+                raise concurrent.futures.CancelledError()
+            future = self.executor.submit(func, *args, **kwargs)
+            self.futures.append(future)
+            return future
+
+    def stop(self):
+        """Cancels files that haven't started and refuses any more"""
+        with self.lock:
+            self.stopped = True
+            for future in self.futures:
+                future.cancel()
+
+
+# get_running_loop is new in python 3.7, when get_event_loop does the same
+# thing from a coroutine
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+async def parse(filename, timeout=None, executor=None,
+        concurrency=DEFAULT_CONCURRENCY, **kwargs):
+    """
+    Parses an nginx config file without blocking the asyncio event loop
+
+    This is a coroutine that gives the same payload that crossplane.parse()
+    returns:
+
+        payload = await crossplane.aio.parse('/etc/nginx/nginx.conf')
+        payload = asyncio.run(crossplane.aio.parse('/etc/nginx/nginx.conf'))
+
+    Files are read, lexed and parsed in an executor, and included files are
+    found there too, so the loop is free while that happens. An included
+    file starts being parsed as soon as the include directive that includes
+    it is found, so files that don't depend on each other are parsed at the
+    same time. The payload is put together in the same order parse() uses.
+
+    Cancelling the task stops the parse. Files that are being parsed when
+    that happens are finished in the background, but no more files are
+    started.
+
+    :param timeout: float; if given, the parse is stopped after this many
+        seconds and asyncio.TimeoutError is raised
+    :param executor: concurrent.futures.Executor that files are parsed in;
+        if not given, a thread pool is made for this parse
+    :param concurrency: int; number of threads in the thread pool that's
+        made if no executor is given
+    :param kwargs: any other arguments that crossplane.parse() takes (except
+        for workers, which is ignored)
+    :returns: the payload
+    """
+    loop = _get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    files = _FileExecutor(executor)
+
+    # parse() waits for files in its own thread, not in the event loop
+    work = functools.partial(parse_file, filename, executor=files, **kwargs)
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(None, work), timeout)
+    finally:
+        # stops the parse if it was cancelled or timed out
+        files.stop()
+        if own_executor:
+            executor.shutdown(wait=False)
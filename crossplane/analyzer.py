@@ -2120,6 +2120,48 @@ def enter_block_ctx(stmt, ctx):
     return ctx + (stmt['directive'],)
 
 
+# precompiled checks for analyze(), stored by (directive, context bit mask)
+# where a context bit mask of 0 means the context isn't checked
+RULES = {}
+
+
+def _compile_rule(masks):
+    """
+    Precompiles the argument checks for a list of directive bit masks
+
+    :returns: None if there are no bit masks, otherwise a 2-tuple like
+        (first_mask, forms) where forms maps the terminators '{' and ';'
+        to (arg_bits, min_args, flag) tuples describing the arguments that
+        the bit masks with that terminator allow
+    """
+    if not masks:
+        return None
+
+    forms = {}
+    for mask in masks:
+        term = '{' if mask & NGX_CONF_BLOCK else ';'
+        arg_bits, min_args, flag = forms.get(term, (0, None, False))
+
+        arg_bits |= mask & 0xff  # NOARGS to TAKE7
+        flag = flag or bool(mask & NGX_CONF_FLAG)
+        for more, n_args in ((NGX_CONF_ANY, 0), (NGX_CONF_1MORE, 1), (NGX_CONF_2MORE, 2)):
+            if mask & more and (min_args is None or n_args < min_args):
+                min_args = n_args
+
+        forms[term] = (arg_bits, min_args, flag)
+
+    return (masks[0], forms)
+
+
+def _compile_rules(directive):
+    """Precompiles the checks for a directive in every known context"""
+    masks = DIRECTIVES[directive]
+    RULES[(directive, 0)] = _compile_rule(masks)
+    for ctx_mask in CONTEXTS.values():
+        allowed = [mask for mask in masks if mask & ctx_mask]
+        RULES[(directive, ctx_mask)] = _compile_rule(allowed)
+
+
 def analyze(fname, stmt, term, ctx=(), strict=False, check_ctx=True,
         check_args=True):
 
@@ -2133,55 +2175,58 @@ def analyze(fname, stmt, term, ctx=(), strict=False, check_ctx=True,
 
     # if we don't know where this directive is allowed and how
     # many arguments it can take then don't bother analyzing it
-    if ctx not in CONTEXTS or directive not in DIRECTIVES:
+    ctx_mask = CONTEXTS.get(ctx)
+    if ctx_mask is None:
         return
 
-    args = stmt.get('args') or []
-    n_args = len(args)
-
-    masks = DIRECTIVES[directive]
+    key = (directive, ctx_mask if check_ctx else 0)
+    try:
+        rule = RULES[key]
+    except KeyError:
+        if directive not in DIRECTIVES:
+            return
+        _compile_rules(directive)
+        rule = RULES[key]
 
     # if this directive can't be used in this context then throw an error
-    if check_ctx:
-        masks = [mask for mask in masks if mask & CONTEXTS[ctx]]
-        if not masks:
-            reason = '"%s" directive is not allowed here' % directive
-            raise NgxParserDirectiveContextError(reason, fname, line)
+    if rule is None:
+        if not check_ctx:
+            return
+        reason = '"%s" directive is not allowed here' % directive
+        raise NgxParserDirectiveContextError(reason, fname, line)
 
     if not check_args:
         return
 
-    valid_flag = lambda x: x.lower() in ('on', 'off')
-
-    # do this in reverse because we only throw errors at the end if no masks
-    # are valid, and typically the first bit mask is what the parser expects
-    for mask in reversed(masks):
-        # if the directive isn't a block but should be according to the mask
-        if mask & NGX_CONF_BLOCK and term != '{':
-            reason = 'directive "%s" has no opening "{"'
-            continue
-
-        # if the directive is a block but shouldn't be according to the mask
-        if not mask & NGX_CONF_BLOCK and term != ';':
-            reason = 'directive "%s" is not terminated by ";"'
-            continue
+    args = stmt.get('args') or []
+    n_args = len(args)
 
-        # use mask to check the directive's arguments
-        if ((mask >> n_args & 1 and n_args <= 7) or  # NOARGS to TAKE7
-            (mask & NGX_CONF_FLAG and n_args == 1 and valid_flag(args[0])) or
-            (mask & NGX_CONF_ANY and n_args >= 0) or
-            (mask & NGX_CONF_1MORE and n_args >= 1) or
-            (mask & NGX_CONF_2MORE and n_args >= 2)):
+    # check the arguments against every bit mask that allows this terminator
+    first_mask, forms = rule
+    form = forms.get(term)
+    if form is not None:
+        arg_bits, min_args, flag = form
+        if ((n_args <= 7 and arg_bits >> n_args & 1) or
+            (min_args is not None and n_args >= min_args) or
+            (flag and n_args == 1 and args[0].lower() in ('on', 'off'))):
             return
-        elif mask & NGX_CONF_FLAG and n_args == 1 and not valid_flag(args[0]):
-            reason = 'invalid value "%s" in "%%s" directive, it must be "on" or "off"' % args[0]
-        else:
-            reason = 'invalid number of arguments in "%s" directive'
+
+    # nothing was valid, so the error is about the first bit mask since
+    # that's typically what the parser expects
+    if first_mask & NGX_CONF_BLOCK and term != '{':
+        reason = 'directive "%s" has no opening "{"'
+    elif not first_mask & NGX_CONF_BLOCK and term != ';':
+        reason = 'directive "%s" is not terminated by ";"'
+    elif first_mask & NGX_CONF_FLAG and n_args == 1:
+        reason = 'invalid value "%s" in "%%s" directive, it must be "on" or "off"' % args[0]
+    else:
+        reason = 'invalid number of arguments in "%s" directive'
 
     raise NgxParserDirectiveArgumentsError(reason % directive, fname, line)
 
 
 def register_external_directives(directives):
-    for directive, bitmasks in directives.iteritems():
+    for directive, bitmasks in directives.items():
         if bitmasks:
             DIRECTIVES[directive] = bitmasks
+            _compile_rules(directive)
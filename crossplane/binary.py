@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for crossplane payloads
+
+Every string in the payload (directive names, args, file names, dict keys)
+is stored once in a string table and is referred to by its index after
+that. The statements in the "parsed" and "block" lists aren't stored with
+their keys. Instead, their directives, lines, args and so on are stored in
+columns of ints that are read all at once, and each list is its length.
+Anything that isn't a statement is stored with a tag for its type and
+varints, so extra keys like "stats" are kept too.
+"""
+import struct
+import sys
+from array import array
+from itertools import chain
+
+from .compat import PY2, accumulate, basestring, gc_paused
+
+MAGIC = b'XPLB\x01'
+
+# tags for the types of values, where _STATEMENTS is a list of statements
+_NULL, _TRUE, _FALSE, _INT, _FLOAT, _STRING, _LIST, _DICT, _STATEMENTS = range(9)
+
+# flags for the keys that a statement has besides directive, line and args
+_FILE, _INCLUDES, _COMMENT, _BLOCK = 1, 2, 4, 8
+
+_STMT_KEYS = frozenset(['file', 'directive', 'line', 'args', 'includes', 'comment', 'block'])
+
+# columns use the smallest of these that fits all of their ints
+_TYPECODES = {1: 'B', 2: 'H', 4: 'I' if array('I').itemsize == 4 else 'L'}
+
+_double = struct.Struct('<d')
+_integer_types = (int, long) if PY2 else (int,)
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write_column(out, values):
+    largest = max(values) if values else 0
+    width = 1 if largest < 0x100 else 2 if largest < 0x10000 else 4
+    column = array(_TYPECODES[width], values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    out.append(width)
+    _write_varint(out, len(values))
+    out.extend(column.tostring() if PY2 else column.tobytes())
+
+
+def dumps(payload):
+    """
+    Turns a payload into bytes of the binary format
+
+    Lists of statements are the "parsed" lists and the "block" lists in
+    them. Their statements can only have the keys that parse() gives them,
+    and they need a "directive", "line" and "args".
+
+    :param payload: a payload returned by parse() (but not with as_objects
+        or graph), or anything else made of dicts, lists, strings, numbers,
+        bools and None
+    :returns: bytes
+    """
+    strings = {}  # stores {string: index in the string table} map
+    table = []
+    roots = []  # stores the lists of statements found outside of blocks
+
+    def _string(s):
+        index = strings.get(s)
+        if index is None:
+            index = strings[s] = len(table)
+            table.append(s)
+        return index
+
+    def _value(obj, out, find_roots=True):
+        if obj is None:
+            out.append(_NULL)
+        elif obj is True:
+            out.append(_TRUE)
+        elif obj is False:
+            out.append(_FALSE)
+        elif isinstance(obj, basestring):
+            out.append(_STRING)
+            _write_varint(out, _string(obj))
+        elif isinstance(obj, _integer_types):
+            out.append(_INT)
+            _write_varint(out, obj << 1 if obj >= 0 else (-obj << 1) - 1)  # zigzag
+        elif isinstance(obj, float):
+            out.append(_FLOAT)
+            out.extend(_double.pack(obj))
+        elif isinstance(obj, (list, tuple)):
+            out.append(_LIST)
+            _write_varint(out, len(obj))
+            for item in obj:
+                _value(item, out, find_roots)
+        elif isinstance(obj, dict):
+            out.append(_DICT)
+            _write_varint(out, len(obj))
+            for key, value in obj.items():
+                if not isinstance(key, basestring):
+                    raise TypeError('keys must be strings, not %r' % (key,))
+                _write_varint(out, _string(key))
+                if find_roots and key == 'parsed' and isinstance(value, list):
+                    out.append(_STATEMENTS)
+                    _write_varint(out, len(value))
+                    roots.append(value)
+                else:
+                    _value(value, out, find_roots)
+        else:
+            raise TypeError('%r can not be stored in a binary payload' % (obj,))
+
+    body = bytearray()
+    _value(payload, body)
+
+    # statements are stored a list at a time, starting with the roots and
+    # then the blocks of the statements in the order they're stored
+    directives, lines, nargs, args, flags = [], [], [], [], []
+    files, comments, blocks, includes = [], [], [], []
+    lists = list(roots)
+    for block in lists:
+        for stmt in block:
+            if not isinstance(stmt, dict) or not _STMT_KEYS.issuperset(stmt):
+                raise TypeError('%r can not be stored as a statement' % (stmt,))
+            directives.append(_string(stmt['directive']))
+            lines.append(stmt['line'])
+            nargs.append(len(stmt['args']))
+            args.extend(_string(arg) for arg in stmt['args'])
+            flag = 0
+            if 'file' in stmt:
+                flag |= _FILE
+                files.append(_string(stmt['file']))
+            if 'includes' in stmt:
+                flag |= _INCLUDES
+                includes.append(stmt['includes'])
+            if 'comment' in stmt:
+                flag |= _COMMENT
+                comments.append(_string(stmt['comment']))
+            if 'block' in stmt:
+                flag |= _BLOCK
+                blocks.append(len(stmt['block']))
+                lists.append(stmt['block'])
+            flags.append(flag)
+
+    extras = bytearray()
+    _value(includes, extras, find_roots=False)
+
+    out = bytearray(MAGIC)
+    _write_column(out, [len(s) for s in table])
+    text = u''.join(table).encode('utf-8', 'surrogatepass')
+    _write_varint(out, len(text))
+    out.extend(text)
+    for column in (directives, lines, nargs, args, flags, files, comments, blocks):
+        _write_column(out, column)
+    out.extend(extras)
+    out.extend(body)
+    return bytes(out)
+
+
+def dump(payload, fp):
+    """
+    Writes a payload to a file object in the binary format
+
+    :param fp: file object opened in binary mode
+    """
+    fp.write(dumps(payload))
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_column(data, pos):
+    width = data[pos]
+    count, pos = _read_varint(data, pos + 1)
+    end = pos + count * width
+    if width not in _TYPECODES or end > len(data):
+        raise ValueError('binary crossplane payload is corrupt')
+    column = array(_TYPECODES[width])
+    if PY2:
+        column.fromstring(bytes(data[pos:end]))
+    else:
+        column.frombytes(data[pos:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, end
+
+
+def _read_value(data, pos, strings, take=None):
+    tag = data[pos]
+    pos += 1
+    if tag == _NULL:
+        return None, pos
+    elif tag == _TRUE:
+        return True, pos
+    elif tag == _FALSE:
+        return False, pos
+    elif tag == _FLOAT:
+        return _double.unpack_from(data, pos)[0], pos + _double.size
+
+    n, pos = _read_varint(data, pos)
+    if tag == _STRING:
+        return strings[n], pos
+    elif tag == _INT:
+        return (n >> 1) ^ -(n & 1), pos
+    elif tag == _STATEMENTS and take is not None:
+        return take(n), pos
+    elif tag == _LIST:
+        items = []
+        for _ in range(n):
+            item, pos = _read_value(data, pos, strings, take)
+            items.append(item)
+        return items, pos
+    elif tag == _DICT:
+        obj = {}
+        for _ in range(n):
+            key, pos = _read_varint(data, pos)
+            obj[strings[key]], pos = _read_value(data, pos, strings, take)
+        return obj, pos
+    raise ValueError('unknown tag %d at byte %d' % (tag, pos - 1))
+
+
+def _read_payload(data):
+    pos = len(MAGIC)
+    lengths, pos = _read_column(data, pos)
+    size, pos = _read_varint(data, pos)
+    text = bytes(data[pos:pos + size]).decode('utf-8', 'surrogatepass')
+    pos += size
+    ends = list(accumulate(lengths))
+    if (ends[-1] if ends else 0) != len(text):
+        raise ValueError('binary crossplane payload is corrupt')
+    strings = [text[start:end] for start, end in zip(chain([0], ends), ends)]
+
+    columns = []
+    for _ in range(8):
+        column, pos = _read_column(data, pos)
+        columns.append(column)
+    directives, lines, nargs, args, flags, files, comments, blocks = columns
+    if not len(directives) == len(lines) == len(nargs) == len(flags):
+        raise ValueError('binary crossplane payload is corrupt')
+
+    # make every statement with just its directive, line and args first
+    args = list(map(strings.__getitem__, args))
+    ends = list(accumulate(nargs))
+    if (ends[-1] if ends else 0) != len(args):
+        raise ValueError('binary crossplane payload is corrupt')
+    stmts = [
+        {'directive': directive, 'line': line, 'args': args[start:end]}
+        for directive, line, start, end in zip(
+            map(strings.__getitem__, directives), lines, chain([0], ends), ends)
+    ]
+
+    includes, pos = _read_value(data, pos, strings)
+    files = iter(map(strings.__getitem__, files))
+    comments = iter(map(strings.__getitem__, comments))
+    includes = iter(includes)
+    flagged = [i for i, flag in enumerate(flags) if flag]
+    for i in flagged:
+        flag = flags[i]
+        if flag & _FILE:
+            stmt = {'file': next(files)}
+            stmt.update(stmts[i])
+            stmts[i] = stmt
+        if flag & _INCLUDES:
+            stmts[i]['includes'] = next(includes)
+        if flag & _COMMENT:
+            stmts[i]['comment'] = next(comments)
+
+    # the lists of statements are in the same order that dumps() found them
+    taken = [0]
+
+    def _take(n):
+        start = taken[0]
+        taken[0] += n
+        return stmts[start:start + n]
+
+    payload, pos = _read_value(data, pos, strings, _take)
+    blocks = iter(blocks)
+    for i in flagged:
+        if flags[i] & _BLOCK:
+            stmts[i]['block'] = _take(next(blocks))
+
+    if pos != len(data) or taken[0] != len(stmts):
+        raise ValueError('binary crossplane payload is corrupt')
+    return payload
+
+
+def loads(data):
+    """
+    Turns bytes of the binary format back into a payload
+
+    :param data: bytes that start with MAGIC
+    :returns: the payload that was given to dumps()
+    """
+    if not data.startswith(MAGIC):
+        raise ValueError('not a binary crossplane payload')
+    if PY2:
+        data = bytearray(data)
+
+    try:
+        with gc_paused():
+            return _read_payload(data)
+    except (IndexError, StopIteration, UnicodeDecodeError, struct.error):
+        raise ValueError('binary crossplane payload is corrupt')
+
+
+def load(fp):
+    """
+    Reads a payload in the binary format from a file object
+
+    :param fp: file object opened in binary mode
+    """
+    return loads(fp.read())
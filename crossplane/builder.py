@@ -1,14 +1,30 @@
 # -*- coding: utf-8 -*-
+import binascii
 import codecs
+import errno
+import functools
+import hashlib
+import io
+import itertools
 import os
 import re
+import stat
+from multiprocessing.pool import ThreadPool
 
-from .compat import PY2
+from .compat import PY2, replace_file
 
 DELIMITERS = ('{', '}', ';')
 EXTERNAL_BUILDERS = {}
 ESCAPE_SEQUENCES_RE = re.compile(r'(\\x[0-9a-f]{2}|\\[0-7]{1,3})')
 
+# strings made of these never need quotes, so they skip _needs_quotes
+# ('$' is fine unless it's last or starts a '${' expansion)
+SAFE_ARG_RE = re.compile(r'(?:[^\s{};"\'\\$]|\$(?=[^\s{};"\'\\]))+\Z', re.UNICODE)
+
+# stores {arg: enquoted arg} for args that aren't safe
+ENQUOTED = {}
+ENQUOTED_MAX_SIZE = 4096
+
 
 def _escape(string):
     prev, char = '', ''
@@ -56,6 +72,21 @@ def _replace_escape_sequences(match):
 
 
 def _enquote(arg):
+    if SAFE_ARG_RE.match(arg):
+        return arg
+
+    try:
+        return ENQUOTED[arg]
+    except KeyError:
+        pass
+
+    if len(ENQUOTED) >= ENQUOTED_MAX_SIZE:
+        ENQUOTED.clear()
+    ENQUOTED[arg] = enquoted = _enquote_uncached(arg)
+    return enquoted
+
+
+def _enquote_uncached(arg):
     if not _needs_quotes(arg):
         return arg
 
@@ -71,25 +102,34 @@ def _enquote(arg):
     return arg
 
 
-def build(payload, indent=4, tabs=False, header=False):
-    padding = '\t' if tabs else ' ' * indent
+HEADER = (
+    '# This config was built from JSON using NGINX crossplane.\n'
+    '# If you encounter any bugs please report them here:\n'
+    '# https://github.com/nginxinc/crossplane/issues\n'
+    '\n'
+)
 
-    head = ''
-    if header:
-        head += '# This config was built from JSON using NGINX crossplane.\n'
-        head += '# If you encounter any bugs please report them here:\n'
-        head += '# https://github.com/nginxinc/crossplane/issues\n'
-        head += '\n'
+# number of chunks that build_to() joins before each write
+WRITE_CHUNKS = 4096
+
+
+def _iter_chunks(payload, indent=4, tabs=False):
+    """Generates the pieces of text that build() joins into a config"""
+    padding = '\t' if tabs else ' ' * indent
 
-    def _build_block(output, block, depth, last_line):
-        margin = padding * depth
+    stack = []  # stores (stmts, last_line, depth) of the blocks around this one
+    stmts, last_line, depth = iter(payload), 0, 0
+    started = False  # nothing is put before the first line
 
-        for stmt in block:
+    while True:
+        for stmt in stmts:
+            margin = padding * depth
             directive = _enquote(stmt['directive'])
             line = stmt.get('line', 0)
 
             if directive == '#' and line == last_line:
-                output += ' #' + stmt['comment']
+                yield ' #' + stmt['comment']
+                started = True
                 continue
             elif directive == '#':
                 built = '#' + stmt['comment']
@@ -106,48 +146,270 @@ def build(payload, indent=4, tabs=False, header=False):
                 else:
                     built = directive
 
-                if stmt.get('block') is None:
-                    built += ';'
-                else:
-                    built += ' {'
-                    built = _build_block(built, stmt['block'], depth+1, line)
-                    built += '\n' + margin + '}'
+                # open the block, then build its statements before this loop's
+                if stmt.get('block') is not None:
+                    yield ('\n' if started else '') + margin + built + ' {'
+                    started = True
+                    stack.append((stmts, line, depth))
+                    stmts, last_line, depth = iter(stmt['block']), line, depth + 1
+                    break
+
+                built += ';'
 
-            output += ('\n' if output else '') + margin + built
+            chunk = ('\n' if started else '') + margin + built
+            if chunk:
+                yield chunk
+                started = True
             last_line = line
+        else:
+            # all of this block's statements were built, so close it
+            if not stack:
+                return
+            stmts, last_line, depth = stack.pop()
+            yield '\n' + padding * depth + '}'
+
+
+def _rstrip_chunks(chunks):
+    """Generates chunks like _iter_chunks() without trailing whitespace"""
+    pending = ''  # whitespace that's only written if more text follows it
+    for chunk in chunks:
+        stripped = chunk.rstrip()
+        if stripped:
+            yield pending + stripped
+            pending = chunk[len(stripped):]
+        else:
+            pending += chunk
+
+
+def build(payload, indent=4, tabs=False, header=False):
+    head = HEADER if header else ''
+    return head + ''.join(_iter_chunks(payload, indent=indent, tabs=tabs))
 
-        return output
 
-    body = ''
-    body = _build_block(body, payload, 0, 0)
-    return head + body
+def build_to(fp, payload, indent=4, tabs=False, header=False, rstrip=False):
+    """
+    Writes the same config that build() returns to a file object
 
+    The config is written a piece at a time, so big configs are never held
+    in memory as one string.
 
-def build_files(payload, dirname=None, indent=4, tabs=False, header=False):
+    :param fp: file object that the config is written to
+    :param rstrip: bool; if True, trailing whitespace is left out and a
+        newline is written at the end instead, like build_files() does
+    """
+    chunks = _iter_chunks(payload, indent=indent, tabs=tabs)
+    if header:
+        chunks = itertools.chain((HEADER,), chunks)
+    if rstrip:
+        chunks = _rstrip_chunks(chunks)
+
+    buf = []
+    for chunk in chunks:
+        buf.append(chunk)
+        if len(buf) >= WRITE_CHUNKS:
+            fp.write(u''.join(buf))
+            del buf[:]
+
+    if rstrip:
+        buf.append('\n')
+    fp.write(u''.join(buf))
+
+
+def _render(parsed, indent=4, tabs=False, header=False):
+    """Builds a config file's bytes just like build_files() writes them"""
+    fp = io.StringIO()
+    build_to(fp, parsed, indent=indent, tabs=tabs, header=header, rstrip=True)
+    return fp.getvalue().encode('utf-8')
+
+
+def _file_digest(path):
+    """Returns the sha1 digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(functools.partial(fp.read, 1 << 16), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _file_status(path, data):
+    """
+    Finds out what writing bytes to a file would do
+
+    Files are compared by size first and by sha1 digest second, so files
+    that differ in size are never read.
+
+    :returns: "created", "written" or "unchanged", and the file's mode (or
+        None if it doesn't exist yet)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'created', None
+
+    if st.st_size == len(data):
+        if _file_digest(path) == hashlib.sha1(data).digest():
+            return 'unchanged', stat.S_IMODE(st.st_mode)
+    return 'written', stat.S_IMODE(st.st_mode)
+
+
+def _make_temp_file(path, mode):
+    """
+    Creates a temporary file next to a file, like tempfile.mkstemp() does
+    but with a mode that the umask applies to
+
+    :returns: the file descriptor and the temporary file's path
+    """
+    dirpath, basename = os.path.split(path)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    for attempt in range(100):
+        suffix = binascii.hexlify(os.urandom(4)).decode('ascii')
+        tmp = os.path.join(dirpath, '.%s.%s' % (basename, suffix))
+        try:
+            return os.open(tmp, flags, mode), tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, 'no usable temporary file name found', path)
+
+
+def _replace_file(path, data, mode):
+    """
+    Writes bytes to a file by replacing it with a temporary file
+
+    :param mode: int; the permissions of the file being replaced, or None
+        if it doesn't exist yet (then it gets the ones that open() would
+        give it under the current umask)
+    """
+    fd, tmp = _make_temp_file(path, 0o666 if mode is None else 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        replace_file(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def build_files(payload, dirname=None, indent=4, tabs=False, header=False,
+        workers=None, skip_unchanged=False, dry_run=False, confirm=None):
     """
     Uses a full nginx config payload (output of crossplane.parse) to build
     config files, then writes those files to disk.
+
+    :param workers: int; if given, files are built by a pool of this many
+        threads (this also turns on skip_unchanged)
+    :param skip_unchanged: bool; if True, files whose contents wouldn't
+        change are left alone, and the others are written by replacing them
+        with a temporary file so they're never seen half written
+    :param dry_run: bool; if True, nothing is written but the result is the
+        same as if it was
+    :param confirm: function; if given, it's called with the list of
+        existing files that would be overwritten (if there are any) before
+        anything is written, and nothing is if it returns False
+    :returns: dict that maps "created", "written" and "unchanged" to lists
+        of the paths of the files that were created, overwritten, or left
+        alone because they were unchanged, or None if confirm returned False
     """
     if dirname is None:
         dirname = os.getcwd()
 
+    paths, configs = _configs_by_path(payload, dirname)
+
+    results = {'created': [], 'written': [], 'unchanged': []}
+
+    if workers is None and not skip_unchanged:
+        for path in paths:
+            results['written' if os.path.exists(path) else 'created'].append(path)
+        if results['written'] and confirm is not None and not confirm(results['written']):
+            return None
+        if dry_run:
+            return results
+
+        _make_dirs(paths)
+        for path, config in zip(paths, configs):
+            # build then create the nginx config file using the json payload
+            parsed = config['parsed']
+            with codecs.open(path, 'w', encoding='utf-8') as fp:
+                build_to(fp, parsed, indent=indent, tabs=tabs, header=header, rstrip=True)
+        return results
+
+    def _plan(args):
+        path, config = args
+        data = _render(config['parsed'], indent=indent, tabs=tabs, header=header)
+        return (path, data) + _file_status(path, data)
+
+    def _write(args):
+        path, data, status, mode = args
+        _replace_file(path, data, mode)
+
+    pool = None if workers is None else ThreadPool(workers)
+    try:
+        # every file is rendered and compared first so that confirm is only
+        # asked about files that would really change
+        jobs = list(zip(paths, configs))
+        plans = list(map(_plan, jobs)) if pool is None else pool.map(_plan, jobs)
+        for path, data, status, mode in plans:
+            results[status].append(path)
+        if results['written'] and confirm is not None and not confirm(results['written']):
+            return None
+        if dry_run:
+            return results
+
+        changed = [plan for plan in plans if plan[2] != 'unchanged']
+        _make_dirs(plan[0] for plan in changed)
+        if pool is None:
+            for plan in changed:
+                _write(plan)
+        else:
+            pool.map(_write, changed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+def _configs_by_path(payload, dirname):
+    """
+    Finds the config to build each file from
+
+    A file that's included from more than one context has a config for each
+    of them, and those only differ where a context made a directive fail.
+    The first config that parsed without errors is built (or the first one
+    if none did).
+
+    :returns: list of paths and list of the configs to build them from
+    :raises ValueError: if two configs without errors would build a file
+        differently
+    """
+    paths, found = [], {}  # stores {path: [configs]} map
     for config in payload['config']:
         path = config['file']
         if not os.path.isabs(path):
             path = os.path.join(dirname, path)
-
-        # make directories that need to be made for the config to be built
-        dirpath = os.path.dirname(path)
+        if path not in found:
+            paths.append(path)
+            found[path] = []
+        found[path].append(config)
+
+    configs = []
+    for path in paths:
+        ok = [config for config in found[path] if config.get('status', 'ok') == 'ok']
+        if len(ok) > 1 and len(set(build(config['parsed']) for config in ok)) > 1:
+            raise ValueError('%s was parsed differently in the contexts it was included from' % path)
+        configs.append((ok or found[path])[0])
+    return paths, configs
+
+
+def _make_dirs(paths):
+    """Makes the directories that need to be made for files to be built"""
+    for dirpath in sorted(set(os.path.dirname(path) for path in paths)):
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
 
-        # build then create the nginx config file using the json payload
-        parsed = config['parsed']
-        output = build(parsed, indent=indent, tabs=tabs, header=header)
-        output = output.rstrip() + '\n'
-        with codecs.open(path, 'w', encoding='utf-8') as fp:
-            fp.write(output)
-
 
 def register_external_builder(builder, directives):
     for directive in directives:
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from collections import OrderedDict
+
+from .compat import gc_paused, replace_file
+
+# the cache is pruned down to this many bytes whenever it grows past it
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+SUFFIX = '.cache'
+
+
+def _check_dir(dirname):
+    """
+    Makes sure only the current user can write to a cache directory
+
+    Entries are unpickled, so anyone who could write one could make the
+    parsing process run their code.
+    """
+    st = os.stat(dirname)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise EnvironmentError('%s belongs to another user' % dirname)
+    if st.st_mode & 0o022:
+        raise EnvironmentError('other users can write to %s' % dirname)
+
+
+class ParseCache(object):
+    """
+    A directory of pickled results of parsing single nginx config files
+
+    Entries are looked up by a key made out of anything that could change
+    the result. When the directory holds more than max_size bytes, the
+    least recently used entries are deleted. Problems reading or writing
+    the directory are treated like cache misses so they never break a parse.
+    """
+
+    def __init__(self, dirname, max_size=DEFAULT_MAX_SIZE):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = None  # total size of entries, found on first write
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        _check_dir(dirname)
+
+    def key(self, *parts):
+        """Makes a key out of reprs of crossplane's version and parts"""
+        from . import __version__
+        parts = (__version__, sys.version_info[0]) + parts
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key + SUFFIX)
+
+    def _entries(self):
+        """Returns (mtime, size, path) tuples for every entry in the cache"""
+        entries = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def get(self, key, validate=None):
+        """
+        Returns the value stored with key or None if there isn't one
+
+        :param validate: function that is given the value and returns False
+            if it's stale, in which case it's counted as a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                value = pickle.load(fp)
+        except Exception:
+            value = None
+
+        if value is None or (validate is not None and not validate(value)):
+            self.misses += 1
+            return None
+
+        # touch the entry so that it's evicted last
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Stores value with key, evicting old entries if needed"""
+        if self.size is None:
+            self.size = sum(size for mtime, size, path in self._entries())
+
+        # write to a temporary file first so readers never see half an entry
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.dirname)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(value, fp, protocol=2)
+            size = os.path.getsize(tmp)
+            replace_file(tmp, self._path(key))
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        self.size += size
+        if self.size > self.max_size:
+            self.prune()
+
+    def prune(self):
+        """Deletes least recently used entries until under max_size bytes"""
+        entries = sorted(self._entries())
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryCache(object):
+    """
+    Pickled results of parsing single nginx config files kept in memory
+
+    This works like ParseCache for a process that parses again and again,
+    like a server. Results are pickled so that the ones that are returned
+    can be changed without changing the cache. Relative file names are
+    relative to the working directory, so it's part of every key.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()  # stores {key: pickled value}, oldest first
+
+    def key(self, *parts):
+        """Makes a key out of reprs of the working directory and parts"""
+        return repr((os.getcwd(),) + parts)
+
+    def get(self, key, validate=None):
+        """
+        Returns the value stored with key or None if there isn't one
+
+        :param validate: function that is given the value and returns False
+            if it's stale, in which case it's counted as a miss
+        """
+        data = self._entries.pop(key, None)
+        with gc_paused():
+            value = None if data is None else pickle.loads(data)
+        if value is None or (validate is not None and not validate(value)):
+            if data is not None:
+                self.size -= len(data)
+            self.misses += 1
+            return None
+
+        self._entries[key] = data  # now the most recently used
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Stores value with key, evicting old entries if needed"""
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            key, data = self._entries.popitem(last=False)
+            self.size -= len(data)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -1,21 +1,50 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import functools
+import gc
+import importlib
+import os
+import re
 import sys
+import time
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # the backport for python 2
+    except ImportError:
+        scandir = None
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        """Generates running totals like itertools.accumulate in python 3"""
+        total = 0
+        for value in iterable:
+            total += value
+            yield total
+
 PY2 = (sys.version_info[0] == 2)
 PY3 = (sys.version_info[0] == 3)
 
 if PY2:
     input = raw_input
     basestring = basestring
+    replace_file = os.rename  # can't overwrite files on windows
 else:
     input = input
     basestring = str
+    replace_file = os.replace
+
+# the most precise clock for timing things
+timer = getattr(time, 'perf_counter', time.time)
 
 
 def fix_pep_479(generator):
@@ -32,3 +61,179 @@ def fix_pep_479(generator):
             return
 
     return _wrapped_generator
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Keeps the garbage collector from running while a payload is loaded
+
+    Nothing made while loading can be garbage, but the collector would go
+    through all of the new objects again and again while they're made.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# json libraries that payloads can be dumped and loaded with, fastest first
+JSON_BACKENDS = ('orjson', 'ujson', 'rapidjson', 'simplejson', 'json')
+
+# environment variable that picks the json library if none is given
+JSON_BACKEND_ENV = 'CROSSPLANE_JSON_BACKEND'
+
+# characters that the json module escapes when ensure_ascii is True
+_NOT_ASCII = re.compile(u'[^\x00-\x7e]')
+
+# a json escape, so that uppercase hex digits in \u escapes can be found
+_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|.)')
+
+
+def _escape_char(match):
+    n = ord(match.group())
+    if n > 0xffff:
+        n -= 0x10000
+        return u'\\u%04x\\u%04x' % (0xd800 | (n >> 10), 0xdc00 | (n & 0x3ff))
+    return u'\\u%04x' % n
+
+
+def _lower_escape(match):
+    return match.group().lower() if match.group(1)[0] == u'u' else match.group()
+
+
+class JSONBackend(object):
+    """
+    Dumps and loads json with the json module or a faster library like it
+
+    dumps() makes exactly the text that the json module makes, with
+    non-ascii characters escaped and no spaces after separators unless
+    there's an indent. Floats are the exception, since libraries write them
+    in different ways (like 1e-05 or 1e-5), so anything that has floats in
+    it should be dumped with the json module. Things that a library can't
+    dump in the same way (like an indent it doesn't have) are dumped with
+    the json module too.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def __repr__(self):
+        return '<JSONBackend %s>' % self.name
+
+    def _dumps(self, obj, indent):
+        """Returns json text, or None if the json module has to make it"""
+        return None
+
+    def dumps(self, obj, indent=None):
+        try:
+            text = self._dumps(obj, indent)
+        except (TypeError, ValueError, OverflowError):
+            text = None
+        return _json_dumps(json, obj, indent) if text is None else text
+
+    def loads(self, text):
+        with gc_paused():
+            try:
+                return self.module.loads(text)
+            except ValueError:
+                return json.loads(text)  # like lone surrogates, or bad json
+
+    def load(self, fp):
+        return self.loads(fp.read())
+
+
+class _OrjsonBackend(JSONBackend):
+    def _dumps(self, obj, indent):
+        if indent is None:
+            text = self.module.dumps(obj)
+        elif indent == 2:
+            text = self.module.dumps(obj, option=self.module.OPT_INDENT_2)
+        else:
+            return None
+        return _NOT_ASCII.sub(_escape_char, text.decode('utf-8'))
+
+
+class _UjsonBackend(JSONBackend):
+    def _dumps(self, obj, indent):
+        if indent == 0:
+            return None  # ujson doesn't put newlines in without an indent
+        text = self.module.dumps(obj, indent=indent or 0, escape_forward_slashes=False)
+        return _NOT_ASCII.sub(_escape_char, text)  # it doesn't escape \x7f
+
+
+class _RapidjsonBackend(JSONBackend):
+    def _dumps(self, obj, indent):
+        text = self.module.dumps(obj, indent=indent, ensure_ascii=False)
+        if u'\\u' in text:
+            text = _ESCAPE.sub(_lower_escape, text)
+        return _NOT_ASCII.sub(_escape_char, text)
+
+
+class _StdlibBackend(JSONBackend):
+    def _dumps(self, obj, indent):
+        return _json_dumps(self.module, obj, indent)
+
+
+_BACKEND_TYPES = {
+    'orjson': _OrjsonBackend,
+    'ujson': _UjsonBackend,
+    'rapidjson': _RapidjsonBackend,
+    'simplejson': _StdlibBackend,
+    'json': _StdlibBackend,
+}
+
+_backends = {}  # stores {name: JSONBackend} map of the ones that were made
+
+
+def _json_dumps(module, obj, indent):
+    kwargs = {'indent': indent}
+    if indent is None:
+        kwargs['separators'] = ',', ':'
+    return module.dumps(obj, **kwargs)
+
+
+def get_json_backend(name=None):
+    """
+    Returns a JSONBackend for a json library
+
+    :param name: string; one of JSON_BACKENDS, or if not given, the one
+        named by the CROSSPLANE_JSON_BACKEND environment variable if it's
+        installed, or else the fastest one that's installed
+    :raises ValueError: if the named library isn't one of JSON_BACKENDS
+    :raises ImportError: if the named library isn't installed
+    """
+    if name is None:
+        name = os.environ.get(JSON_BACKEND_ENV)
+        if name:
+            try:
+                return get_json_backend(name)
+            except (ValueError, ImportError):
+                pass
+        for name in JSON_BACKENDS:
+            try:
+                return get_json_backend(name)
+            except ImportError:
+                pass
+
+    if name not in _BACKEND_TYPES:
+        raise ValueError('unknown json backend %r (choose from %s)' % (name, ', '.join(JSON_BACKENDS)))
+    if name not in _backends:
+        _backends[name] = _BACKEND_TYPES[name](name, importlib.import_module(name))
+    return _backends[name]
+
+
+def available_json_backends():
+    """Returns the names of the JSON_BACKENDS that are installed"""
+    names = []
+    for name in JSON_BACKENDS:
+        try:
+            get_json_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
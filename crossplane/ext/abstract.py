@@ -9,7 +9,7 @@ class CrossplaneExtension(object):
     directives = {}
 
     def register_extension(self):
-        register_external_directives(directive=self.directives)
+        register_external_directives(directives=self.directives)
         register_external_lexer(directives=self.directives, lexer=self.lex)
         register_external_parser(directives=self.directives, parser=self.parse)
         register_external_builder(directives=self.directives, builder=self.build)
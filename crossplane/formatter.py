@@ -4,7 +4,7 @@ from .builder import build
 from .parser import parse
 
 
-def format(filename, indent=4, tabs=False):
+def _parse_for_format(filename):
     payload = parse(
         filename,
         comments=True,
@@ -17,6 +17,10 @@ def format(filename, indent=4, tabs=False):
         e = payload['errors'][0]
         raise NgxParserBaseException(e['error'], e['file'], e['line'])
 
-    parsed = payload['config'][0]['parsed']
+    return payload['config'][0]['parsed']
+
+
+def format(filename, indent=4, tabs=False):
+    parsed = _parse_for_format(filename)
     output = build(parsed, indent=indent, tabs=tabs)
     return output
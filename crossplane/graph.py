@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import collections
+
+
+class IncludeGraph(object):
+    """
+    A graph of which nginx config files include which
+
+    Files are nodes, named the same way as in the payload's "config" list.
+    Every file that an include directive includes gets an edge, which is a
+    dict with the "file" and "line" of the include directive, the "include"d
+    file, and the "context" the directive was in. Edges are indexed both
+    ways, so finding what a file includes or what includes it is one dict
+    lookup.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = []  # in the order they were added
+        self._includes = {}  # stores {filename: edges from the file}
+        self._included_by = {}  # stores {filename: edges to the file}
+        self._contexts = {}  # stores {filename: contexts it's included from}
+        self.add_file(root, ())
+
+    def add_file(self, fname, ctx=None):
+        """Adds a file and the context it's included from if it's new"""
+        if fname not in self._includes:
+            self.files.append(fname)
+            self._includes[fname] = []
+            self._included_by[fname] = []
+            self._contexts[fname] = []
+        if ctx is not None and ctx not in self._contexts[fname]:
+            self._contexts[fname].append(ctx)
+
+    def add_edge(self, fname, line, include, ctx):
+        """Adds an edge for a file that's included by an include directive"""
+        self.add_file(fname)
+        self.add_file(include, ctx)
+        edge = {'file': fname, 'line': line, 'include': include, 'context': ctx}
+        self._includes[fname].append(edge)
+        self._included_by[include].append(edge)
+
+    def __contains__(self, fname):
+        return fname in self._includes
+
+    def __len__(self):
+        return len(self.files)
+
+    def includes(self, fname):
+        """Returns the edges of the files that a file includes"""
+        return list(self._includes[fname])
+
+    def included_by(self, fname):
+        """Returns the edges of the include directives that include a file"""
+        return list(self._included_by[fname])
+
+    def contexts(self, fname):
+        """Returns the contexts that a file is included from"""
+        return list(self._contexts[fname])
+
+    def dependents(self, fname):
+        """Returns the files that include a file, directly or not"""
+        found = set()
+        queue = collections.deque([fname])
+        while queue:
+            for edge in self._included_by[queue.popleft()]:
+                if edge['file'] not in found:
+                    found.add(edge['file'])
+                    queue.append(edge['file'])
+        found.discard(fname)
+        return [f for f in self.files if f in found]
+
+    def affected_roots(self, fname):
+        """Returns the files that nothing includes that depend on a file"""
+        files = [fname] + self.dependents(fname)
+        return [f for f in files if not self._included_by[f]]
+
+    def topological_order(self):
+        """
+        Returns every file, with files that include other files coming
+        before them. Files in an include cycle are put after the others,
+        in the order they were added.
+        """
+        included = {}  # stores {filename: number of files including it}
+        for fname in self.files:
+            included[fname] = len(set(edge['file'] for edge in self._included_by[fname]))
+
+        order = []
+        queue = collections.deque(f for f in self.files if not included[f])
+        while queue:
+            fname = queue.popleft()
+            order.append(fname)
+            for include in self._unique_includes(fname):
+                included[include] -= 1
+                if not included[include]:
+                    queue.append(include)
+
+        if len(order) < len(self.files):
+            ordered = set(order)
+            order += [f for f in self.files if f not in ordered]
+
+        return order
+
+    def _unique_includes(self, fname):
+        seen = set()
+        for edge in self._includes[fname]:
+            if edge['include'] not in seen:
+                seen.add(edge['include'])
+                yield edge['include']
+
+    def to_dict(self):
+        """Returns a dict version of the graph that can be dumped as JSON"""
+        edges = []
+        for fname in self.files:
+            for edge in self._includes[fname]:
+                edges.append(dict(edge, context=list(edge['context'])))
+        return {
+            'root': self.root,
+            'files': [
+                {'file': f, 'contexts': [list(ctx) for ctx in self._contexts[f]]}
+                for f in self.files
+            ],
+            'edges': edges
+        }
@@ -1,12 +1,38 @@
 # -*- coding: utf-8 -*-
+import array
 import itertools
 import io
+import mmap
+import operator
+import os
+import re
 
-from .compat import fix_pep_479
+from .compat import accumulate, fix_pep_479
 from .errors import NgxParserSyntaxError
 
+# the compiled version of _ChunkLexer._scan, if it could be built
+try:
+    from . import _speedups
+except ImportError:
+    _speedups = None
+
 EXTERNAL_LEXERS = {}
 
+# number of chars read from a config file at a time by the chunk lexer
+CHUNK_SIZE = 1 << 16
+
+# number of tokens grouped together at a time by lexers that don't work in
+# blocks, and the least number of tokens in each buffer that's parsed
+BATCH_SIZE = 1 << 12
+
+# how much each unquoted brace changes the depth of nesting
+_BRACE_DEPTHS = {'{': 1, '}': -1}
+
+# get the columns of token tuples
+_get_token = operator.itemgetter(0)
+_get_line = operator.itemgetter(1)
+_get_quoted = operator.itemgetter(2)
+
 
 @fix_pep_479
 def _iterescape(iterable):
@@ -26,10 +52,82 @@ def _iterlinecount(iterable):
         yield (char, line)
 
 
+def _iterbatches(tokens, size=BATCH_SIZE):
+    """Groups token tuples into lists, including the ones before an error"""
+    batch = []
+    try:
+        for token in tokens:
+            batch.append(token)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    except Exception:
+        if batch:
+            yield batch
+        raise
+    if batch:
+        yield batch
+
+
+class TokenBuffer(object):
+    """
+    Tokens from an nginx config file stored column by column
+
+    Instead of a tuple for every token, token strings are kept in a list,
+    their line numbers in an array and whether they were quoted in a
+    bytearray, all at the same indexes. This is a lot smaller than a list
+    of tuples, and it pickles quickly, so it's cheap to keep or send around.
+
+    If lexing the file raised an error, it's kept in error and raised again
+    after the last token when the buffer is iterated over.
+    """
+
+    def __init__(self, tokens=()):
+        self.tokens = []
+        self.lines = array.array('I')
+        self.quoted = bytearray()
+        self.error = None
+        if tokens:
+            self.extend(tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        return (self.tokens[i], self.lines[i], bool(self.quoted[i]))
+
+    def __iter__(self):
+        lines, quoted = self.lines, self.quoted
+        for i, token in enumerate(self.tokens):
+            yield (token, lines[i], quoted[i] == 1)
+        if self.error is not None:
+            raise self.error
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, TokenBuffer) and
+            self.tokens == other.tokens and
+            self.lines == other.lines and
+            self.quoted == other.quoted
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def extend(self, tokens):
+        """Appends a list of token tuples"""
+        self.tokens.extend(map(_get_token, tokens))
+        self.lines.extend(map(_get_line, tokens))
+        self.quoted.extend(map(_get_quoted, tokens))
+
+
 @fix_pep_479
-def _lex_file_object(file_obj):
+def _lex_file_object_by_char(file_obj):
     """
-    Generates token tuples from an nginx config file object
+    Generates token tuples from an nginx config file object one char at a time
+
+    This is the original lexer. It is slower than _lex_file_object but it is
+    kept around so that the two can be compared (see lex(..., legacy=True)).
 
     Yields 3-tuples like (token, lineno, quoted)
     """
@@ -120,22 +218,581 @@ def _lex_file_object(file_obj):
         token += char
 
 
-def _balance_braces(tokens, filename=None):
-    """Raises syntax errors if braces aren't balanced"""
+class _ChunkLexer(object):
+    """
+    Splits an nginx config file object into tokens by scanning large blocks
+    of text with regular expressions instead of looking at one char at a time
+
+    The tokens produced are exactly the same as _lex_file_object_by_char's,
+    quirks and all, including handing the rest of the file off to external
+    lexers as a (char, line) iterator when one of their directives is found.
+    """
+    space_re = re.compile(r'\s*', re.UNICODE)
+    bare_re = re.compile(r'(?:[^\s\\{};]|\\.)*', re.UNICODE | re.DOTALL)
+    comment_re = re.compile(r'#(?:[^\\\n]|\\[^\n])*')
+    expansion_re = re.compile(r'\{(?:[^\s\\}]|\\[^}])*(?:\\?\})?', re.UNICODE)
+    token_re = re.compile(
+        r'(\s*)(?:'
+        r'(#(?:[^\\\n]|\\[^\n])*)\\?\n|'  # comment
+        r'"((?:[^"\\]|\\.)*)"|'  # double quoted
+        r"'((?:[^'\\]|\\.)*)'|"  # single quoted
+        r'([{};])|'  # special
+        r'((?:[^\s\\{};#"\']|\\.)(?:[^\s\\{};]|\\.)*)(?:(\s)|(?=[{};]))'
+        r')',
+        re.UNICODE | re.DOTALL
+    )
+    quoted_res = {
+        '"': re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL),
+        "'": re.compile(r"'((?:[^'\\]|\\.)*)'", re.DOTALL)
+    }
+
+    # the raw forms of the chars that the lexer looks for in the buffer
+    newline = '\n'
+    escaped_newline = '\\\n'
+    dollar = '$'
+    left_brace = '{'
+    specials = {'{': '{', '}': '}', ';': ';'}
+
+    # whether _speedups.scan can be used instead of _scan
+    accelerated = True
+
+    def __init__(self, file_obj, chunk_size=CHUNK_SIZE):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.line = 1
+        self.eof = False
+        self.peek_size = 0
+
+    def _fill(self):
+        """Appends the next block of the file to the buffer if there is one"""
+        if self.eof:
+            return False
+
+        # read at least as much as is left over so that huge tokens that
+        # span many blocks don't make refilling the buffer quadratic
+        size = max(self.chunk_size, len(self.buf) - self.pos)
+        data = self.file_obj.read(size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _match(self, regex):
+        """Matches regex at the current position, reading more if needed"""
+        while True:
+            m = regex.match(self.buf, self.pos)
+            # stop short of the last char so a trailing "\\" is never split
+            if m is not None and m.end() < len(self.buf) - 1:
+                return m
+            if not self._fill():
+                return m
+
+    def _count_newlines(self, start, end):
+        return self.buf.count('\n', start, end)
+
+    def _advance(self, end):
+        """Moves the current position forward, counting newlines passed"""
+        self.line += self._count_newlines(self.pos, end)
+        self.pos = end
+
+    def _decode(self, raw):
+        """Turns a slice of the buffer into a token string"""
+        return raw
+
+    def _peek(self):
+        """Returns the char or escape sequence at the current position"""
+        while self.pos + 1 >= len(self.buf) and self._fill():
+            pass
+        char = self.buf[self.pos:self.pos + 2]
+        if char[:1] != '\\':
+            char = char[:1]
+        # a backslash at the very end of the file ends the token stream
+        elif len(char) < 2:
+            char = ''
+        self.peek_size = len(char)
+        return char
+
+    def _skip(self):
+        """Moves past the char or escape sequence returned by _peek"""
+        self._advance(self.pos + self.peek_size)
+
+    def _iterchars(self):
+        """Generates (char, line) tuples like the legacy char iterator does"""
+        while True:
+            char = self._peek()
+            if not char:
+                self.pos = len(self.buf)
+                return
+            self.pos += self.peek_size
+            if char.endswith('\n'):
+                self.line += 1
+            yield (char, self.line)
+
+    def _external(self, token):
+        """Hands the rest of the file off to an external lexer"""
+        lexer = EXTERNAL_LEXERS[token]
+        for custom_lexer_token in lexer(self._iterchars(), token):
+            yield custom_lexer_token
+
+    def _step(self):
+        """
+        Slowly lexes the next token(s) while taking care of every edge case
+
+        Returns a tuple like (tokens, kind) where tokens is a list of token
+        tuples and kind says how next_token_is_directive should be updated,
+        or None if the end of the token stream was reached.
+        """
+        # disregard whitespace between tokens
+        self._advance(self._match(self.space_re).end())
+
+        char = self._peek()
+        if not char:
+            return None
+
+        line = self.line
+
+        # comments run until the end of the line (which is left out)
+        if char == '#':
+            m = self._match(self.comment_re)
+            self._advance(m.end())
+            if not self._peek():
+                return None
+            self._skip()
+            return [(self._decode(m.group(0)), line, False)], 'comment'
+
+        # if a quote is found, the whole string is the token
+        if char in ('"', "'"):
+            m = self._match(self.quoted_res[char])
+            if m is None:
+                return None
+            token = self._decode(m.group(1)).replace('\\' + char, char)
+            self._advance(m.end())
+            return [(token, line, True)], 'token'  # True because it's quoted
+
+        # handle special characters that are treated like full tokens
+        if char in ('{', '}', ';'):
+            self._skip()
+            return [(char, line, False)], 'special'
+
+        # otherwise read an unquoted token until whitespace or a special
+        if char == '\\\n':
+            line += 1  # an escaped newline counts toward the token's line
+        token = ''
+        kind = 'token'
+        while True:
+            m = self._match(self.bare_re)
+            token += self._decode(m.group(0))
+            self._advance(m.end())
+
+            char = self._peek()
+            if not char:
+                return None
+
+            # handle parameter expansion syntax (ex: "${var[@]}")
+            if char == '{' and token.endswith('$'):
+                kind = 'expansion'
+                m = self._match(self.expansion_re)
+                token += self._decode(m.group(0))
+                self._advance(m.end())
+
+                # the char after the expansion is always part of the
+                # token unless it is a special character
+                char = self._peek()
+                if not char:
+                    return None
+                if char not in ('{', '}', ';'):
+                    token += char
+                    self._skip()
+                continue
+
+            if char.isspace():
+                self._skip()
+                return [(token, line, False)], kind
+
+            # char must be "{", "}" or ";" so it's a token too
+            self._skip()
+            return [(token, line, False), (char, self.line, False)], 'special'
+
+    def _scan(self, buf, pos, line, limit, directive, externals):
+        """
+        Lexes as many tokens as possible from the buffer with a regex each
+
+        This stops before anything that needs _step() to take care of it,
+        or after a directive that an external lexer has to take over from.
+
+        :param limit: int; matches that reach this far aren't trusted
+        :param directive: bool; True if the next token is a directive
+        :param externals: dict of directives handled by external lexers
+        :returns: a 5-tuple like (tokens, pos, line, directive, external)
+            where tokens is a list of token tuples and external is True if
+            the last token is a directive for an external lexer
+        """
+        tokens = []
+        append = tokens.append
+        match = self.token_re.match
+        decode = self._decode
+        specials = self.specials
+        newline = self.newline
+        escaped_newline = self.escaped_newline
+        dollar = self.dollar
+        left_brace = self.left_brace
+
+        while True:
+            m = match(buf, pos)
+            if m is None or m.end() >= limit:
+                break
+
+            space, comment, double, single, special, token, term = m.groups()
+            end = m.end()
+            token_line = line + space.count(newline) if space else line
+
+            if special is not None:
+                pos, line = end, token_line
+                append((specials[special], line, False))
+                directive = True
+                continue
+
+            if comment is not None:
+                pos, line = end, token_line + 1
+                append((decode(comment), token_line, False))
+                continue
+
+            if token is None:
+                if single is None:
+                    quote, token = '"', double
+                else:
+                    quote, token = "'", single
+                pos, line = end, token_line + token.count(newline)
+                token = decode(token).replace('\\' + quote, quote)
+                append((token, token_line, True))  # True because it's quoted
+            else:
+                # parameter expansion and escaped newlines need special care
+                if token.startswith(escaped_newline):
+                    break
+                if term is None and token.endswith(dollar) and buf[end:end + 1] == left_brace:
+                    break
+
+                pos, line = end, token_line + token.count(newline)
+                token = decode(token)
+                append((token, token_line, False))
+                if term is None:
+                    append((specials[buf[pos:pos + 1]], line, False))
+                    pos += 1
+                    directive = True
+                    continue
+                line += term == newline
+
+            if directive and token in externals:
+                return tokens, pos, line, directive, True
+            directive = False
+
+        return tokens, pos, line, directive, False
+
+    def __iter__(self):
+        for tokens in self._batches():
+            for token in tokens:
+                yield token
+
+    def _batches(self):
+        """Generates lists of token tuples, as many at a time as possible"""
+        next_token_is_directive = True
+        scan = self._scan
+        if _speedups is not None and self.accelerated:
+            scan = _speedups.scan
+
+        while True:
+            # don't trust matches that reach the end of the buffer unless
+            # the end of the file has been read, because a token might be
+            # split between this block and the next one
+            limit = len(self.buf) + 1 if self.eof else len(self.buf) - 1
+
+            tokens, self.pos, self.line, next_token_is_directive, external = scan(
+                self.buf, self.pos, self.line, limit, next_token_is_directive,
+                EXTERNAL_LEXERS
+            )
+            if tokens:
+                yield tokens
+
+            if external:
+                for tokens in _iterbatches(self._external(tokens[-1][0])):
+                    yield tokens
+                next_token_is_directive = True
+                continue
+
+            # fall back to the slower lexer for everything else
+            step = self._step()
+            if step is None:
+                return
+
+            tokens, kind = step
+            yield tokens
+
+            if kind == 'special':
+                next_token_is_directive = True
+            elif kind == 'expansion':
+                next_token_is_directive = False
+            elif kind == 'token':
+                token = tokens[0][0]
+                if next_token_is_directive and token in EXTERNAL_LEXERS:
+                    for tokens in _iterbatches(self._external(token)):
+                        yield tokens
+                        next_token_is_directive = True
+                else:
+                    next_token_is_directive = False
+
+
+class _MappedLexer(_ChunkLexer):
+    """
+    Lexes the raw bytes of a memory-mapped nginx config file in place
+
+    Only the slices of the map that become tokens are decoded, so the file
+    is never copied into a string as a whole. The whole file is mapped at
+    once so the buffer never has to be refilled.
+    """
+    space_re = re.compile(br'\s*')
+    bare_re = re.compile(br'(?:[^\s\\{};]|\\.)*', re.DOTALL)
+    comment_re = re.compile(br'#(?:[^\\\n]|\\[^\n])*')
+    expansion_re = re.compile(br'\{(?:[^\s\\}]|\\[^}])*(?:\\?\})?')
+    token_re = re.compile(
+        br'(\s*)(?:'
+        br'(#(?:[^\\\n]|\\[^\n])*)\\?\n|'  # comment
+        br'"((?:[^"\\]|\\.)*)"|'  # double quoted
+        br"'((?:[^'\\]|\\.)*)'|"  # single quoted
+        br'([{};])|'  # special
+        br'((?:[^\s\\{};#"\']|\\.)(?:[^\s\\{};]|\\.)*)(?:(\s)|(?=[{};]))'
+        br')',
+        re.DOTALL
+    )
+    quoted_res = {
+        '"': re.compile(br'"((?:[^"\\]|\\.)*)"', re.DOTALL),
+        "'": re.compile(br"'((?:[^'\\]|\\.)*)'", re.DOTALL)
+    }
+
+    # bytes that io.open would have changed (newlines are translated) or
+    # that str.isspace sees as whitespace even though \s in a bytes regex
+    # doesn't; files that contain any of them are lexed as text instead
+    text_only_re = re.compile(
+        br'[\r\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|'
+        br'\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80'
+    )
+
+    newline = b'\n'
+    escaped_newline = b'\\\n'
+    dollar = b'$'
+    left_brace = b'{'
+    specials = {b'{': '{', b'}': '}', b';': ';'}
+    accelerated = False  # the compiled scanner only works on text
+
+    def __init__(self, buf):
+        super(_MappedLexer, self).__init__(None)
+        self.buf = buf
+        self.eof = True
+
+    def _count_newlines(self, start, end):
+        return self.buf[start:end].count(b'\n')
+
+    def _decode(self, raw):
+        return raw.decode('utf-8', 'replace')
+
+    def _peek(self):
+        """Returns the decoded char or escape sequence at the position"""
+        char = u''
+        pos = self.pos
+        if self.buf[pos:pos + 1] == b'\\':
+            if pos + 1 >= len(self.buf):
+                self.peek_size = 0
+                return u''  # a backslash at the very end of the file
+            char = u'\\'
+            pos += 1
+
+        # decode one whole utf-8 char the same way io.open would have
+        raw = self.buf[pos:pos + 4]
+        try:
+            text = raw.decode('utf-8')
+        except UnicodeDecodeError as e:
+            text = raw[:e.start].decode('utf-8')
+            if not text:
+                # invalid bytes are replaced with U+FFFD just like io.open
+                self.peek_size = pos + e.end - self.pos
+                return char + u'\ufffd'
+        if text:
+            char += text[0]
+            pos += len(text[0].encode('utf-8'))
+
+        self.peek_size = pos - self.pos
+        return char
+
+
+def _lex_file_object(file_obj, chunk_size=CHUNK_SIZE):
+    """
+    Generates token tuples from an nginx config file object
+
+    Yields 3-tuples like (token, lineno, quoted)
+    """
+    return iter(_ChunkLexer(file_obj, chunk_size=chunk_size))
+
+
+def _lex_mapped_batches(file_obj):
+    """
+    Generates lists of token tuples by memory-mapping a binary config file
+    """
+    # empty files can't be mapped but they don't have any tokens anyway
+    if os.fstat(file_obj.fileno()).st_size == 0:
+        return
+
+    buf = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    if _MappedLexer.text_only_re.search(buf) is not None:
+        buf.close()
+        text = io.TextIOWrapper(file_obj, encoding='utf-8', errors='replace')
+        for tokens in _ChunkLexer(text)._batches():
+            yield tokens
+        return
+
+    try:
+        for tokens in _MappedLexer(buf)._batches():
+            yield tokens
+    finally:
+        buf.close()
+
+
+def _balance_braces(tokens, quoted, depth):
+    """
+    Checks that the braces in a list of tokens are balanced so far
+
+    :param tokens: list of token strings
+    :param quoted: bytearray of whether each token was quoted
+    :param depth: int; how many braces were left open before these tokens
+    :returns: a 2-tuple like (depth, index) of how many braces are left open
+        after the tokens, and the index of the first right brace that there
+        isn't a left one for, or None if there isn't one
+    """
+    changes = list(map(_BRACE_DEPTHS.get, tokens, itertools.repeat(0, len(tokens))))
+    i = quoted.find(b'\x01')
+    while i != -1:
+        changes[i] = 0
+        i = quoted.find(b'\x01', i + 1)
+
+    # the depth is never negative unless the lowest running total is
+    depths = list(accumulate(changes))
+    if not depths:
+        return depth, None
+    if depth + min(depths) >= 0:
+        return depth + depths[-1], None
+
+    for i, change in enumerate(depths):
+        if depth + change < 0:
+            return depth + change, i
+
+
+def _lex_batches(filename, legacy=False, use_mmap=False):
+    """Generates lists of token tuples from an nginx config file"""
+    if use_mmap and not legacy:
+        f = io.open(filename, mode='rb')
+    else:
+        f = io.open(filename, mode='r', encoding='utf-8', errors='replace')
+
+    with f:
+        if legacy:
+            batches = _iterbatches(_lex_file_object_by_char(f))
+        elif use_mmap:
+            batches = _lex_mapped_batches(f)
+        else:
+            batches = _ChunkLexer(f)._batches()
+
+        for tokens in batches:
+            yield tokens
+
+
+def _lex_buffers(filename, legacy=False, use_mmap=False):
+    """
+    Generates TokenBuffers of an nginx config file's tokens a block at a time
+
+    Errors aren't raised. Instead, the buffer with the tokens before the
+    error has its error set and it's the last one generated.
+    """
     depth = 0
+    line = None  # the line of the last token
+    buf = TokenBuffer()
+    try:
+        for tokens in _lex_batches(filename, legacy=legacy, use_mmap=use_mmap):
+            start = len(buf)
+            buf.extend(tokens)
+            depth, i = _balance_braces(buf.tokens[start:], buf.quoted[start:], depth)
+
+            # raise error if we ever have more right braces than left
+            if i is not None:
+                i += start
+                reason = 'unexpected "}"'
+                buf.error = NgxParserSyntaxError(reason, filename, buf.lines[i])
+                del buf.tokens[i:], buf.lines[i:], buf.quoted[i:]
+                break
+
+            line = buf.lines[-1]
+            if len(buf) >= BATCH_SIZE:
+                yield buf
+                buf = TokenBuffer()
+
+        # raise error if we have less right braces than left at EOF
+        if buf.error is None and depth > 0:
+            reason = 'unexpected end of file, expecting "}"'
+            buf.error = NgxParserSyntaxError(reason, filename, line)
+    except Exception as e:
+        buf.error = e
+    yield buf
+
+
+def lex_buffer(filename, legacy=False, use_mmap=False):
+    """
+    Lexes a whole nginx config file into one TokenBuffer
+
+    This is quicker than putting the tokens from lex() in a list, and the
+    buffer takes up less memory. If there's an error, the buffer has the
+    tokens before it and the error is raised when it's iterated over.
+
+    :param filename: string containing the name of the config file to lex
+    :param legacy: bool; if True, use the slower char-by-char lexer
+    :param use_mmap: bool; if True, lex the file's bytes via a memory map
+    :returns: a TokenBuffer of the file's tokens
+    """
+    buffers = _lex_buffers(filename, legacy=legacy, use_mmap=use_mmap)
+    buf = next(buffers)
+    for more in buffers:
+        buf.tokens.extend(more.tokens)
+        buf.lines.extend(more.lines)
+        buf.quoted.extend(more.quoted)
+        buf.error = more.error
+    return buf
 
-    for token, line, quoted in tokens:
-        if token == '}' and not quoted:
-            depth -= 1
-        elif token == '{' and not quoted:
-            depth += 1
+
+def lex(filename, legacy=False, use_mmap=False):
+    """
+    Generates tokens from an nginx config file
+
+    :param filename: string containing the name of the config file to lex
+    :param legacy: bool; if True, use the slower char-by-char lexer
+    :param use_mmap: bool; if True, lex the file's bytes via a memory map
+    """
+    depth = 0
+    line = None  # the line of the last token
+    for tokens in _lex_batches(filename, legacy=legacy, use_mmap=use_mmap):
+        quoted = bytearray(map(_get_quoted, tokens))
+        depth, i = _balance_braces(list(map(_get_token, tokens)), quoted, depth)
 
         # raise error if we ever have more right braces than left
-        if depth < 0:
+        if i is not None:
+            for token in tokens[:i]:
+                yield token
             reason = 'unexpected "}"'
-            raise NgxParserSyntaxError(reason, filename, line)
-        else:
-            yield (token, line, quoted)
+            raise NgxParserSyntaxError(reason, filename, tokens[i][1])
+
+        for token in tokens:
+            yield token
+        line = tokens[-1][1]
 
     # raise error if we have less right braces than left at EOF
     if depth > 0:
@@ -143,15 +800,6 @@ def _balance_braces(tokens, filename=None):
         raise NgxParserSyntaxError(reason, filename, line)
 
 
-def lex(filename):
-    """Generates tokens from an nginx config file"""
-    with io.open(filename, mode='r', encoding='utf-8', errors='replace') as f:
-        it = _lex_file_object(f)
-        it = _balance_braces(it, filename)
-        for token, line, quoted in it:
-            yield (token, line, quoted)
-
-
 def register_external_lexer(directives, lexer):
     for directive in directives:
         EXTERNAL_LEXERS[directive] = lexer
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+
+class _Slotted(object):
+    """Base for objects that can be read like the dicts they replace"""
+    __slots__ = ()
+    _keys = ()  # dict keys in the order parse() adds them
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self._keys else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._keys and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self._keys if getattr(self, key) is not None]
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self._keys)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        items = ', '.join('%s=%r' % (key, self[key]) for key in self.keys())
+        return '%s(%s)' % (type(self).__name__, items)
+
+
+class Statement(_Slotted):
+    """
+    A directive or comment in a config file
+
+    Keys that a statement dict wouldn't have are None, so a directive that
+    isn't a block has a block of None while an empty block is ().
+    """
+    __slots__ = ('file', 'directive', 'line', 'args', 'includes', 'block', 'comment')
+    _keys = __slots__
+
+    def __init__(self, directive, line=None, args=(), file=None, includes=None,
+            block=None, comment=None):
+        self.file = file
+        self.directive = directive
+        self.line = line
+        self.args = args
+        self.includes = includes
+        self.block = block
+        self.comment = comment
+
+    @classmethod
+    def from_dict(cls, stmt, strings=None):
+        """
+        Makes a statement object out of a statement dict
+
+        :param strings: dict used to share one copy of each repeated string
+        """
+        if strings is None:
+            strings = {}
+        intern = strings.setdefault
+
+        block = stmt.get('block')
+        if block is not None:
+            block = tuple(cls.from_dict(inner, strings) for inner in block)
+
+        includes = stmt.get('includes')
+        if includes is not None:
+            includes = tuple(includes)
+
+        file = stmt.get('file')
+        if file is not None:
+            file = intern(file, file)
+
+        return cls(
+            directive=intern(stmt['directive'], stmt['directive']),
+            line=stmt.get('line'),
+            args=tuple(intern(arg, arg) for arg in stmt.get('args', ())),
+            file=file,
+            includes=includes,
+            block=block,
+            comment=stmt.get('comment')
+        )
+
+    def to_dict(self):
+        """Makes the statement dict that this object stands in for"""
+        stmt = {}
+        for key in self.keys():
+            value = getattr(self, key)
+            if key == 'block':
+                value = [inner.to_dict() for inner in value]
+            elif key in ('args', 'includes'):
+                value = list(value)
+            stmt[key] = value
+        return stmt
+
+
+class ConfigFile(_Slotted):
+    """A parsed config file, or the "config" entry of a payload"""
+    __slots__ = ('file', 'status', 'errors', 'parsed')
+    _keys = __slots__
+
+    def __init__(self, file, status='ok', errors=(), parsed=()):
+        self.file = file
+        self.status = status
+        self.errors = errors
+        self.parsed = parsed
+
+    @classmethod
+    def from_dict(cls, config, strings=None):
+        """
+        Makes a config file object out of a "config" entry dict
+
+        :param strings: dict used to share one copy of each repeated string
+        """
+        if strings is None:
+            strings = {}
+
+        parsed = config['parsed']
+        return cls(
+            file=strings.setdefault(config['file'], config['file']),
+            status=config['status'],
+            errors=tuple(dict(error) for error in config['errors']),
+            parsed=tuple(Statement.from_dict(stmt, strings) for stmt in parsed)
+        )
+
+    def to_dict(self):
+        """Makes the "config" entry dict that this object stands in for"""
+        return {
+            'file': self.file,
+            'status': self.status,
+            'errors': [dict(error) for error in self.errors],
+            'parsed': [stmt.to_dict() for stmt in self.parsed]
+        }
+
+
+def to_objects(payload):
+    """
+    Makes a copy of a parse() payload that uses ConfigFile and Statement
+    objects in place of its "config" entry and statement dicts
+
+    These objects use __slots__ instead of a dict per directive, hold blocks
+    and arguments in tuples, and share one copy of each repeated string.
+    They can be read like the dicts they replace, so build() accepts them.
+    """
+    strings = {}
+    payload = dict(payload)
+    payload['config'] = [
+        config if isinstance(config, ConfigFile)
+        else ConfigFile.from_dict(config, strings)
+        for config in payload['config']
+    ]
+    return payload
+
+
+def to_dicts(payload):
+    """
+    Makes a copy of a parse() payload made with as_objects=True that only
+    uses dicts, like the payload parse() returns by default
+    """
+    payload = dict(payload)
+    payload['config'] = [
+        config.to_dict() if isinstance(config, ConfigFile) else config
+        for config in payload['config']
+    ]
+    return payload
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
+import copy
 import glob
+import hashlib
+import multiprocessing
 import os
 
-from .lexer import lex
-from .analyzer import analyze, enter_block_ctx
+from .lexer import lex_buffer, _lex_buffers, EXTERNAL_LEXERS
+from .analyzer import analyze, enter_block_ctx, DIRECTIVES
+from .builder import EXTERNAL_BUILDERS
+from .cache import ParseCache
+from .objects import ConfigFile, to_objects
+from .graph import IncludeGraph
+from .resolver import IncludeResolver
+from .compat import timer
 from .errors import NgxParserDirectiveError
 
 # map of external / third-party directives to a parse function
@@ -22,218 +31,908 @@ def _prepare_if_args(stmt):
         args[:] = args[start:end]
 
 
-def parse(filename, onerror=None, catch_errors=True, ignore=(), single=False,
-        comments=False, strict=False, combine=False, check_ctx=True,
-        check_args=True):
+class _TokensExhausted(Exception):
+    """Raised when a file ends in the middle of a directive"""
+
+
+def _next_buffer(buffers, buf):
     """
-    Parses an nginx config file and returns a nested dict payload
+    Moves on to the next TokenBuffer that has tokens in it
 
-    :param filename: string contianing the name of the config file to parse
-    :param onerror: function that determines what's saved in "callback"
-    :param catch_errors: bool; if False, parse stops after first error
-    :param ignore: list or tuple of directives to exclude from the payload
-    :param combine: bool; if True, use includes to create a single config obj
-    :param single: bool; if True, including from other files doesn't happen
-    :param comments: bool; if True, including comments to json payload
-    :param strict: bool; if True, unrecognized directives raise errors
-    :param check_ctx: bool; if True, runs context analysis on directives
-    :param check_args: bool; if True, runs arg count analysis on directives
-    :returns: a payload that describes the parsed nginx config
+    The error of the buffer that was used up is raised if it has one.
+
+    :returns: a 6-tuple like (buf, tokens, lines, quoted, i, n) of the
+        buffer, its columns, the index to start at and its length, where
+        buf is None if there are no more tokens
     """
-    config_dir = os.path.dirname(filename)
+    while True:
+        if buf is not None and buf.error is not None:
+            raise buf.error
+        buf = next(buffers, None)
+        if buf is None:
+            return None, (), (), b'', 0, 0
+        if len(buf):
+            return buf, buf.tokens, buf.lines, buf.quoted, 0, len(buf)
 
-    payload = {
-        'status': 'ok',
-        'errors': [],
-        'config': [],
-    }
 
-    # start with the main nginx config file/context
-    includes = [(filename, ())]  # stores (filename, config context) tuples
-    included = {filename: 0} # stores {filename: array index} map
+def _consume_block(buffers, buf, tokens, lines, quoted, i, n):
+    """
+    Skips over tokens until the end of the current block
 
-    def _handle_error(parsing, e):
-        """Adds representaions of an error to the payload"""
-        file = parsing['file']
-        error = str(e)
-        line = getattr(e, 'lineno', None)
+    :returns: the same 6-tuple as _next_buffer for the token after the block
+    """
+    depth = 1
+    while True:
+        if i == n:
+            buf, tokens, lines, quoted, i, n = _next_buffer(buffers, buf)
+            if buf is None:
+                return buf, tokens, lines, quoted, i, n
+
+        token, is_quoted = tokens[i], quoted[i]
+        i += 1
+        if token == '}' and not is_quoted:
+            depth -= 1
+            if depth == 0:
+                return buf, tokens, lines, quoted, i, n
+        elif token == '{' and not is_quoted:
+            depth += 1
+
+
+def _make_error(fname, e, onerror):
+    """Makes a payload representation of an error"""
+    error = {'file': fname, 'error': str(e), 'line': getattr(e, 'lineno', None)}
+    if onerror is not None:
+        error['callback'] = onerror(e)
+    return error
+
+
+def _find_includes(pattern):
+    """Returns the names of the files that an include pattern includes"""
+    if glob.has_magic(pattern):
+        fnames = glob.glob(pattern)
+        fnames.sort()
+        return fnames
+
+    # if the file pattern was explicit, nginx will check
+    # that the included file can be opened and read
+    open(str(pattern)).close()
+    return [pattern]
+
+
+def _timed(func, stats, key):
+    """Wraps a function so the time spent in it is added to stats[key]"""
+    def _wrapped(*args, **kwargs):
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats[key] += timer() - start
+    return _wrapped
 
-        parsing_error = {'error': error, 'line': line}
-        payload_error = {'file': file, 'error': error, 'line': line}
-        if onerror is not None:
-            payload_error['callback'] = onerror(e)
 
-        parsing['status'] = 'failed'
-        parsing['errors'].append(parsing_error)
+def _timed_buffers(buffers, stats):
+    """Counts tokens and adds the time spent lexing them to stats"""
+    buffers = iter(buffers)
+    while True:
+        start = timer()
+        try:
+            buf = next(buffers)
+        except StopIteration:
+            return
+        finally:
+            stats['lex_time'] += timer() - start
+        stats['tokens'] += len(buf)
+        yield buf
 
-        payload['status'] = 'failed'
-        payload['errors'].append(payload_error)
 
-    def _parse(parsing, tokens, ctx=(), consume=False):
-        """Recursively parses nginx config contexts"""
-        fname = parsing['file']
-        parsed = []
+class _TokenReplayer(object):
+    """
+    Lexes files that are parsed once for each context they're included from
 
-        # parse recursively by pulling from a flat stream of tokens
-        for token, lineno, quoted in tokens:
-            comments_in_args = []
+    Files are only kept in a TokenBuffer if they're still waiting to be
+    parsed in another context when they're lexed, so files that are only
+    included from one context are lexed a block at a time. Buffers are
+    dropped when no contexts are left waiting.
+    """
 
-            # we are parsing a block, so break if it's closing
-            if token == '}' and not quoted:
-                break
+    def __init__(self, use_mmap=False):
+        self.use_mmap = use_mmap
+        self.waiting = {}  # stores {filename: contexts waiting to be parsed}
+        self.records = {}  # stores {filename: TokenBuffer} map
 
-            # if we are consuming, then just continue until end of context
-            if consume:
-                # if we find a block inside this context, consume it too
-                if token == '{' and not quoted:
-                    _parse(parsing, tokens, consume=True)
-                continue
+    def add(self, fname):
+        """Counts a context that a file is waiting to be parsed in"""
+        self.waiting[fname] = self.waiting.get(fname, 0) + 1
 
-            # the first token should always(?) be an nginx directive
-            directive = token
+    def tokens(self, fname):
+        """Returns TokenBuffers of a file that's about to be parsed"""
+        self.waiting[fname] -= 1
+        if self.waiting[fname]:
+            if fname not in self.records:
+                self.records[fname] = lex_buffer(fname, use_mmap=self.use_mmap)
+            return [self.records[fname]]
 
-            if combine:
-                stmt = {
-                    'file': fname,
-                    'directive': directive,
-                    'line': lineno,
-                    'args': []
-                }
-            else:
-                stmt = {
-                    'directive': directive,
-                    'line': lineno,
-                    'args': []
-                }
-
-            # if token is comment
-            if directive.startswith('#') and not quoted:
-                if comments:
-                    stmt['directive'] = '#'
-                    stmt['comment'] = token[1:]
-                    parsed.append(stmt)
-                continue
+        if fname in self.records:
+            return [self.records.pop(fname)]
+        return _lex_buffers(fname, use_mmap=self.use_mmap)
 
-            # TODO: add external parser checking and handling
 
-            # parse arguments by reading tokens
-            args = stmt['args']
-            token, __, quoted = next(tokens)  # disregard line numbers of args
-            while token not in ('{', ';', '}') or quoted:
-                if token.startswith('#') and not quoted:
-                    comments_in_args.append(token[1:])
-                else:
-                    stmt['args'].append(token)
+def _iter_events(buffers, fname, ctx, config_dir, onerror=None,
+        catch_errors=True, ignore=(), single=False, comments=False,
+        strict=False, combine=False, check_ctx=True, check_args=True,
+        stats=None, resolver=None):
+    """
+    Generates parse events for a single nginx config file from its tokens
+
+    Events are 2-tuples like (event, obj). A statement that opens a block is
+    a "start_block" event, followed by the events inside the block and then
+    an "end_block" event with the same statement. Include statements are
+    "include" events whose "includes" list holds the included file names.
+    Errors that are caught are "error" events holding a payload error, and
+    errors that aren't caught are raised.
+
+    :param buffers: iterable of TokenBuffers of the file's tokens, which
+        are read by index instead of as tuples
+    :param stats: dict; if given, time spent analyzing statements and
+        finding included files is added to its "analyze_time" and
+        "include_time" values
+    :param resolver: IncludeResolver; if given, included files are found
+        with it
+    """
+    blocks = []  # stores (stmt, comments_in_args, outer ctx) of open blocks
+
+    check = analyze
+    find_includes = _find_includes if resolver is None else resolver.find
+    if stats is not None:
+        check = _timed(analyze, stats, 'analyze_time')
+        find_includes = _timed(find_includes, stats, 'include_time')
+
+    # parse by walking through the tokens in each buffer by index
+    buffers = iter(buffers)
+    buf, tokens, lines, quoted, i, n = None, (), (), b'', 0, 0
+    while True:
+        if i == n:
+            buf, tokens, lines, quoted, i, n = _next_buffer(buffers, buf)
+            if buf is None:
+                break
+
+        token, lineno, is_quoted = tokens[i], lines[i], quoted[i]
+        i += 1
+
+        # we are parsing a block, so end it if it's closing
+        if token == '}' and not is_quoted:
+            if not blocks:
+                return
+            stmt, comments_in_args, ctx = blocks.pop()
+            yield ('end_block', stmt)
+            for comment_stmt in comments_in_args:
+                yield ('comment', comment_stmt)
+            continue
+
+        # the first token should always(?) be an nginx directive
+        directive = token
+
+        if combine:
+            stmt = {
+                'file': fname,
+                'directive': directive,
+                'line': lineno,
+                'args': []
+            }
+        else:
+            stmt = {
+                'directive': directive,
+                'line': lineno,
+                'args': []
+            }
+
+        # if token is comment
+        if directive.startswith('#') and not is_quoted:
+            if comments:
+                stmt['directive'] = '#'
+                stmt['comment'] = token[1:]
+                yield ('comment', stmt)
+            continue
+
+        # TODO: add external parser checking and handling
+
+        # parse arguments by reading tokens
+        args = stmt['args']
+        comments_in_args = []
+        while True:
+            if i == n:
+                buf, tokens, lines, quoted, i, n = _next_buffer(buffers, buf)
+                if buf is None:
+                    raise _TokensExhausted()
+
+            token, is_quoted = tokens[i], quoted[i]  # disregard line numbers of args
+            i += 1
+            if token in ('{', ';', '}') and not is_quoted:
+                break
+
+            if token.startswith('#') and not is_quoted:
+                comments_in_args.append(token[1:])
+            else:
+                stmt['args'].append(token)
+
+        # consume the directive if it is ignored and move on
+        if stmt['directive'] in ignore:
+            # if this directive was a block consume it too
+            if token == '{':
+                buf, tokens, lines, quoted, i, n = _consume_block(
+                    buffers, buf, tokens, lines, quoted, i, n)
+            continue
 
-                token, __, quoted = next(tokens)
+        # prepare arguments
+        if stmt['directive'] == 'if':
+            _prepare_if_args(stmt)
 
-            # consume the directive if it is ignored and move on
-            if stmt['directive'] in ignore:
-                # if this directive was a block consume it too
-                if token == '{' and not quoted:
-                    _parse(parsing, tokens, consume=True)
+        try:
+            # raise errors if this statement is invalid
+            check(
+                fname=fname, stmt=stmt, term=token, ctx=ctx, strict=strict,
+                check_ctx=check_ctx, check_args=check_args
+            )
+        except NgxParserDirectiveError as e:
+            if catch_errors:
+                yield ('error', _make_error(fname, e, onerror))
+
+                # if it was a block but shouldn't have been then consume
+                if e.strerror.endswith(' is not terminated by ";"'):
+                    if token != '}':
+                        buf, tokens, lines, quoted, i, n = _consume_block(
+                            buffers, buf, tokens, lines, quoted, i, n)
+                    elif not blocks:
+                        return
+                    else:
+                        stmt, comments_in_args, ctx = blocks.pop()
+                        yield ('end_block', stmt)
+                        for comment_stmt in comments_in_args:
+                            yield ('comment', comment_stmt)
+
+                # keep on parsin'
                 continue
+            else:
+                raise e
+
+        event = 'directive'
 
-            # prepare arguments
-            if stmt['directive'] == 'if':
-                _prepare_if_args(stmt)
+        # add "includes" to the payload if this is an include statement
+        if not single and stmt['directive'] == 'include':
+            pattern = args[0]
+            if not os.path.isabs(args[0]):
+                pattern = os.path.join(config_dir, args[0])
 
+            # get names of all included files
             try:
-                # raise errors if this statement is invalid
-                analyze(
-                    fname=fname, stmt=stmt, term=token, ctx=ctx, strict=strict,
-                    check_ctx=check_ctx, check_args=check_args
-                )
-            except NgxParserDirectiveError as e:
+                fnames = find_includes(pattern)
+            except Exception as e:
+                fnames = []
+                e.lineno = stmt['line']
                 if catch_errors:
-                    _handle_error(parsing, e)
-
-                    # if it was a block but shouldn't have been then consume
-                    if e.strerror.endswith(' is not terminated by ";"'):
-                        if token != '}' and not quoted:
-                            _parse(parsing, tokens, consume=True)
-                        else:
-                            break
-
-                    # keep on parsin'
-                    continue
+                    yield ('error', _make_error(fname, e, onerror))
                 else:
                     raise e
 
-            # add "includes" to the payload if this is an include statement
-            if not single and stmt['directive'] == 'include':
-                pattern = args[0]
-                if not os.path.isabs(args[0]):
-                    pattern = os.path.join(config_dir, args[0])
+            stmt['includes'] = fnames
+            event = 'include'
+
+        # all comments found inside args come after the stmt
+        comments_in_args = [
+            {'directive': '#', 'line': stmt['line'], 'args': [], 'comment': comment}
+            for comment in comments_in_args
+        ]
+
+        # if this statement terminated with '{' then it is a block
+        if token == '{':
+            blocks.append((stmt, comments_in_args, ctx))
+            ctx = enter_block_ctx(stmt, ctx)  # get context for block
+            yield ('start_block', stmt)
+            continue
+
+        yield (event, stmt)
+        for comment_stmt in comments_in_args:
+            yield ('comment', comment_stmt)
+
+    # close blocks left open when the tokens ran out
+    while blocks:
+        stmt, comments_in_args, ctx = blocks.pop()
+        yield ('end_block', stmt)
+        for comment_stmt in comments_in_args:
+            yield ('comment', comment_stmt)
+
+
+def _parse_file(fname, ctx, config_dir, onerror=None, catch_errors=True,
+        ignore=(), single=False, comments=False, strict=False, combine=False,
+        check_ctx=True, check_args=True, use_mmap=False, stats=None,
+        tokens=None, resolver=None):
+    """
+    Parses a single nginx config file in the context it was included from
+
+    Included files are not parsed here. Instead, the "includes" list of every
+    include statement is left holding the names of the files it includes so
+    that parse() can turn them into indexes in the order nginx would.
+
+    :param stats: dict; if given, it's filled in with _new_stats() counts
+    :param tokens: iterable of TokenBuffers of the file's tokens to use
+        instead of lexing it
+    :param resolver: IncludeResolver; if given, included files are found
+        with it
+    :returns: a 3-tuple like (parsing, errors, include_stmts) where parsing
+        is the file's "config" entry, errors is a list of payload errors, and
+        include_stmts is a list of (stmt, ctx) tuples for include statements
+    """
+    parsing = {
+        'file': fname,
+        'status': 'ok',
+        'errors': [],
+        'parsed': []
+    }
+    errors = []
+    include_stmts = []
 
-                stmt['includes'] = []
+    def _handle_error(error):
+        """Adds representaions of an error to the payload"""
+        parsing_error = {'error': error['error'], 'line': error['line']}
+        parsing['status'] = 'failed'
+        parsing['errors'].append(parsing_error)
+        errors.append(error)
+
+    start = timer()
+    if tokens is None:
+        tokens = _lex_buffers(fname, use_mmap=use_mmap)
+    if stats is not None:
+        tokens = _timed_buffers(tokens, stats)
+
+    # build the nested "parsed" lists out of a flat stream of events
+    events = _iter_events(
+        tokens, fname, ctx, config_dir, onerror=onerror,
+        catch_errors=catch_errors, ignore=ignore, single=single,
+        comments=comments, strict=strict, combine=combine,
+        check_ctx=check_ctx, check_args=check_args, stats=stats,
+        resolver=resolver
+    )
+
+    root = parsed = []
+    blocks = []  # stores (parsed, ctx) of the blocks around the current one
+    try:
+        for event, obj in events:
+            if event == 'error':
+                _handle_error(obj)
+            elif event == 'end_block':
+                parsed, ctx = blocks.pop()
+            else:
+                parsed.append(obj)
+                if stats is not None and event != 'comment':
+                    stats['directives'] += 1
+                if 'includes' in obj:
+                    include_stmts.append((obj, ctx))
+                if event == 'start_block':
+                    obj['block'] = []
+                    blocks.append((parsed, ctx))
+                    parsed, ctx = obj['block'], enter_block_ctx(obj, ctx)
+    except Exception as e:
+        _handle_error(_make_error(fname, e, onerror))
+    else:
+        parsing['parsed'] = root
+
+    if stats is not None:
+        stats['errors'] = len(errors)
+        stats['time'] = timer() - start
+        stats['parse_time'] = stats['time'] - sum(
+            stats[key] for key in ('lex_time', 'analyze_time', 'include_time')
+        )
+        try:
+            stats['bytes'] = os.path.getsize(fname)
+        except OSError:
+            pass
+
+    return parsing, errors, include_stmts
+
+
+def _new_stats():
+    """Makes the dict of counts and times that profiling fills in"""
+    return {
+        'bytes': 0,
+        'tokens': 0,
+        'directives': 0,
+        'errors': 0,
+        'time': 0.0,
+        'lex_time': 0.0,
+        'parse_time': 0.0,
+        'analyze_time': 0.0,
+        'include_time': 0.0
+    }
+
+
+def _profile_file(fname, ctx, config_dir, **options):
+    """Parses a file like _parse_file and returns (result, stats)"""
+    stats = dict(file=fname, **_new_stats())
+    result = _parse_file(fname, ctx, config_dir, stats=stats, **options)
+    return result, stats
+
+
+def _handler_names(handlers):
+    """Returns sorted (directive, handler name) tuples for a registry"""
+    names = []
+    for directive, handler in handlers.items():
+        owner = getattr(handler, '__self__', None)
+        name = getattr(handler, '__name__', type(handler).__name__)
+        if owner is not None:
+            name = type(owner).__name__ + '.' + name
+        names.append((directive, getattr(handler, '__module__', None), name))
+    return sorted(names)
+
+
+def _extensions_key():
+    """
+    Describes the registered extensions and directives for cache keys
+
+    A result cached by a process that had a plugin registered is wrong for
+    one that doesn't (and the other way around), so the names of external
+    lexers, parsers and builders and a hash of the DIRECTIVES table are
+    part of every key.
+    """
+    directives = repr(sorted(DIRECTIVES.items())).encode('utf-8')
+    return (
+        _handler_names(EXTERNAL_LEXERS),
+        _handler_names(EXTERNAL_PARSERS),
+        _handler_names(EXTERNAL_BUILDERS),
+        hashlib.sha1(directives).hexdigest()
+    )
+
+
+def _cache_key(cache, fname, ctx, config_dir, options, extensions=()):
+    """
+    Makes a parse cache key for a file, or returns None if it can't
+
+    :param extensions: what _extensions_key() returned for this parse
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+
+    flags = dict(options)
+    del flags['onerror'], flags['use_mmap']
+    flags['ignore'] = sorted(flags['ignore'])
+    flags = sorted(flags.items())
+
+    return cache.key(fname, st.st_size, st.st_mtime, ctx, config_dir, flags, extensions)
+
+
+def _includes_unchanged(result, config_dir, resolver):
+    """Checks that a cached file's includes would still find the same files"""
+    parsing, errors, include_stmts = result
+    for stmt, ctx in include_stmts:
+        pattern = stmt['args'][0]
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(config_dir, pattern)
 
-                # get names of all included files
-                if glob.has_magic(pattern):
-                    fnames = glob.glob(pattern)
-                    fnames.sort()
-                else:
-                    try:
-                        # if the file pattern was explicit, nginx will check
-                        # that the included file can be opened and read
-                        open(str(pattern)).close()
-                        fnames = [pattern]
-                    except Exception as e:
-                        fnames = []
-                        e.lineno = stmt['line']
-                        if catch_errors:
-                            _handle_error(parsing, e)
-                        else:
-                            raise e
-
-                for fname in fnames:
-                    # the included set keeps files from being parsed twice
-                    # TODO: handle files included from multiple contexts
-                    if fname not in included:
-                        included[fname] = len(includes)
-                        includes.append((fname, ctx))
-                    index = included[fname]
-                    stmt['includes'].append(index)
-
-            # if this statement terminated with '{' then it is a block
-            if token == '{' and not quoted:
-                inner = enter_block_ctx(stmt, ctx)  # get context for block
-                stmt['block'] = _parse(parsing, tokens, ctx=inner)
-
-            parsed.append(stmt)
-
-            # add all comments found inside args after stmt is added
-            for comment in comments_in_args:
-                comment_stmt = {
-                    'directive': '#',
-                    'line': stmt['line'],
-                    'args': [],
-                    'comment': comment
-                }
-                parsed.append(comment_stmt)
-
-        return parsed
-
-    # the includes list grows as "include" directives are found in _parse
-    for fname, ctx in includes:
-        tokens = lex(fname)
-        parsing = {
-            'file': fname,
-            'status': 'ok',
-            'errors': [],
-            'parsed': []
-        }
         try:
-            parsing['parsed'] = _parse(parsing, tokens, ctx=ctx)
+            fnames = resolver.find(pattern)
+        except Exception:
+            fnames = []
+
+        if fnames != stmt['includes']:
+            return False
+
+    return True
+
+
+def _find_includer(includes, parents, index, fname):
+    """
+    Returns the index of the file at index or the file that included it,
+    or the file that included that one and so on, if its name is fname
+    """
+    while index is not None:
+        if includes[index][0] == fname:
+            return index
+        index = parents[index]
+    return None
+
+
+def parse(filename, onerror=None, catch_errors=True, ignore=(), single=False,
+        comments=False, strict=False, combine=False, check_ctx=True,
+        check_args=True, use_mmap=False, workers=None, cache_dir=None,
+        as_objects=False, profile=False, graph=False, resolver=None,
+        executor=None, serialize=None, cache=None):
+    """
+    Parses an nginx config file and returns a nested dict payload
+
+    :param filename: string contianing the name of the config file to parse
+    :param onerror: function that determines what's saved in "callback"
+    :param catch_errors: bool; if False, parse stops after first error
+    :param ignore: list or tuple of directives to exclude from the payload
+    :param combine: bool; if True, use includes to create a single config obj
+    :param single: bool; if True, including from other files doesn't happen
+    :param comments: bool; if True, including comments to json payload
+    :param strict: bool; if True, unrecognized directives raise errors
+    :param check_ctx: bool; if True, runs context analysis on directives
+    :param check_args: bool; if True, runs arg count analysis on directives
+    :param use_mmap: bool; if True, lexes files' bytes through a memory map
+    :param workers: int; if given, included files are parsed by a pool of
+        this many processes (onerror must be picklable if this is used)
+    :param cache_dir: string; if given, files' parse results are cached in
+        this directory and only files that changed are parsed again (this
+        is skipped if onerror is used since callbacks can't be cached); it
+        has to be one that only the current user can write to
+    :param as_objects: bool; if True, the "config" entries and statements
+        in the payload are ConfigFile and Statement objects from
+        crossplane.objects instead of dicts, which use less memory
+    :param profile: bool or function; if truthy, the payload gets a "stats"
+        dict of counts and times for each file that was parsed and in total,
+        and if it's a function it's also called with that dict
+    :param graph: bool; if True, the payload gets a "graph" that is an
+        IncludeGraph from crossplane.graph of which files include which
+    :param resolver: IncludeResolver from crossplane.resolver; if given,
+        include patterns are resolved with it instead of a new one, so that
+        parses can share what it found (see IncludeResolver.invalidate)
+    :param executor: concurrent.futures.Executor; if given, files are read
+        and parsed in it (and workers is ignored), so that files that don't
+        depend on each other can be parsed at the same time
+    :param serialize: function; if given, each "config" entry is replaced
+        with what this returns for it (like its json) as soon as its file is
+        done, so that the dicts of every file aren't kept at the same time
+        (this is skipped if combine is used since that needs the dicts)
+    :param cache: ParseCache or MemoryCache from crossplane.cache; if given
+        (and cache_dir isn't), files' parse results are cached in it, so a
+        process that parses many times can keep one (its "cache" counts in
+        the payload are for every parse that used it)
+    :returns: a payload that describes the parsed nginx config
+    """
+    options = {
+        'onerror': onerror,
+        'catch_errors': catch_errors,
+        'ignore': ignore,
+        'single': single,
+        'comments': comments,
+        'strict': strict,
+        'combine': combine,
+        'check_ctx': check_ctx,
+        'check_args': check_args,
+        'use_mmap': use_mmap
+    }
+
+    return _parse_payload(filename, options, workers, cache_dir,
+        as_objects=as_objects, profile=profile, graph=graph, resolver=resolver,
+        executor=executor, serialize=serialize, cache=cache)
+
+
+def iterparse(filename, onerror=None, catch_errors=True, ignore=(),
+        single=False, comments=False, strict=False, check_ctx=True,
+        check_args=True, use_mmap=False, resolver=None):
+    """
+    Parses an nginx config file and its includes, generating events as it goes
+
+    Events are 2-tuples like (event, obj) where event is one of "start_block",
+    "directive", "end_block", "comment", "include" or "error". A statement
+    that opens a block is given by a "start_block" event, then the events
+    inside the block, then an "end_block" event with the same statement.
+    Every statement has a "file" key, and the "includes" list of an include
+    statement holds the names of the files it includes. Included files are
+    parsed after the file that includes them, in the same order parse() uses,
+    so a file included from more than one context is parsed once for each.
+
+    Arguments are the same as parse() except for combine and workers, which
+    don't apply to events. If catch_errors is False, parsing a file stops at
+    its first error, but the error is still generated as an event.
+
+    :returns: a generator of (event, obj) tuples
+    """
+    config_dir = os.path.dirname(filename)
+    if resolver is None:
+        resolver = IncludeResolver()
+
+    # start with the main nginx config file/context
+    includes = [(filename, ())]  # stores (filename, config context) tuples
+    included = set(includes)
+    parents = [None]  # stores the array index of the file including each one
+    replayer = _TokenReplayer(use_mmap=use_mmap)
+    replayer.add(filename)
+
+    # the includes list grows as "include" directives are found in files
+    for index, (fname, ctx) in enumerate(includes):
+        ctxs = []  # stores the contexts of the blocks around the current one
+        try:
+            tokens = replayer.tokens(fname)
+            events = _iter_events(
+                tokens, fname, ctx, config_dir, onerror=onerror,
+                catch_errors=catch_errors, ignore=ignore, single=single,
+                comments=comments, strict=strict, combine=True,
+                check_ctx=check_ctx, check_args=check_args, resolver=resolver
+            )
+            for event, obj in events:
+                if event in ('include', 'start_block') and 'includes' in obj:
+                    for include in obj['includes']:
+                        cycle = _find_includer(includes, parents, index, include)
+                        if (include, ctx) not in included and cycle is None:
+                            included.add((include, ctx))
+                            includes.append((include, ctx))
+                            parents.append(index)
+                            replayer.add(include)
+
+                if event == 'start_block':
+                    ctxs.append(ctx)
+                    ctx = enter_block_ctx(obj, ctx)
+                elif event == 'end_block':
+                    ctx = ctxs.pop()
+
+                yield (event, obj)
         except Exception as e:
-            _handle_error(parsing, e)
+            yield ('error', _make_error(fname, e, onerror))
 
-        payload['config'].append(parsing)
 
-    if combine:
-        return _combine_parsed_configs(payload)
-    else:
-        return payload
+def reparse(payload, changed_files, onerror=None, catch_errors=True,
+        ignore=(), single=False, comments=False, strict=False, check_ctx=True,
+        check_args=True, use_mmap=False, workers=None, cache_dir=None,
+        profile=False, graph=False, resolver=None):
+    """
+    Parses an nginx config again after some of its files have changed
+
+    Only the changed files, files whose includes now match different files,
+    and files that weren't included before are lexed and parsed. Everything
+    else is reused from the earlier payload (unchanged config objects that
+    don't include other files are shared by both payloads, not copied).
+
+    The result is the same as calling parse() again with the same options.
+
+    :param payload: a payload returned by parse() (but not with combine or
+        as_objects)
+    :param changed_files: list of names of the files that were changed
+        (if a resolver is given, these are invalidated in it, but files
+        that were added or deleted have to be included too)
+    :returns: a payload that describes the parsed nginx config
+    """
+    options = {
+        'onerror': onerror,
+        'catch_errors': catch_errors,
+        'ignore': ignore,
+        'single': single,
+        'comments': comments,
+        'strict': strict,
+        'combine': False,
+        'check_ctx': check_ctx,
+        'check_args': check_args,
+        'use_mmap': use_mmap
+    }
+
+    filename = payload['config'][0]['file']
+    config_dir = os.path.dirname(filename)
+    changed = set(os.path.abspath(fname) for fname in changed_files)
+    configs = payload['config']
+
+    if resolver is None:
+        resolver = IncludeResolver()
+    for fname in changed:
+        resolver.invalidate(fname)
+
+    # find the context each config was parsed in and its errors
+    previous = {}  # stores {(filename, ctx): (array index, errors)} map
+    contexts = {0: ()}  # stores {array index: ctx} map
+    errors = iter(payload['errors'])
+    for index, config in enumerate(configs):
+        file_errors = [next(errors) for error in config['errors']]
+
+        # files included by a file that failed to parse can't be reused
+        # because the include statements giving their context are gone
+        if index not in contexts:
+            continue
+
+        ctx = contexts[index]
+        previous[(config['file'], ctx)] = (index, file_errors)
+        for stmt, stmt_ctx in _find_include_stmts(config['parsed'], ctx):
+            for i in stmt['includes']:
+                contexts.setdefault(i, stmt_ctx)
+
+    def _reuse(fname, ctx):
+        """Returns the earlier result of _parse_file if it's still valid"""
+        if (fname, ctx) not in previous or os.path.abspath(fname) in changed:
+            return None
+
+        index, file_errors = previous[(fname, ctx)]
+        parsing = configs[index]
+
+        # include statements after an error that wasn't caught are missing,
+        # and so are all of them if the error stopped the file being parsed
+        if parsing['status'] == 'failed' and not (catch_errors and parsing['parsed']):
+            return None
+
+        # copy files with includes because parse() changes their indexes
+        include_stmts = list(_find_include_stmts(parsing['parsed'], ctx))
+        if include_stmts:
+            parsing = copy.deepcopy(parsing)
+            include_stmts = list(_find_include_stmts(parsing['parsed'], ctx))
+            for stmt, stmt_ctx in include_stmts:
+                stmt['includes'] = [configs[i]['file'] for i in stmt['includes']]
+
+        result = (parsing, list(file_errors), include_stmts)
+        if not _includes_unchanged(result, config_dir, resolver):
+            return None
+
+        return result
+
+    return _parse_payload(filename, options, workers, cache_dir,
+        reuse=_reuse, profile=profile, graph=graph, resolver=resolver)
+
+
+def _find_include_stmts(block, ctx):
+    """Generates (stmt, ctx) tuples for include statements in a block"""
+    for stmt in block:
+        if 'includes' in stmt:
+            yield (stmt, ctx)
+        if 'block' in stmt:
+            inner = enter_block_ctx(stmt, ctx)
+            for stmt_ctx in _find_include_stmts(stmt['block'], inner):
+                yield stmt_ctx
+
+
+def _parse_payload(filename, options, workers=None, cache_dir=None,
+        reuse=None, as_objects=False, profile=False, graph=False,
+        resolver=None, executor=None, serialize=None, cache=None):
+    """
+    Parses an nginx config file and all of the files it includes
+
+    :param reuse: function that is given a file name and context and may
+        return an earlier result of _parse_file to use instead of parsing
+    :param as_objects: bool; if True, the payload is made of objects
+    :param profile: bool or function; if truthy, the payload gets "stats"
+    :param graph: bool; if True, the payload gets an IncludeGraph "graph"
+    :param resolver: IncludeResolver; used instead of a new one if given
+        (worker processes find included files without it)
+    :param executor: concurrent.futures.Executor; if given, files are parsed
+        in it instead of in this thread or a pool of worker processes
+    :param serialize: function that finished "config" entries are replaced
+        with what it returns for them, unless combine is used
+    :param cache: ParseCache or MemoryCache; used if cache_dir isn't given
+    """
+    start = timer()
+    config_dir = os.path.dirname(filename)
+
+    payload = {
+        'status': 'ok',
+        'errors': [],
+        'config': [],
+    }
+
+    # start with the main nginx config file/context
+    includes = [(filename, ())]  # stores (filename, config context) tuples
+    included = {(filename, ()): 0}  # stores {(filename, ctx): array index} map
+    parents = [None]  # stores the array index of the file including each one
+    replayer = _TokenReplayer(use_mmap=options['use_mmap'])
+
+    pool = None
+    results = {}  # stores {array index: function returning result} map
+    if workers and executor is None and not options['single']:
+        pool = multiprocessing.Pool(workers)
+
+    keys = {}  # stores {array index: cache key} map for cache misses
+    strings = {}  # stores one copy of each string used by objects
+    if options['onerror'] is not None:
+        cache = None
+    elif cache_dir is not None:
+        cache = ParseCache(cache_dir)
+
+    extensions = None if cache is None else _extensions_key()
+
+    if resolver is None:
+        resolver = IncludeResolver()
+    resolved = resolver.stats()  # subtracted so a shared resolver's counts are per parse
+
+    parse_file = _parse_file
+    stats = None
+    profiled = set()  # stores array indexes of files parsed with stats
+    if profile:
+        parse_file = _profile_file
+        stats = {'total': _new_stats(), 'files': []}
+
+    include_graph = IncludeGraph(filename) if graph else None
+
+    def _start(index):
+        """Starts parsing a file unless its result is already known"""
+        fname, ctx = includes[index]
+
+        if reuse is not None:
+            result = reuse(fname, ctx)
+            if result is not None:
+                results[index] = lambda: result
+                return
+
+        if cache is not None:
+            key = _cache_key(cache, fname, ctx, config_dir, options, extensions)
+            if key is not None:
+                validate = lambda result: _includes_unchanged(result, config_dir, resolver)
+                result = cache.get(key, validate=validate)
+                if result is not None:
+                    results[index] = lambda: result
+                    return
+                keys[index] = key
+
+        args = (fname, ctx, config_dir)
+        if pool is not None:
+            results[index] = pool.apply_async(parse_file, args, options).get
+        elif executor is not None:
+            future = executor.submit(parse_file, *args, resolver=resolver, **options)
+            results[index] = future.result
+        else:
+            replayer.add(fname)
+            results[index] = lambda: parse_file(*args, tokens=replayer.tokens(fname),
+                resolver=resolver, **options)
+        if profile:
+            profiled.add(index)
+
+    try:
+        # the includes list grows as "include" directives are found in files
+        for index, (fname, ctx) in enumerate(includes):
+            if index not in results:
+                _start(index)
+            result = results.pop(index)()
+            if index in profiled:
+                result, file_stats = result
+                stats['files'].append(file_stats)
+
+            # failed parses are only cached if errors were caught, because
+            # otherwise include statements after the error can't be checked
+            parsing, errors, include_stmts = result
+            if index in keys and (options['catch_errors'] or parsing['status'] == 'ok'):
+                cache.set(keys.pop(index), result)
+
+            if errors:
+                payload['status'] = 'failed'
+                payload['errors'].extend(errors)
+
+            for stmt, stmt_ctx in include_stmts:
+                for i, include in enumerate(stmt['includes']):
+                    # files are parsed once for each context they're included
+                    # from, except when they include themselves, which would
+                    # otherwise go on forever with deeper and deeper contexts
+                    key = (include, stmt_ctx)
+                    cycle = _find_includer(includes, parents, index, include)
+                    if key not in included and cycle is None:
+                        included[key] = len(includes)
+                        includes.append(key)
+                        parents.append(index)
+                        _start(included[key])
+                    stmt['includes'][i] = included.get(key, cycle)
+                    if include_graph is not None:
+                        include_graph.add_edge(fname, stmt['line'], include, stmt_ctx)
+
+            # combining needs dicts, so objects are made after that instead
+            if not options['combine']:
+                if serialize is not None:
+                    parsing = serialize(parsing)
+                elif as_objects:
+                    parsing = ConfigFile.from_dict(parsing, strings)
+
+            payload['config'].append(parsing)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if options['combine']:
+        payload = _combine_parsed_configs(payload)
+        if as_objects:
+            payload = to_objects(payload)
+
+    if cache is not None:
+        payload['cache'] = cache.stats()
+
+    if include_graph is not None:
+        payload['graph'] = include_graph
+
+    if stats is not None:
+        total = stats['total']
+        for file_stats in stats['files']:
+            for key in total:
+                total[key] += file_stats[key]
+        total['time'] = timer() - start
+        stats['resolver'] = dict((k, v - resolved[k]) for k, v in resolver.stats().items())
+        payload['stats'] = stats
+        if callable(profile):
+            profile(stats)
+
+    return payload
 
 
 def _combine_parsed_configs(old_payload):
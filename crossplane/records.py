@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from .analyzer import enter_block_ctx
+from .compat import get_json_backend
+from .parser import parse
+
+
+class _Flattener(object):
+    """
+    Turns "config" entries into records in the order parse() makes them
+
+    A file's context is only known from the include statement that included
+    it, which is always in an earlier entry, so entries have to be given to
+    this one at a time starting with the first.
+    """
+
+    def __init__(self, directives=False):
+        self.directives = directives
+        self.contexts = {0: ()}  # stores {array index: ctx} map
+        self.index = 0
+
+    def __call__(self, config, errors=None):
+        """
+        Returns the records for a "config" entry
+
+        :param errors: list of the entry's errors from the payload's
+            "errors", which have the "file" they're from (with combine, the
+            entry's own errors don't)
+        """
+        if not self.directives:
+            return [config]
+        ctx = self.contexts.pop(self.index, ())
+        self.index += 1
+        records = []
+        self._walk(config['parsed'], config['file'], ctx, records)
+        if errors is None:
+            errors = config['errors']
+        for error in errors:
+            record = {'file': config['file']}
+            record.update(error)
+            records.append(record)
+        return records
+
+    def _walk(self, block, fname, ctx, records):
+        for stmt in block:
+            for index in stmt.get('includes', ()):
+                self.contexts.setdefault(index, ctx)
+            record = {'file': fname}
+            record.update((k, v) for k, v in stmt.items() if k != 'block')
+            record['context'] = list(ctx)
+            records.append(record)
+            if 'block' in stmt:
+                self._walk(stmt['block'], fname, enter_block_ctx(stmt, ctx), records)
+
+
+def iterrecords(payload, directives=False):
+    """
+    Generates records from a payload that can each be written as a json line
+
+    By default there's a record for each "config" entry, which is the entry
+    itself. If directives is True, there's a record for every statement
+    instead, which has the "file" it's in and the "context" it's in (like
+    ["http", "server"]), and its keys other than "block". Errors from the
+    payload are records too, with the "file" and "line" they're from.
+
+    :param payload: a payload returned by parse() (but not with as_objects)
+    :param directives: bool; if True, generate a record for each statement
+    :returns: a generator of dicts
+    """
+    flatten = _Flattener(directives)
+    errors = iter(payload['errors'])
+    for config in payload['config']:
+        file_errors = [next(errors) for error in config['errors']]
+        for record in flatten(config, file_errors):
+            yield record
+
+
+def dump(filename, fp, directives=False, json_backend=None, **kwargs):
+    """
+    Parses an nginx config file and writes its records as json lines
+
+    Each file's records (see iterrecords) are written to the file object as
+    soon as the file is parsed, so the whole payload isn't kept in memory
+    and the output can be read and split up a line at a time.
+
+    :param fp: file object that lines of json text are written to
+    :param directives: bool; if True, write a record for each statement
+    :param json_backend: string; name of the json library that records are
+        dumped with (see crossplane.compat.get_json_backend)
+    :param kwargs: any other arguments that parse() takes (except for
+        as_objects and serialize, which are ignored)
+    :returns: the payload's "status", which is "ok" or "failed"
+    """
+    backend = get_json_backend(json_backend)
+    flatten = _Flattener(directives)
+
+    def _write(config):
+        for record in flatten(config):
+            fp.write(u'' + backend.dumps(record) + u'\n')
+        return None
+
+    kwargs['as_objects'] = False
+    kwargs['serialize'] = _write
+    payload = parse(filename, **kwargs)
+
+    # serialize isn't used with combine, so records are written after that
+    if kwargs.get('combine'):
+        for record in iterrecords(payload, directives):
+            fp.write(u'' + backend.dumps(record) + u'\n')
+    return payload['status']
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import glob
+import os
+
+from .compat import scandir
+
+
+def _parent(path):
+    """Returns the directory whose listing has path in it"""
+    return os.path.dirname(path.rstrip(os.sep) or path)
+
+
+def _stamp(path):
+    """Returns what changes about a path when it or its entries change"""
+    try:
+        st = os.stat(path or os.curdir)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_ctime
+
+
+class IncludeResolver(object):
+    """
+    Finds the files that include directives include and remembers them
+
+    Include patterns are matched the same way glob.glob() matches them, but
+    directory listings come from os.scandir() and are kept, along with the
+    results of patterns and of checking that explicitly included files can
+    be opened. Configs often repeat the same include patterns hundreds of
+    times, so this saves a lot of syscalls (which is more noticeable on
+    network file systems).
+
+    A resolver used for one parse doesn't need to be told about changes.
+    One that's shared by many parses has to be told which paths changed
+    with invalidate(), or it will keep finding the files it found before.
+    If it's made with watch=True, it remembers the modification times of
+    the directories it looked in, and refresh() forgets whatever was found
+    in the ones that changed since then.
+    """
+
+    def __init__(self, watch=False):
+        self._listings = {}  # stores {dirname: [(name, DirEntry or None)]}
+        self._paths = {}  # stores {(path, dironly): exists} map
+        self._opened = {}  # stores {filename: None or the error it raised}
+        self._patterns = {}  # stores {pattern: (fnames, syscalls needed)}
+        self._stamps = {} if watch else None  # stores {path: _stamp(path)} map
+        self.hits = 0
+        self.misses = 0
+        self.syscalls = 0  # syscalls that were made
+        self.needed = 0  # syscalls that would have been made with no cache
+
+    def _watch(self, path):
+        """Remembers a path's times before something is found out from it"""
+        if self._stamps is not None and path not in self._stamps:
+            self._stamps[path] = _stamp(path)
+
+    def _listdir(self, dirname):
+        """Returns (name, entry) tuples for everything in a directory"""
+        self.needed += 1
+        if dirname in self._listings:
+            return self._listings[dirname]
+
+        self._watch(dirname)
+        self.syscalls += 1
+        try:
+            if scandir is not None:
+                listing = [(entry.name, entry) for entry in scandir(dirname or os.curdir)]
+            else:
+                listing = [(name, None) for name in os.listdir(dirname or os.curdir)]
+        except OSError:
+            listing = []
+
+        self._listings[dirname] = listing
+        return listing
+
+    def _exists(self, path, dironly):
+        """Checks that a path exists like os.path.lexists or os.path.isdir"""
+        self.needed += 1
+        key = (path, dironly)
+        if key not in self._paths:
+            self._watch(_parent(path))
+            self.syscalls += 1
+            self._paths[key] = os.path.isdir(path) if dironly else os.path.lexists(path)
+        return self._paths[key]
+
+    def _glob_in_dir(self, dirname, pattern, dironly):
+        names = []
+        for name, entry in self._listdir(dirname):
+            if dironly:
+                # entries cache whether they're directories themselves
+                try:
+                    if entry is not None:
+                        is_dir = entry.is_dir()
+                    else:
+                        is_dir = os.path.isdir(os.path.join(dirname, name))
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    continue
+            names.append(name)
+
+        if pattern[0] != '.':
+            names = [name for name in names if name[0] != '.']
+        return fnmatch.filter(names, pattern)
+
+    def _iglob(self, pattern, dironly):
+        """Generates the paths that glob.glob() would for a pattern"""
+        dirname, basename = os.path.split(pattern)
+
+        if not glob.has_magic(pattern):
+            if self._exists(pattern if basename else dirname, not basename or dironly):
+                yield pattern
+            return
+
+        if not dirname:
+            for name in self._glob_in_dir(dirname, basename, dironly):
+                yield name
+            return
+
+        if dirname != pattern and glob.has_magic(dirname):
+            dirs = self._iglob(dirname, True)
+        else:
+            dirs = [dirname]
+
+        for dirname in dirs:
+            if glob.has_magic(basename):
+                names = self._glob_in_dir(dirname, basename, dironly)
+            elif basename:
+                exists = self._exists(os.path.join(dirname, basename), False)
+                names = [basename] if exists else []
+            else:
+                names = [basename] if self._exists(dirname, True) else []
+            for name in names:
+                yield os.path.join(dirname, name)
+
+    def glob(self, pattern):
+        """Returns the sorted paths that match a glob pattern"""
+        if pattern in self._patterns:
+            fnames, needed = self._patterns[pattern]
+            self.hits += 1
+            self.needed += needed
+            return list(fnames)
+
+        self.misses += 1
+        before = self.needed
+        fnames = sorted(self._iglob(pattern, False))
+        self._patterns[pattern] = (fnames, self.needed - before)
+        return list(fnames)
+
+    def open(self, filename):
+        """Checks that a file can be opened, raising the error open() would"""
+        self.needed += 1
+        if filename in self._opened:
+            self.hits += 1
+            e = self._opened[filename]
+        else:
+            self.misses += 1
+            self._watch(_parent(filename))
+            self._watch(filename)
+            self.syscalls += 1
+            try:
+                open(str(filename)).close()
+                e = None
+            except EnvironmentError as err:
+                if err.errno is None:
+                    raise
+                e = err
+            self._opened[filename] = e
+
+        # raise a copy because the parser adds a line number to it
+        if e is not None:
+            raise type(e)(e.errno, e.strerror, e.filename)
+
+    def find(self, pattern):
+        """Returns the names of the files that an include pattern includes"""
+        if glob.has_magic(pattern):
+            return self.glob(pattern)
+
+        # if the file pattern was explicit, nginx will check
+        # that the included file can be opened and read
+        self.open(pattern)
+        return [pattern]
+
+    def invalidate(self, path=None):
+        """
+        Forgets what's known about a file or directory that changed
+
+        The directory it's in is listed again the next time it's needed.
+
+        :param path: string; the changed path, or None to forget everything
+        """
+        self._patterns.clear()
+        if path is None:
+            self._listings.clear()
+            self._paths.clear()
+            self._opened.clear()
+            if self._stamps is not None:
+                self._stamps.clear()
+            return
+
+        # the same path can be spelled differently by different includes
+        path = os.path.abspath(path)
+        changed = lambda name: os.path.abspath(name or os.curdir) == path
+        parent = os.path.dirname(path)
+        for name in list(self._listings):
+            if os.path.abspath(name or os.curdir) in (path, parent):
+                del self._listings[name]
+        for key in list(self._paths):
+            if changed(key[0]):
+                del self._paths[key]
+        for name in list(self._opened):
+            if changed(name):
+                del self._opened[name]
+
+    def refresh(self):
+        """
+        Forgets what was found in directories that changed since then
+
+        Files and directories that were added, removed or renamed change the
+        times of the directory they're in, and files whose permissions were
+        changed are checked too, so this costs one stat() for each of those
+        paths instead of listing and opening everything again. It only works
+        for resolvers made with watch=True.
+
+        :returns: int; the number of paths that changed
+        """
+        if not self._stamps:
+            return 0
+
+        changed = set(path for path, stamp in self._stamps.items() if _stamp(path) != stamp)
+        if not changed:
+            return 0
+
+        self._patterns.clear()
+        for path in changed:
+            del self._stamps[path]
+        for name in list(self._listings):
+            if name in changed:
+                del self._listings[name]
+        for key in list(self._paths):
+            if _parent(key[0]) in changed:
+                del self._paths[key]
+        for name in list(self._opened):
+            if name in changed or _parent(name) in changed:
+                del self._opened[name]
+        return len(changed)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'syscalls': self.syscalls,
+            'saved_syscalls': self.needed - self.syscalls
+        }
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+A server that answers crossplane commands over a unix domain socket
+
+Starting python and importing crossplane takes longer than parsing most
+configs, so something that runs crossplane many times can start a server
+once with `crossplane serve` and send it requests instead. The server also
+keeps the results of parsing files and of finding included files between
+requests, and only parses the files that changed since.
+
+Each request is a line of json like this:
+
+    {"command": "parse", "args": {"filename": "nginx.conf"}, "cwd": "/etc/nginx"}
+
+where "args" are the command's options with the names that the functions in
+crossplane.__main__ take, and "cwd" is the directory that relative paths are
+relative to. Each response is a line of json, followed by "size" bytes of
+what the command wrote to stdout:
+
+    {"status": "ok", "exit": 0, "size": 1234}
+
+The "status" is "failed" if the command raised an error, and then "error"
+has its traceback. It's "refused" if the request couldn't be run at all,
+like when the command is unknown or its "version" isn't the server's.
+Requests are run one at a time, in the order they're received.
+
+The crossplane commands only send requests to a server when CROSSPLANE_SOCKET
+is set, and only if the socket is owned by the same user and nobody else can
+connect to it. If they can't send the request in time, they run the command
+themselves. Once it's sent, they wait for the answer however long it takes,
+since the server may already be running the command.
+"""
+import io
+import os
+import socket
+import stat
+import sys
+import tempfile
+import traceback
+
+from . import __version__
+from .cache import MemoryCache, DEFAULT_MAX_SIZE
+from .compat import basestring, json
+from .resolver import IncludeResolver
+
+# environment variable with the path of the socket, which commands only
+# send requests to if it's set
+SOCKET_ENV = 'CROSSPLANE_SOCKET'
+
+# seconds that a client waits to connect and send a request before it gives
+# up on the server (after that it waits as long as the command takes)
+DEFAULT_TIMEOUT = 10.0
+
+
+class ServerError(Exception):
+    """Raised when a server was sent a request but didn't answer it"""
+
+
+def default_socket_path():
+    """
+    Returns the socket path from CROSSPLANE_SOCKET, or else one in the
+    user's runtime directory ($XDG_RUNTIME_DIR) or the temp directory
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'crossplane.sock')
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'crossplane-%d.sock' % uid)
+
+
+def _check_socket(path):
+    """
+    Makes sure a socket was made by a server that this user started
+
+    Anyone can make files in the temp directory, so otherwise another user
+    could listen there first and answer requests with whatever they want.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISSOCK(st.st_mode):
+        raise EnvironmentError('%s is not a socket' % path)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise EnvironmentError('%s belongs to another user' % path)
+    if st.st_mode & 0o077:
+        raise EnvironmentError('other users can connect to %s' % path)
+
+
+class _Output(object):
+    """Collects what a command writes to stdout, as text or as bytes"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.buffer = self
+
+    def write(self, text):
+        self.data.extend(text if isinstance(text, bytes) else text.encode('utf-8'))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass  # commands close stdout when they're done with it
+
+
+def _send(conn, response, output=b''):
+    response['size'] = len(output)
+    header = json.dumps(response, separators=(',', ':')) + '\n'
+    conn.sendall(header.encode('utf-8'))
+    if output:
+        conn.sendall(output)
+
+
+class Server(object):
+    """
+    Listens on a unix domain socket and runs the commands it's sent
+
+    :param commands: dict of {name: function} that requests can run, where
+        each function is called with the request's "args" as keyword args
+    :param path: string; the socket's path (see default_socket_path)
+    :param max_cache_size: int; bytes of parse results to keep in memory
+    """
+
+    def __init__(self, commands=None, path=None, max_cache_size=DEFAULT_MAX_SIZE):
+        self.commands = dict(commands or {})
+        self.path = default_socket_path() if path is None else path
+        self.cache = MemoryCache(max_cache_size)
+        self._resolvers = {}  # stores {working directory: IncludeResolver}
+        self._sock = None
+        self._stopping = False
+
+    def resolver(self):
+        """
+        Returns the include resolver for the working directory
+
+        Include patterns can be relative, so each directory gets its own.
+        Anything it found in directories that changed since the last time
+        is forgotten first.
+        """
+        cwd = os.getcwd()
+        resolver = self._resolvers.get(cwd)
+        if resolver is None:
+            resolver = self._resolvers[cwd] = IncludeResolver(watch=True)
+        else:
+            resolver.refresh()
+        return resolver
+
+    def handle(self, request):
+        """
+        Runs a request and returns its response and output
+
+        :param request: dict with "command", "args" and maybe "cwd" and
+            "version" (see the module's docstring)
+        :returns: (response dict, output bytes)
+        """
+        if not isinstance(request, dict) or request.get('command') not in self.commands:
+            return {'status': 'refused', 'exit': 1, 'error': 'unknown command'}, b''
+        if request.get('version', __version__) != __version__:
+            error = 'server is running crossplane %s' % __version__
+            return {'status': 'refused', 'exit': 1, 'error': error}, b''
+
+        func = self.commands[request['command']]
+        args = request.get('args') or {}
+        output = _Output()
+        stdin, stdout = sys.stdin, sys.stdout
+        cwd = os.getcwd()
+        sys.stdin, sys.stdout = io.StringIO(), output  # there's nobody to answer prompts
+        try:
+            os.chdir(request.get('cwd') or cwd)
+            func(**args)
+            response = {'status': 'ok', 'exit': 0}
+        except SystemExit as e:
+            if self._stopping:
+                raise  # the server was told to stop, not the command
+            code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+            response = {'status': 'ok' if code == 0 else 'failed', 'exit': code}
+        except Exception:
+            response = {'status': 'failed', 'exit': 1, 'error': traceback.format_exc()}
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+            os.chdir(cwd)
+        return response, output.data
+
+    def _serve_connection(self, conn):
+        fp = conn.makefile('rb')
+        try:
+            for line in fp:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    response, output = {'status': 'refused', 'exit': 1, 'error': 'bad request'}, b''
+                else:
+                    response, output = self.handle(request)
+                _send(conn, response, output)
+        finally:
+            fp.close()
+
+    def bind(self):
+        """Starts listening on the socket, replacing a stale one"""
+        try:
+            st = os.lstat(self.path)
+        except OSError:
+            st = None
+        if st is not None:
+            if not stat.S_ISSOCK(st.st_mode):
+                raise EnvironmentError('%s already exists and is not a socket' % self.path)
+            try:
+                _connect(self.path).close()
+            except EnvironmentError:
+                os.remove(self.path)  # nothing is listening on it anymore
+            else:
+                raise EnvironmentError('a crossplane server is already listening on ' + self.path)
+
+        sock = _unix_socket()
+        umask = os.umask(0o177)  # only this user can connect
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        self._sock = sock
+
+    def serve_forever(self):
+        """Answers connections one at a time until shutdown() is called"""
+        if self._sock is None:
+            self.bind()
+        try:
+            while True:
+                conn, addr = self._sock.accept()
+                if self._stopping:
+                    conn.close()
+                    break
+                try:
+                    self._serve_connection(conn)
+                except EnvironmentError:
+                    pass  # the client went away
+                finally:
+                    conn.close()
+        finally:
+            self.close()
+
+    def terminate(self):
+        """Stops the server from a signal handler, even during a request"""
+        self._stopping = True
+        sys.exit(0)
+
+    def shutdown(self):
+        """Makes serve_forever() return, from another thread"""
+        self._stopping = True
+        _connect(self.path).close()  # wakes up accept()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def _unix_socket():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise EnvironmentError('unix domain sockets are not supported here')
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+def _connect(path, timeout=None):
+    sock = _unix_socket()
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def call(command, args=None, path=None, cwd=None, timeout=None):
+    """
+    Runs a command in a crossplane server and returns its response
+
+    :param command: string; the name of the command
+    :param args: dict of the command's keyword args
+    :param path: string; the server's socket (see default_socket_path)
+    :param cwd: string; the directory that relative paths are relative to
+        (the current working directory by default)
+    :param timeout: float; seconds to wait to connect and send the request
+        (DEFAULT_TIMEOUT if not given)
+    :returns: the response dict, with what the command wrote to stdout as
+        bytes in its "output"
+    :raises EnvironmentError: if no server made by this user is listening
+        on the socket, or the request couldn't be sent in time (so the
+        command wasn't run)
+    :raises ServerError: if the request was sent but the server didn't send
+        back a response (so the command may have been run)
+    """
+    path = default_socket_path() if path is None else path
+    _check_socket(path)
+    sock = _connect(path, DEFAULT_TIMEOUT if timeout is None else timeout)
+    fp = sock.makefile('rb')
+    try:
+        message = {
+            'command': command,
+            'args': args or {},
+            'cwd': os.getcwd() if cwd is None else cwd,
+            'version': __version__,
+        }
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+        # the server may be running the command now, so it's too late to
+        # give up on it (the command would run twice)
+        sock.settimeout(None)
+        try:
+            line = fp.readline()
+        except EnvironmentError as e:
+            raise ServerError('crossplane server failed to answer: %s' % e)
+        if not line:
+            raise ServerError('crossplane server closed the connection')
+        try:
+            response = json.loads(line.decode('utf-8'))
+            size = response['size']
+            if not (isinstance(response.get('status'), basestring) and
+                    isinstance(response.get('exit'), int) and isinstance(size, int)):
+                raise ValueError
+        except (ValueError, TypeError, KeyError):
+            raise ServerError('bad response from crossplane server: %r' % line[:100])
+        try:
+            response['output'] = fp.read(size)
+        except EnvironmentError as e:
+            raise ServerError('crossplane server failed to answer: %s' % e)
+        if len(response['output']) != size:
+            raise ServerError('crossplane server closed the connection')
+        return response
+    finally:
+        fp.close()
+        sock.close()
@@ -4,10 +4,12 @@ from __future__ import print_function
 
 import io
 import os
+import platform
 import shutil
 import sys
 
-from setuptools import find_packages, setup, Command
+from setuptools import find_packages, setup, Command, Extension
+from setuptools.command.build_py import build_py
 
 from crossplane import (
     __title__, __summary__, __url__, __version__, __author__, __email__,
@@ -56,6 +58,33 @@ class UploadCommand(Command):
         sys.exit()
 
 
+# modules with syntax that only python 3 has, which python 2 installs leave
+# out instead of failing to byte-compile them
+PY3_ONLY_MODULES = [('crossplane', 'aio')]
+
+
+class BuildPyCommand(build_py):
+    """Leaves python 3 only modules out of python 2 builds."""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info >= (3,):
+            return modules
+        return [m for m in modules if m[:2] not in PY3_ONLY_MODULES]
+
+
+def get_ext_modules():
+    # the lexer works without its compiled parts, so they're only built
+    # where they can be and the install carries on if building them fails
+    if sys.version_info < (3,) or platform.python_implementation() != 'CPython':
+        return []
+    if os.environ.get('CROSSPLANE_NO_EXTENSIONS'):
+        return []
+    return [
+        Extension('crossplane._speedups', ['crossplane/_speedups.c'], optional=True)
+    ]
+
+
 setup(
     name=__title__,
     version=__version__,
@@ -65,7 +94,8 @@ setup(
     author=__author__,
     author_email=__email__,
     url=__url__,
-    packages=find_packages(exclude=['tests','tests.*']),
+    packages=find_packages(exclude=['tests','tests.*','benchmarks','benchmarks.*']),
+    ext_modules=get_ext_modules(),
     license=__license__,
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -89,5 +119,5 @@ setup(
             'crossplane = crossplane.__main__:main'
         ],
     },
-    cmdclass={'upload': UploadCommand}
+    cmdclass={'upload': UploadCommand, 'build_py': BuildPyCommand}
 )
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import pytest
+
+import crossplane
+from . import here
+
+# asyncio is only in python 3
+asyncio = pytest.importorskip('asyncio')
+futures = pytest.importorskip('concurrent.futures')
+aio = pytest.importorskip('crossplane.aio')
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+class SlowExecutor(futures.ThreadPoolExecutor):
+    """Takes a while to parse each file so that parses can be stopped"""
+
+    def __init__(self):
+        super(SlowExecutor, self).__init__(1)
+        self.submitted = 0
+        self.release = threading.Event()
+
+    def submit(self, func, *args, **kwargs):
+        self.submitted += 1
+        def _slow():
+            self.release.wait(5)
+            return func(*args, **kwargs)
+        return super(SlowExecutor, self).submit(_slow)
+
+
+def test_aio_parse_matches_parse(loop):
+    for dirname in ('includes-globbed', 'includes-multiple-contexts', 'with-comments', 'missing-semicolon'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for kwargs in ({}, {'comments': True}, {'combine': True}, {'catch_errors': False}):
+            payload = loop.run_until_complete(aio.parse(config, **kwargs))
+            assert payload == crossplane.parse(config, **kwargs)
+
+
+@pytest.mark.skipif(not hasattr(asyncio, 'run'), reason='asyncio.run is new in python 3.7')
+def test_aio_parse_with_asyncio_run():
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    assert asyncio.run(aio.parse(config)) == crossplane.parse(config)
+
+
+def test_aio_parse_timeout(loop):
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    executor = SlowExecutor()
+    with pytest.raises(asyncio.TimeoutError):
+        loop.run_until_complete(aio.parse(config, timeout=0.05, executor=executor))
+
+    # the file that was being parsed finishes but no others are started
+    executor.release.set()
+    executor.shutdown(wait=True)
+    assert executor.submitted == 1
+
+
+def test_aio_parse_cancel(loop):
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    executor = SlowExecutor()
+    task = loop.create_task(aio.parse(config, executor=executor))
+    loop.call_later(0.05, task.cancel)
+    with pytest.raises(asyncio.CancelledError):
+        loop.run_until_complete(task)
+
+    executor.release.set()
+    executor.shutdown(wait=True)
+    assert executor.submitted == 1
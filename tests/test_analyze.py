@@ -57,3 +57,41 @@ def test_flag_directive_args():
             raise Exception('bad args for flag directive: ' + repr(args))
         except crossplane.errors.NgxParserDirectiveArgumentsError as e:
             assert e.strerror.endswith('it must be "on" or "off"')
+
+
+def test_register_external_directives():
+    from crossplane.analyzer import (
+        DIRECTIVES, RULES, NGX_HTTP_MAIN_CONF, NGX_CONF_TAKE1, NGX_CONF_TAKE2
+    )
+    fname = '/path/to/nginx.conf'
+    stmt = {
+        'directive': 'my_external_directive',
+        'args': ['one'],
+        'line': 5  # this is arbitrary
+    }
+
+    try:
+        # unknown directives aren't analyzed
+        crossplane.analyzer.analyze(fname, stmt, term=';', ctx=('http',))
+
+        masks = [NGX_HTTP_MAIN_CONF | NGX_CONF_TAKE1]
+        crossplane.analyzer.register_external_directives({stmt['directive']: masks})
+        crossplane.analyzer.analyze(fname, stmt, term=';', ctx=('http',))
+        try:
+            crossplane.analyzer.analyze(fname, stmt, term=';', ctx=('events',))
+            raise Exception('bad context for external directive passed')
+        except crossplane.errors.NgxParserDirectiveContextError as e:
+            assert e.strerror == '"my_external_directive" directive is not allowed here'
+
+        # registering a directive again replaces its old bit masks
+        masks = [NGX_HTTP_MAIN_CONF | NGX_CONF_TAKE2]
+        crossplane.analyzer.register_external_directives({stmt['directive']: masks})
+        try:
+            crossplane.analyzer.analyze(fname, stmt, term=';', ctx=('http',))
+            raise Exception('bad args for external directive passed')
+        except crossplane.errors.NgxParserDirectiveArgumentsError as e:
+            assert e.strerror == 'invalid number of arguments in "my_external_directive" directive'
+    finally:
+        del DIRECTIVES[stmt['directive']]
+        for key in [key for key in RULES if key[0] == stmt['directive']]:
+            del RULES[key]
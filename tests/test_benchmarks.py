@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import crossplane
+from benchmarks.__main__ import compare
+from benchmarks.generate import generate
+
+
+def test_generated_config_is_valid(tmpdir):
+    main = generate(tmpdir.strpath, sites=2, servers=3, maps=1, map_size=10, upstreams=5)
+    payload = crossplane.parse(main)
+    assert payload['errors'] == []
+    assert len(payload['config']) == 6
+
+    # the same arguments write the same tree
+    again = generate(tmpdir.join('again').strpath, sites=2, servers=3, maps=1, map_size=10, upstreams=5)
+    built = [crossplane.build(config['parsed']) for config in payload['config']]
+    assert built == [crossplane.build(config['parsed']) for config in crossplane.parse(again)['config']]
+
+
+def test_compare_finds_regressions():
+    old = {'benchmarks': {
+        'lex': {'seconds': 1.0, 'peak_memory': 100},
+        'parse': {'seconds': 2.0, 'peak_memory': None},
+    }}
+    new = {'benchmarks': {
+        'lex': {'seconds': 1.05, 'peak_memory': 150},
+        'parse': {'seconds': 2.5, 'peak_memory': None},
+        'build': {'seconds': 9.0, 'peak_memory': 1},
+    }}
+    assert compare(old, new, 0.1) == [
+        'lex peak memory went up 50.0%',
+        'parse time went up 25.0%',
+    ]
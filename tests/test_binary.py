@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+import crossplane
+from crossplane import binary
+from crossplane.compat import json
+from . import here
+
+
+def test_binary_round_trip():
+    for dirname in ('includes-globbed', 'with-comments', 'messy', 'russian-text', 'lua-block-tricky'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for kwargs in ({}, {'comments': True}, {'combine': True}, {'single': True}, {'profile': True}):
+            payload = crossplane.parse(config, **kwargs)
+            data = binary.dumps(payload)
+            assert data.startswith(binary.MAGIC)
+            assert len(data) < len(json.dumps(payload, separators=(',', ':')))
+            assert binary.loads(data) == payload
+
+            fp = io.BytesIO()
+            binary.dump(payload, fp)
+            fp.seek(0)
+            assert binary.load(fp) == payload
+
+
+def test_binary_values():
+    payload = {
+        u'status': u'ok',
+        u'config': [{
+            u'file': u'nginx.conf',
+            u'parsed': [
+                {u'directive': u'http', u'line': 1, u'args': [], u'block': [
+                    {u'directive': u'#', u'line': 2, u'args': [], u'comment': u' добрый день'},
+                    {u'directive': u'include', u'line': 300, u'args': [u'a.conf'], u'includes': [1, u'b.conf']},
+                ]},
+                {u'file': u'b.conf', u'directive': u'user', u'line': 70000, u'args': [u'nobody', u'']},
+            ],
+        }],
+        u'other': [None, True, False, 0, -1, 2 ** 40, -2 ** 40, 1.5, u'\ud800', {u'parsed': u'x'}, []],
+    }
+    assert binary.loads(binary.dumps(payload)) == payload
+
+    with pytest.raises(TypeError):
+        binary.dumps({u'config': [{u'parsed': [{u'directive': u'a', u'line': 1, u'args': [], u'x': 1}]}]})
+    with pytest.raises(TypeError):
+        binary.dumps({u'config': [{u'parsed': [1]}]})
+    with pytest.raises(TypeError):
+        binary.dumps({1: u'a'})
+
+
+def test_binary_corrupt():
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    data = binary.dumps(crossplane.parse(config))
+    for corrupt in (b'{}', data[:len(binary.MAGIC)], data[:-1], data + b'\x00'):
+        with pytest.raises(ValueError):
+            binary.loads(corrupt)
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 
 import crossplane
-from . import compare_parsed_and_built
+from . import compare_parsed_and_built, here
 
 
 def test_build_nested_and_multiple_args():
@@ -277,6 +278,179 @@ def test_build_files_with_unicode(tmpdir):
     assert built_files[0].read_text('utf-8') == u'user 測試;\n'
 
 
+def test_build_to_matches_build():
+    for dirname in ('messy', 'with-comments', 'lua-block-larger'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        parsed = crossplane.parse(config, comments=True)['config'][0]['parsed']
+        for kwargs in ({}, {'tabs': True}, {'indent': 2, 'header': True}):
+            built = crossplane.build(parsed, **kwargs)
+            fp = io.StringIO()
+            crossplane.builder.build_to(fp, parsed, **kwargs)
+            assert fp.getvalue() == built
+            fp = io.StringIO()
+            crossplane.builder.build_to(fp, parsed, rstrip=True, **kwargs)
+            assert fp.getvalue() == built.rstrip() + '\n'
+
+
+def test_build_deeply_nested_blocks():
+    payload = []
+    block = payload
+    for i in range(5000):
+        stmt = {'directive': 'location', 'line': i + 1, 'args': ['/'], 'block': []}
+        block.append(stmt)
+        block = stmt['block']
+    block.append({'directive': 'return', 'line': 5001, 'args': ['200']})
+
+    built = crossplane.build(payload, indent=0)
+    assert built == 'location / {\n' * 5000 + 'return 200;' + '\n}' * 5000
+
+
+def test_build_files_with_workers(tmpdir):
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    payload = crossplane.parse(config, comments=True)
+    for entry in payload['config']:
+        entry['file'] = os.path.relpath(entry['file'], os.path.dirname(config))
+
+    serial, threaded = tmpdir.join('serial'), tmpdir.join('threaded')
+    crossplane.builder.build_files(payload, dirname=serial.strpath)
+    crossplane.builder.build_files(payload, dirname=threaded.strpath, workers=4)
+    names = sorted(p.relto(serial) for p in serial.visit() if p.isfile())
+    assert len(names) == len(payload['config'])
+    assert names == sorted(p.relto(threaded) for p in threaded.visit() if p.isfile())
+    for name in names:
+        assert serial.join(name).read_binary() == threaded.join(name).read_binary()
+
+    # unchanged files are left alone and changed files keep their permissions
+    unchanged, changed = threaded.join('http.conf'), threaded.join('servers', 'server1.conf')
+    unchanged.setmtime(1000000000)
+    changed.write('# old\n')
+    changed.chmod(0o640)
+    crossplane.builder.build_files(payload, dirname=threaded.strpath, workers=4)
+    assert unchanged.mtime() == 1000000000
+    assert changed.read_binary() == serial.join('servers', 'server1.conf').read_binary()
+    assert changed.stat().mode & 0o777 == 0o640
+    assert len(threaded.listdir()) == len(serial.listdir())  # no temporary files left
+
+
+def test_build_files_included_from_many_contexts(tmpdir):
+    dirname = os.path.join(here, 'configs', 'includes-multiple-contexts')
+    payload = crossplane.parse(os.path.join(dirname, 'nginx.conf'))
+    for entry in payload['config']:
+        entry['file'] = os.path.relpath(entry['file'], dirname)
+
+    # proxy.conf is built once, from the context it parsed without errors in
+    for kwargs in [{}, {'workers': 2}]:
+        built = tmpdir.mkdir('workers' if kwargs else 'serial')
+        results = crossplane.builder.build_files(payload, dirname=built.strpath, **kwargs)
+        assert results['created'] == [built.join('nginx.conf').strpath, built.join('proxy.conf').strpath]
+        with io.open(os.path.join(dirname, 'proxy.conf'), encoding='utf-8') as fp:
+            assert built.join('proxy.conf').read_text('utf-8') == fp.read()
+
+    # configs that parsed without errors can't be built differently
+    payload['config'][2]['parsed'] = payload['config'][3]['parsed']
+    try:
+        crossplane.builder.build_files(payload, dirname=tmpdir.mkdir('conflict').strpath)
+    except ValueError as e:
+        assert 'proxy.conf was parsed differently' in str(e)
+    else:
+        raise AssertionError('build_files() should have raised ValueError')
+
+
+def test_build_files_skip_unchanged(tmpdir):
+    payload = {
+        'config': [
+            {'file': 'nginx.conf', 'parsed': [{'directive': 'user', 'line': 1, 'args': ['nginx']}]},
+            {'file': 'conf.d/a.conf', 'parsed': [{'directive': 'listen', 'line': 1, 'args': ['80']}]},
+            {'file': 'conf.d/b.conf', 'parsed': [{'directive': 'listen', 'line': 1, 'args': ['81']}]},
+        ]
+    }
+    build_files = crossplane.builder.build_files
+    paths = [tmpdir.join(*config['file'].split('/')).strpath for config in payload['config']]
+
+    results = build_files(payload, dirname=tmpdir.strpath, dry_run=True, skip_unchanged=True)
+    assert results == {'created': paths, 'written': [], 'unchanged': []}
+    assert tmpdir.listdir() == []
+
+    results = build_files(payload, dirname=tmpdir.strpath, skip_unchanged=True)
+    assert results == {'created': paths, 'written': [], 'unchanged': []}
+
+    # same size but different contents, then a different size
+    tmpdir.join('conf.d', 'a.conf').write('listen 88;\n')
+    tmpdir.join('conf.d', 'b.conf').write('listen 8181;\n')
+    results = build_files(payload, dirname=tmpdir.strpath, skip_unchanged=True)
+    assert results == {'created': [], 'written': paths[1:], 'unchanged': paths[:1]}
+    assert tmpdir.join('conf.d', 'a.conf').read() == 'listen 80;\n'
+    assert tmpdir.join('conf.d', 'b.conf').read() == 'listen 81;\n'
+
+    results = build_files(payload, dirname=tmpdir.strpath)
+    assert results == {'created': [], 'written': paths, 'unchanged': []}
+
+
+def test_build_files_confirm(tmpdir):
+    payload = {
+        'config': [
+            {'file': 'a.conf', 'parsed': [{'directive': 'listen', 'line': 1, 'args': ['80']}]},
+            {'file': 'b.conf', 'parsed': [{'directive': 'listen', 'line': 1, 'args': ['81']}]},
+        ]
+    }
+    build_files = crossplane.builder.build_files
+    paths = [tmpdir.join(config['file']).strpath for config in payload['config']]
+    asked = []
+
+    def _confirm(existing):
+        asked.append(existing)
+        return False
+
+    # nothing exists yet so there's nothing to ask about
+    for kwargs in ({}, {'skip_unchanged': True}, {'workers': 2}):
+        tmpdir.remove()
+        tmpdir.mkdir()
+        assert build_files(payload, dirname=tmpdir.strpath, confirm=_confirm, **kwargs)['created'] == paths
+    assert asked == []
+
+    # only files that would change are asked about, and nothing is written
+    tmpdir.join('b.conf').write('listen 8181;\n')
+    assert build_files(payload, dirname=tmpdir.strpath, confirm=_confirm) is None
+    assert build_files(payload, dirname=tmpdir.strpath, confirm=_confirm, workers=2) is None
+    assert asked == [paths, paths[1:]]
+    assert tmpdir.join('b.conf').read() == 'listen 8181;\n'
+
+
+def test_build_files_uses_current_umask(tmpdir, monkeypatch):
+    payload = {'config': [{'file': 'a.conf', 'parsed': [{'directive': 'listen', 'line': 1, 'args': ['80']}]}]}
+
+    def _umask(mask):
+        raise AssertionError('the umask is process-wide')
+
+    umask = os.umask(0o077)
+    try:
+        monkeypatch.setattr(os, 'umask', _umask)
+        for name, kwargs in [('serial', {}), ('workers', {'workers': 2}), ('skip', {'skip_unchanged': True})]:
+            built = tmpdir.mkdir(name)
+            crossplane.builder.build_files(payload, dirname=built.strpath, **kwargs)
+            assert built.join('a.conf').stat().mode & 0o777 == 0o600
+    finally:
+        monkeypatch.undo()
+        os.umask(umask)
+
+
+def test_enquote_fast_path_and_cache():
+    from crossplane.builder import _enquote, _enquote_uncached, ENQUOTED
+    args = [
+        'on', '80', '/var/www', 'X-Real-IP', '$host', '$$x', 'a$b', '#x', u'測試',
+        '', '$', 'a$', '${x}', 'a{b', 'a}b', 'a;b', 'a b', 'a\tb', '"a"', "'a'",
+        'a\\', '\\n', '${', u'a\u00a0b', '\x1c'
+    ]
+    for arg in args:
+        assert _enquote(arg) == _enquote_uncached(arg)
+        assert _enquote(arg) == _enquote_uncached(arg)  # cached this time
+
+    # the cache is cleared instead of growing past its max size
+    for i in range(crossplane.builder.ENQUOTED_MAX_SIZE + 10):
+        assert _enquote('a b%d' % i) == "'a b%d'" % i
+    assert len(ENQUOTED) <= crossplane.builder.ENQUOTED_MAX_SIZE
+
+
 def test_compare_parsed_and_built_simple(tmpdir):
     compare_parsed_and_built('simple', 'nginx.conf', tmpdir)
 
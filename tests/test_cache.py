@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from crossplane.cache import MemoryCache, ParseCache
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = ParseCache(tmpdir.strpath, max_size=1300)
+    keys = [cache.key('file%d.conf' % i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, 'x' * 400)
+        path = os.path.join(tmpdir.strpath, key + '.cache')
+        os.utime(path, (i, i))
+
+    assert cache.get(keys[0]) == 'x' * 400  # now most recently used
+    cache.set(cache.key('file3.conf'), 'x' * 400)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == 'x' * 400
+    assert cache.get(keys[0]) == 'x' * 400
+    assert cache.stats() == {'hits': 3, 'misses': 1}
+
+
+def test_cache_ignores_corrupt_entries(tmpdir):
+    cache = ParseCache(tmpdir.strpath)
+    key = cache.key('nginx.conf')
+    tmpdir.join(key + '.cache').write('not a pickle')
+    assert cache.get(key) is None
+    cache.set(key, {'status': 'ok'})
+    assert cache.get(key) == {'status': 'ok'}
+
+
+def test_cache_dir_is_private(tmpdir):
+    dirname = tmpdir.join('cache')
+    ParseCache(dirname.strpath)
+    assert dirname.stat().mode & 0o777 == 0o700
+
+    # entries are unpickled, so nobody else can be able to write them
+    dirname.chmod(0o777)
+    with pytest.raises(EnvironmentError):
+        ParseCache(dirname.strpath)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_size=1300)
+    keys = [cache.key('file%d.conf' % i) for i in range(3)]
+    for key in keys:
+        cache.set(key, 'x' * 400)
+
+    value = cache.get(keys[0])
+    assert value == 'x' * 400  # now most recently used
+    cache.set(cache.key('file3.conf'), 'x' * 400)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == 'x' * 400
+    assert cache.get(keys[0]) is not value  # every get returns a copy
+    assert cache.get(keys[0], validate=lambda value: False) is None
+    assert cache.get(keys[0]) is None
+    assert cache.stats() == {'hits': 3, 'misses': 3}
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import os
+
+import crossplane
+from crossplane.graph import IncludeGraph
+from . import here
+
+
+def test_parse_include_graph():
+    dirname = os.path.join(here, 'configs', 'includes-globbed')
+    config = os.path.join(dirname, 'nginx.conf')
+    payload = crossplane.parse(config, graph=True)
+    graph = payload.pop('graph')
+    assert payload == crossplane.parse(config)
+
+    path = lambda *parts: os.path.join(dirname, *parts)
+    assert graph.files == [c['file'] for c in payload['config']]
+    assert graph.includes(config) == [
+        {'file': config, 'line': 2, 'include': path('http.conf'), 'context': ()}
+    ]
+    assert graph.included_by(path('locations', 'location1.conf')) == [
+        {'file': path('servers', 'server1.conf'), 'line': 3, 'include': path('locations', 'location1.conf'), 'context': ('http', 'server')},
+        {'file': path('servers', 'server2.conf'), 'line': 3, 'include': path('locations', 'location1.conf'), 'context': ('http', 'server')},
+    ]
+    assert graph.contexts(path('servers', 'server1.conf')) == [('http',)]
+    assert graph.dependents(path('locations', 'location2.conf')) == [
+        config, path('http.conf'), path('servers', 'server1.conf'), path('servers', 'server2.conf')
+    ]
+    assert graph.affected_roots(path('locations', 'location2.conf')) == [config]
+    assert graph.topological_order() == graph.files
+    assert len(graph.to_dict()['edges']) == 7
+
+
+def test_include_graph_order_and_cycles():
+    graph = IncludeGraph('main.conf')
+    graph.add_edge('main.conf', 1, 'b.conf', ())
+    graph.add_edge('main.conf', 2, 'a.conf', ())
+    graph.add_edge('a.conf', 1, 'b.conf', ('http',))
+    assert graph.topological_order() == ['main.conf', 'a.conf', 'b.conf']
+    assert graph.contexts('b.conf') == [(), ('http',)]
+
+    # files in a cycle come last instead of being left out
+    graph.add_edge('b.conf', 1, 'c.conf', ())
+    graph.add_edge('c.conf', 1, 'b.conf', ())
+    assert graph.topological_order() == ['main.conf', 'a.conf', 'b.conf', 'c.conf']
+    assert graph.affected_roots('c.conf') == ['main.conf']
+    assert graph.dependents('b.conf') == ['main.conf', 'a.conf', 'c.conf']
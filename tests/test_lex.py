@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import io
 import os
+import pickle
+
+import pytest
 
 import crossplane
+from crossplane import lexer
+from crossplane.errors import NgxParserSyntaxError
+from crossplane.lexer import _lex_file_object, _lex_file_object_by_char
 from . import here
 
 
@@ -92,3 +99,110 @@ def test_quoted_right_brace():
         '"referer": "$http_referer", ', '"agent": "$http_user_agent"', '}',
         ';', '}'
     ]
+
+
+def test_chunk_lexer_matches_legacy_lexer():
+    configs = os.path.join(here, 'configs')
+    for dirpath, dirnames, filenames in os.walk(configs):
+        for filename in filenames:
+            config = os.path.join(dirpath, filename)
+            legacy = list(crossplane.lex(config, legacy=True))
+            assert list(crossplane.lex(config)) == legacy
+
+            # make sure tokens split between blocks are handled properly
+            for chunk_size in (1, 2, 3, 7):
+                with io.open(config, encoding='utf-8', errors='replace') as f:
+                    tokens = list(_lex_file_object(f, chunk_size=chunk_size))
+                assert tokens == legacy
+
+
+def test_chunk_lexer_quirks():
+    for text in (
+        u'set $a ${var} ;\n',
+        u'a ${b c}d;',
+        u'unterminated "quote',
+        u'a b\\\nc;#x\\\ny;',
+        u'\\\nescaped-newline;',
+        u'trailing backslash\\',
+    ):
+        legacy = list(_lex_file_object_by_char(io.StringIO(text)))
+        assert list(_lex_file_object(io.StringIO(text))) == legacy
+
+
+def test_mmap_lexer_matches_chunk_lexer():
+    configs = os.path.join(here, 'configs')
+    for dirpath, dirnames, filenames in os.walk(configs):
+        for filename in filenames:
+            config = os.path.join(dirpath, filename)
+            tokens = list(crossplane.lex(config, use_mmap=True))
+            assert tokens == list(crossplane.lex(config))
+
+
+def test_mmap_lexer_with_windows_newlines(tmpdir):
+    config = tmpdir.join('nginx.conf')
+    config.write_binary(b'events {\r\n    worker_connections 1024; # hi\r\n}\r\n')
+    tokens = list(crossplane.lex(config.strpath, use_mmap=True))
+    assert tokens == list(crossplane.lex(config.strpath)) == [
+        ('events', 1, False), ('{', 1, False), ('worker_connections', 2, False),
+        ('1024', 2, False), (';', 2, False), ('# hi', 2, False), ('}', 3, False)
+    ]
+
+
+def test_speedups_match_pure_python_lexer(monkeypatch):
+    if lexer._speedups is None:
+        pytest.skip('crossplane._speedups was not built')
+
+    def _lex_all():
+        configs = os.path.join(here, 'configs')
+        for dirpath, dirnames, filenames in os.walk(configs):
+            for filename in sorted(filenames):
+                config = os.path.join(dirpath, filename)
+                yield list(crossplane.lex(config))
+                for chunk_size in (1, 2, 3, 7):
+                    with io.open(config, encoding='utf-8', errors='replace') as f:
+                        yield list(_lex_file_object(f, chunk_size=chunk_size))
+        for text in (
+            u'set $a ${var} ;\n',
+            u'a "b\\"c" \'d\\\'e\' "f\\\\";',
+            u'unterminated "quote\\',
+            u'a b\\\nc;#x\\\ny;\n#z',
+            u'\\\nescaped-newline;',
+            u'tabs\tand other\x85spaces;',
+            u'content_by_lua_block { ngx.say("}") }\n"content_by_lua_block" {}',
+            u'trailing backslash\\',
+        ):
+            yield list(_lex_file_object(io.StringIO(text)))
+
+    accelerated = list(_lex_all())
+    monkeypatch.setattr(lexer._ChunkLexer, 'accelerated', False)
+    assert accelerated == list(_lex_all())
+
+
+def test_lex_buffer_matches_lex():
+    configs = os.path.join(here, 'configs')
+    for dirpath, dirnames, filenames in os.walk(configs):
+        for filename in filenames:
+            config = os.path.join(dirpath, filename)
+            for use_mmap in (False, True):
+                tokens = lexer.lex_buffer(config, use_mmap=use_mmap)
+                assert list(tokens) == list(crossplane.lex(config))
+                assert tokens[0] == next(crossplane.lex(config))
+                assert pickle.loads(pickle.dumps(tokens)) == tokens
+
+
+def test_lex_buffer_errors(tmpdir):
+    config = tmpdir.join('nginx.conf')
+    config.write('events {\n}\n}\nhttp {\n')
+    tokens = lexer.lex_buffer(config.strpath)
+    assert len(tokens) == 3
+    assert str(tokens.error) == 'unexpected "}" in %s:3' % config.strpath
+
+    # the error is raised after the tokens before it, like lex() does
+    expected = []
+    with pytest.raises(NgxParserSyntaxError):
+        for token in crossplane.lex(config.strpath):
+            expected.append(token)
+    with pytest.raises(NgxParserSyntaxError):
+        for token in tokens:
+            expected.remove(token)
+    assert expected == []
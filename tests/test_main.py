@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+import crossplane
+from crossplane.__main__ import _dump_payload, _json_encoder
+from crossplane.compat import json, available_json_backends, get_json_backend
+from . import here
+
+
+def _dumps(obj, indent):
+    kwargs = {'indent': indent}
+    if indent is None:
+        kwargs['separators'] = ',', ':'
+    return json.dumps(obj, **kwargs) + u'\n'
+
+
+def test_dump_payload_matches_json_dumps():
+    for dirname in ('includes-globbed', 'with-comments', 'messy', 'russian-text'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for indent in (None, 0, 4):
+            for kwargs in ({}, {'comments': True}, {'combine': True}):
+                payload = crossplane.parse(config, **kwargs)
+                out = io.StringIO()
+                _dump_payload(payload, out, indent)
+                assert out.getvalue() == _dumps(payload, indent)
+
+            # config entries that were already turned into json are the same
+            serialize = _json_encoder(indent).encode
+            encoded = crossplane.parse(config, serialize=serialize)
+            out = io.StringIO()
+            _dump_payload(encoded, out, indent, encoded=('config',))
+            assert out.getvalue() == _dumps(crossplane.parse(config), indent)
+
+            tokens = [[token, line] for token, line, quoted in crossplane.lex(config)]
+            for payload in (tokens, [], {}):
+                out = io.StringIO()
+                _dump_payload(payload, out, indent)
+                assert out.getvalue() == _dumps(payload, indent)
+
+
+def test_json_backends_match_json_module():
+    for name in available_json_backends():
+        backend = get_json_backend(name)
+        for dirname in ('includes-globbed', 'with-comments', 'russian-text', 'quote-behavior'):
+            config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+            for indent in (None, 0, 2, 4):
+                payload = crossplane.parse(config, comments=True, profile=True)
+                out = io.StringIO()
+                _dump_payload(payload, out, indent, backend=backend)
+                assert out.getvalue() == _dumps(payload, indent)
+
+                serialize = lambda config: backend.dumps(config, indent)
+                encoded = crossplane.parse(config, serialize=serialize)
+                out = io.StringIO()
+                _dump_payload(encoded, out, indent, encoded=('config',), backend=backend)
+                assert out.getvalue() == _dumps(crossplane.parse(config), indent)
+
+            assert backend.loads(backend.dumps(payload)) == json.loads(json.dumps(payload))
+
+        # things some libraries can't dump are dumped by the json module
+        for obj in ([u'\x7f\u00e9\U0001f600\ud800', 2 ** 70], {1: u'\\u001F\x1f'}):
+            assert backend.dumps(obj) == _dumps(obj, None).rstrip()
+
+
+def test_get_json_backend(monkeypatch):
+    monkeypatch.setenv('CROSSPLANE_JSON_BACKEND', 'json')
+    assert get_json_backend().name == 'json'
+
+    # the environment variable is ignored if it doesn't name a library
+    monkeypatch.setenv('CROSSPLANE_JSON_BACKEND', 'nope')
+    assert get_json_backend().name == available_json_backends()[0]
+
+    with pytest.raises(ValueError):
+        get_json_backend('nope')
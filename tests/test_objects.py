@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+
+import crossplane
+from crossplane.objects import ConfigFile, Statement, to_dicts, to_objects
+from . import here
+
+
+def test_objects_convert_losslessly():
+    for dirname in os.listdir(os.path.join(here, 'configs')):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for kwargs in ({}, {'comments': True}, {'combine': True}):
+            expected = crossplane.parse(config, **kwargs)
+            payload = crossplane.parse(config, as_objects=True, **kwargs)
+            assert all(isinstance(c, ConfigFile) for c in payload['config'])
+            assert to_dicts(payload) == expected
+            assert to_objects(expected) == payload
+
+
+def test_objects_share_strings():
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    payload = crossplane.parse(config, as_objects=True)
+    servers = [
+        stmt
+        for config in payload['config']
+        for stmt in config.parsed
+        if stmt.directive == 'server'
+    ]
+    assert len(servers) == 2
+    assert servers[0].directive is servers[1].directive
+    assert servers[0].block[0].directive is servers[1].block[0].directive
+    assert isinstance(servers[0].block, tuple)
+    assert isinstance(servers[0].block[0].args, tuple)
+
+
+def test_build_objects():
+    config = os.path.join(here, 'configs', 'with-comments', 'nginx.conf')
+    payload = crossplane.parse(config, comments=True)
+    parsed = payload['config'][0]['parsed']
+    built = crossplane.build(parsed)
+    assert crossplane.build(to_objects(payload)['config'][0].parsed) == built
+
+
+def test_statement_reads_like_a_dict():
+    stmt = Statement('listen', line=2, args=('80',))
+    assert stmt['directive'] == 'listen'
+    assert stmt.get('block') is None
+    assert 'block' not in stmt
+    assert sorted(stmt.keys()) == ['args', 'directive', 'line']
+    assert stmt.to_dict() == {'directive': 'listen', 'line': 2, 'args': ['80']}
+    assert Statement.from_dict(stmt.to_dict()) == stmt
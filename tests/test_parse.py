@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
 
 import crossplane
 from . import here
@@ -405,6 +406,66 @@ def test_includes_single():
     }
 
 
+def test_includes_multiple_contexts(monkeypatch):
+    dirname = os.path.join(here, 'configs', 'includes-multiple-contexts')
+    config = os.path.join(dirname, 'nginx.conf')
+    proxy = os.path.join(dirname, 'proxy.conf')
+
+    lexed = []
+    lex_buffers = crossplane.lexer._lex_buffers
+    def _lex_buffers(filename, legacy=False, use_mmap=False):
+        lexed.append(filename)
+        return lex_buffers(filename, legacy=legacy, use_mmap=use_mmap)
+    monkeypatch.setattr(crossplane.lexer, '_lex_buffers', _lex_buffers)
+    monkeypatch.setattr(crossplane.parser, '_lex_buffers', _lex_buffers)
+
+    payload = crossplane.parse(config)
+
+    # the file is parsed once for each context but only lexed once
+    assert lexed == [config, proxy]
+    assert [c['file'] for c in payload['config']] == [config, proxy, proxy, proxy]
+
+    http = payload['config'][0]['parsed'][1]
+    server = http['block'][1]
+    location = server['block'][2]
+    assert http['block'][0]['includes'] == [1]
+    assert server['block'][1]['includes'] == [2]
+    assert location['block'][0]['includes'] == [3]
+
+    # merge_slashes is allowed in http and server blocks but not locations
+    assert [c['status'] for c in payload['config']] == ['ok', 'ok', 'ok', 'failed']
+    assert payload['errors'] == [
+        {
+            'file': proxy,
+            'error': '"merge_slashes" directive is not allowed here in %s:2' % proxy,
+            'line': 2
+        }
+    ]
+    assert payload['config'][1] == payload['config'][2]
+    assert payload['config'][3]['parsed'] == payload['config'][1]['parsed'][:1]
+
+    # the file is built from the first context, where nothing failed
+    paths, configs = crossplane.builder._configs_by_path(payload, dirname)
+    assert paths == [config, proxy]
+    assert configs == payload['config'][:2]
+
+    # iterparse and reparse give the same results
+    errors = [obj for event, obj in crossplane.iterparse(config) if event == 'error']
+    assert errors == payload['errors']
+    assert crossplane.reparse(payload, [proxy]) == payload
+
+
+def test_includes_itself(tmpdir):
+    config = str(tmpdir.join('nginx.conf'))
+    tmpdir.join('nginx.conf').write('http {\n    include other.conf;\n}\n')
+    tmpdir.join('other.conf').write('server {\n    include nginx.conf;\n}\n')
+
+    # the include cycle stops instead of going on with deeper contexts
+    payload = crossplane.parse(config)
+    assert [c['file'] for c in payload['config']] == [config, str(tmpdir.join('other.conf'))]
+    assert payload['config'][1]['parsed'][0]['block'][0]['includes'] == [0]
+
+
 def test_ignore_directives():
     dirname = os.path.join(here, 'configs', 'simple')
     config = os.path.join(dirname, 'nginx.conf')
@@ -1032,3 +1093,180 @@ def test_non_unicode():
             }
         ]
     }
+
+
+def test_parse_with_mmap():
+    for dirname in ('includes-globbed', 'lua-block-larger', 'non-unicode', 'russian-text'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        payload = crossplane.parse(config, comments=True, use_mmap=True)
+        assert payload == crossplane.parse(config, comments=True)
+
+
+def test_parse_across_token_buffers(monkeypatch):
+    dirnames = ('includes-globbed', 'lua-block-larger', 'messy', 'with-comments')
+    configs = [os.path.join(here, 'configs', dirname, 'nginx.conf') for dirname in dirnames]
+    kwargs_list = ({'comments': True}, {'ignore': ['server']}, {'catch_errors': False})
+    expected = [crossplane.parse(config, **kwargs) for config in configs for kwargs in kwargs_list]
+
+    # statements and blocks are split between many small buffers
+    monkeypatch.setattr(crossplane.lexer, 'BATCH_SIZE', 1)
+    payloads = [crossplane.parse(config, **kwargs) for config in configs for kwargs in kwargs_list]
+    assert payloads == expected
+
+
+def test_parse_with_serialize():
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    expected = crossplane.parse(config)
+    payload = crossplane.parse(config, serialize=repr)
+    assert payload['config'] == [repr(parsing) for parsing in expected['config']]
+    assert payload['errors'] == expected['errors']
+
+    # combining needs the dicts so they aren't serialized
+    payload = crossplane.parse(config, serialize=repr, combine=True)
+    assert payload == crossplane.parse(config, combine=True)
+
+
+def test_parse_with_workers():
+    for dirname in ('includes-regular', 'includes-globbed', 'simple'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for kwargs in ({}, {'combine': True}, {'catch_errors': False}):
+            payload = crossplane.parse(config, workers=2, **kwargs)
+            assert payload == crossplane.parse(config, **kwargs)
+
+
+def test_parse_with_cache(tmpdir):
+    dirname = tmpdir.join('includes-globbed')
+    shutil.copytree(os.path.join(here, 'configs', 'includes-globbed'), dirname.strpath)
+    config = dirname.join('nginx.conf').strpath
+    cache_dir = tmpdir.join('cache').strpath
+    expected = crossplane.parse(config)
+
+    payload = crossplane.parse(config, cache_dir=cache_dir)
+    assert payload.pop('cache') == {'hits': 0, 'misses': 6}
+    assert payload == expected
+
+    payload = crossplane.parse(config, cache_dir=cache_dir)
+    assert payload.pop('cache') == {'hits': 6, 'misses': 0}
+    assert payload == expected
+
+    # different options shouldn't reuse results
+    payload = crossplane.parse(config, cache_dir=cache_dir, comments=True)
+    assert payload.pop('cache') == {'hits': 0, 'misses': 6}
+
+    # only the changed file should be parsed again
+    dirname.join('servers', 'server2.conf').write('server { listen 9090; }\n', mode='a')
+    payload = crossplane.parse(config, cache_dir=cache_dir)
+    assert payload.pop('cache') == {'hits': 5, 'misses': 1}
+    assert payload == crossplane.parse(config)
+
+    # files matching a glob changed so the including file is parsed again
+    dirname.join('servers', 'server3.conf').write('server { listen 9191; }\n')
+    payload = crossplane.parse(config, cache_dir=cache_dir)
+    assert payload.pop('cache') == {'hits': 5, 'misses': 2}
+    assert payload == crossplane.parse(config)
+
+
+def test_parse_cache_depends_on_extensions(tmpdir, monkeypatch):
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    cache_dir = tmpdir.join('cache').strpath
+    assert crossplane.parse(config, cache_dir=cache_dir)['cache'] == {'hits': 0, 'misses': 6}
+    assert crossplane.parse(config, cache_dir=cache_dir)['cache'] == {'hits': 6, 'misses': 0}
+
+    # results from a process with other plugins or directives aren't reused
+    monkeypatch.setitem(crossplane.lexer.EXTERNAL_LEXERS, 'my_block', lambda it, token: it)
+    assert crossplane.parse(config, cache_dir=cache_dir)['cache'] == {'hits': 0, 'misses': 6}
+    monkeypatch.setitem(crossplane.analyzer.DIRECTIVES, 'my_directive', [crossplane.analyzer.NGX_HTTP_MAIN_CONF])
+    assert crossplane.parse(config, cache_dir=cache_dir)['cache'] == {'hits': 0, 'misses': 6}
+
+    monkeypatch.undo()
+    assert crossplane.parse(config, cache_dir=cache_dir)['cache'] == {'hits': 6, 'misses': 0}
+
+
+def test_reparse_changed_files(tmpdir):
+    dirname = tmpdir.join('includes-globbed')
+    shutil.copytree(os.path.join(here, 'configs', 'includes-globbed'), dirname.strpath)
+    config = dirname.join('nginx.conf').strpath
+    payload = crossplane.parse(config)
+    location1 = payload['config'][4]
+
+    # nothing changed
+    new_payload = crossplane.reparse(payload, [])
+    assert new_payload == payload
+    assert new_payload['config'][4] is location1
+
+    # a file changed and now includes a file that wasn't included before
+    server1 = dirname.join('servers', 'server1.conf')
+    server1.write('server {\n    listen 8080;\n    include locations/*.conf;\n    include ../http.conf;\n}\n')
+    dirname.join('nginx.conf').write('events {}\ninclude http.conf;\ninclude missing.conf;\n')
+    new_payload = crossplane.reparse(payload, [server1.strpath, config])
+    assert new_payload == crossplane.parse(config)
+    assert new_payload['config'][4] is location1
+
+    # a file was added to a directory that was included with a glob
+    dirname.join('servers', 'server0.conf').write('server { listen 8888; }\n')
+    newer_payload = crossplane.reparse(new_payload, [])
+    assert newer_payload == crossplane.parse(config)
+
+
+def test_iterparse_events():
+    dirname = os.path.join(here, 'configs', 'includes-regular')
+    config = os.path.join(dirname, 'nginx.conf')
+    server = os.path.join(dirname, 'conf.d', 'server.conf')
+    events = [
+        (event, obj.get('directive'), obj['file'], obj['line'])
+        for event, obj in crossplane.iterparse(config)
+    ]
+    assert events == [
+        ('start_block', 'events', config, 1),
+        ('end_block', 'events', config, 1),
+        ('start_block', 'http', config, 2),
+        ('include', 'include', config, 3),
+        ('end_block', 'http', config, 2),
+        ('start_block', 'server', server, 1),
+        ('directive', 'listen', server, 2),
+        ('directive', 'server_name', server, 3),
+        ('include', 'include', server, 4),
+        ('error', None, server, 5),
+        ('include', 'include', server, 5),
+        ('end_block', 'server', server, 1),
+        ('start_block', 'location', os.path.join(dirname, 'foo.conf'), 1),
+        ('directive', 'return', os.path.join(dirname, 'foo.conf'), 2),
+        ('end_block', 'location', os.path.join(dirname, 'foo.conf'), 1),
+    ]
+
+
+def test_iterparse_errors_match_parse():
+    for dirname in ('bad-args', 'includes-globbed', 'missing-semicolon', 'spelling-mistake'):
+        config = os.path.join(here, 'configs', dirname, 'nginx.conf')
+        for kwargs in ({}, {'strict': True}, {'catch_errors': False}):
+            errors = [obj for event, obj in crossplane.iterparse(config, **kwargs) if event == 'error']
+            assert errors == crossplane.parse(config, **kwargs)['errors']
+
+
+def test_parse_with_profile():
+    dirname = os.path.join(here, 'configs', 'includes-regular')
+    config = os.path.join(dirname, 'nginx.conf')
+    collected = []
+    payload = crossplane.parse(config, profile=collected.append)
+    stats = payload.pop('stats')
+    assert payload == crossplane.parse(config)
+    assert collected == [stats]
+
+    counts = [
+        (s['file'], s['bytes'], s['tokens'], s['directives'], s['errors'])
+        for s in stats['files']
+    ]
+    assert counts == [
+        (config, 51, 9, 3, 0),
+        (os.path.join(dirname, 'conf.d', 'server.conf'), 127, 15, 5, 1),
+        (os.path.join(dirname, 'foo.conf'), 40, 8, 2, 0),
+    ]
+    for s in stats['files']:
+        parts = s['lex_time'] + s['parse_time'] + s['analyze_time'] + s['include_time']
+        assert abs(s['time'] - parts) < 1e-6
+    total = stats['total']
+    assert (total['bytes'], total['tokens'], total['directives'], total['errors']) == (218, 32, 10, 1)
+
+    # workers send their stats back with their results
+    payload = crossplane.parse(config, profile=True, workers=2)
+    assert [s['tokens'] for s in payload['stats']['files']] == [9, 15, 8]
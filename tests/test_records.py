@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+
+import crossplane
+from crossplane.records import iterrecords, dump
+from . import here
+
+
+def test_file_records():
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    payload = crossplane.parse(config)
+    assert list(iterrecords(payload)) == payload['config']
+
+    out = io.StringIO()
+    assert dump(config, out) == 'ok'
+    lines = out.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == payload['config']
+
+
+def test_directive_records():
+    dirname = os.path.join(here, 'configs', 'includes-multiple-contexts')
+    config = os.path.join(dirname, 'nginx.conf')
+    proxy = os.path.join(dirname, 'proxy.conf')
+    records = list(iterrecords(crossplane.parse(config), directives=True))
+    assert [(r['file'], r['line'], r.get('directive'), r.get('context')) for r in records] == [
+        (config, 1, 'events', []),
+        (config, 2, 'http', []),
+        (config, 3, 'include', ['http']),
+        (config, 4, 'server', ['http']),
+        (config, 5, 'listen', ['http', 'server']),
+        (config, 6, 'include', ['http', 'server']),
+        (config, 7, 'location', ['http', 'server']),
+        (config, 8, 'include', ['http', 'location']),
+        (proxy, 1, 'proxy_set_header', ['http']),
+        (proxy, 2, 'merge_slashes', ['http']),
+        (proxy, 1, 'proxy_set_header', ['http', 'server']),
+        (proxy, 2, 'merge_slashes', ['http', 'server']),
+        (proxy, 1, 'proxy_set_header', ['http', 'location']),
+        (proxy, 2, None, None),
+    ]
+    assert records[2]['args'] == ['proxy.conf']
+    assert records[2]['includes'] == [1]
+    assert all('block' not in r for r in records)
+    assert records[-1]['error'].startswith('"merge_slashes" directive is not allowed here')
+
+    # the same records are written as each file is parsed
+    out = io.StringIO()
+    assert dump(config, out, directives=True) == 'failed'
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == records
+
+    out = io.StringIO()
+    dump(config, out, directives=True, combine=True)
+    lines = out.getvalue().splitlines()
+    combined = [json.loads(line) for line in lines]
+    assert [(r['file'], r.get('directive'), r.get('context')) for r in combined] == [
+        (config, 'events', []),
+        (config, 'http', []),
+        (proxy, 'proxy_set_header', ['http']),
+        (proxy, 'merge_slashes', ['http']),
+        (config, 'server', ['http']),
+        (config, 'listen', ['http', 'server']),
+        (proxy, 'proxy_set_header', ['http', 'server']),
+        (proxy, 'merge_slashes', ['http', 'server']),
+        (config, 'location', ['http', 'server']),
+        (proxy, 'proxy_set_header', ['http', 'location']),
+        (proxy, None, None),
+    ]
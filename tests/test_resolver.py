@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+
+import pytest
+
+import crossplane
+from crossplane.parser import _find_includes
+from crossplane.resolver import IncludeResolver
+from . import here
+
+
+def test_resolver_matches_glob():
+    dirname = os.path.join(here, 'configs', 'includes-globbed')
+    resolver = IncludeResolver()
+    patterns = [
+        '*.conf', '*/*.conf', '*/locations/*', 'servers/*', 'locations/', '*/',
+        '.*', 'http.conf', 'nope/*', '[hn]*.conf', 'servers/locations'
+    ]
+    for pattern in patterns:
+        pattern = os.path.join(dirname, pattern)
+        assert resolver.glob(pattern) == sorted(glob.glob(pattern))
+
+    # asking again is answered from the cache
+    stats = resolver.stats()
+    for pattern in patterns:
+        pattern = os.path.join(dirname, pattern)
+        assert resolver.glob(pattern) == sorted(glob.glob(pattern))
+    assert resolver.stats() == {
+        'hits': stats['hits'] + len(patterns),
+        'misses': stats['misses'],
+        'syscalls': stats['syscalls'],
+        'saved_syscalls': stats['saved_syscalls'] * 2 + stats['syscalls']
+    }
+
+
+def test_resolver_open_errors(tmpdir):
+    resolver = IncludeResolver()
+    missing = str(tmpdir.join('missing.conf'))
+    for i in range(2):
+        with pytest.raises(IOError) as expected:
+            _find_includes(missing)
+        with pytest.raises(IOError) as cached:
+            resolver.find(missing)
+        assert type(cached.value) == type(expected.value)
+        assert str(cached.value) == str(expected.value)
+    assert resolver.stats() == {'hits': 1, 'misses': 1, 'syscalls': 1, 'saved_syscalls': 1}
+
+
+def test_resolver_invalidate(tmpdir):
+    pattern = str(tmpdir.join('conf.d', '*.conf'))
+    tmpdir.mkdir('conf.d').join('a.conf').write('')
+    resolver = IncludeResolver()
+    assert resolver.find(pattern) == [str(tmpdir.join('conf.d', 'a.conf'))]
+
+    # new files aren't found until their directory is invalidated
+    tmpdir.join('conf.d', 'b.conf').write('')
+    assert len(resolver.find(pattern)) == 1
+    resolver.invalidate(str(tmpdir.join('conf.d', 'b.conf')))
+    assert len(resolver.find(pattern)) == 2
+
+    tmpdir.join('conf.d', 'a.conf').remove()
+    resolver.invalidate()
+    assert resolver.find(pattern) == [str(tmpdir.join('conf.d', 'b.conf'))]
+
+
+def test_parse_with_resolver():
+    dirname = os.path.join(here, 'configs', 'includes-globbed')
+    config = os.path.join(dirname, 'nginx.conf')
+    resolver = IncludeResolver()
+    payload = crossplane.parse(config, resolver=resolver)
+    assert payload == crossplane.parse(config)
+
+    # a shared resolver doesn't look at the file system again
+    syscalls = resolver.syscalls
+    payload = crossplane.parse(config, resolver=resolver, profile=True)
+    assert resolver.syscalls == syscalls
+    assert payload['stats']['resolver']['syscalls'] == 0
+    assert payload['stats']['resolver']['misses'] == 0
+    assert payload['stats']['resolver']['saved_syscalls'] > 0
+
+
+def test_resolver_refresh(tmpdir):
+    pattern = str(tmpdir.join('conf.d', '*.conf'))
+    explicit = str(tmpdir.join('http.conf'))
+    tmpdir.mkdir('conf.d').join('a.conf').write('')
+    resolver = IncludeResolver(watch=True)
+    assert resolver.find(pattern) == [str(tmpdir.join('conf.d', 'a.conf'))]
+    with pytest.raises(IOError):
+        resolver.find(explicit)
+    assert resolver.refresh() == 0
+
+    # only what was found in the directories that changed is forgotten
+    tmpdir.join('conf.d', 'b.conf').write('')
+    assert resolver.refresh() == 1
+    assert len(resolver.find(pattern)) == 2
+    with pytest.raises(IOError):
+        resolver.find(explicit)
+    assert resolver.stats()['syscalls'] == 3
+
+    tmpdir.join('http.conf').write('')
+    assert resolver.refresh() == 2  # the file and the directory it's in
+    assert resolver.find(explicit) == [explicit]
+
+    # resolvers that don't watch can't refresh
+    resolver = IncludeResolver()
+    resolver.find(pattern)
+    assert resolver.refresh() == 0
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from crossplane import __main__ as crossplane_main, server as crossplane_server
+from crossplane.__main__ import _make_server, main, parse, lex, minify, format
+from crossplane.server import SOCKET_ENV, call
+from . import here
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='needs unix domain sockets')
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = _make_server(str(tmpdir.join('crossplane.sock')))
+    server.bind()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def _local(tmpdir, func, **kwargs):
+    out = tmpdir.join('local.out')
+    func(out=str(out), **kwargs)
+    return out.read_binary()
+
+
+def test_server_matches_cli(server, tmpdir):
+    config = os.path.join(here, 'configs', 'includes-globbed', 'nginx.conf')
+    for func, kwargs in [
+        (parse, {}), (parse, {'combine': True}), (parse, {'indent': 4, 'comments': True}),
+        (parse, {'output_format': 'ndjson', 'per_directive': True}),
+        (lex, {'line_numbers': True}), (minify, {}), (format, {'indent': 2})
+    ]:
+        kwargs['filename'] = config
+        response = call(func.__name__, kwargs, path=server.path)
+        assert response['status'] == 'ok'
+        assert response['exit'] == 0
+        assert response['output'] == _local(tmpdir, func, **kwargs)
+
+    # files that didn't change aren't parsed again
+    misses = server.cache.misses
+    response = call('parse', {'filename': config}, path=server.path)
+    assert response['output'] == _local(tmpdir, parse, filename=config)
+    assert server.cache.misses == misses
+
+
+def test_server_notices_changes(server, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('nginx.conf').write('events {}\nhttp {\n    include conf.d/*.conf;\n}\n')
+    conf_d = tmpdir.mkdir('conf.d')
+    conf_d.join('a.conf').write('server {}\n')
+
+    def _parse():
+        response = call('parse', {'filename': 'nginx.conf'}, path=server.path, cwd=str(tmpdir))
+        assert response['output'] == _local(tmpdir, parse, filename='nginx.conf')
+        return response['output']
+
+    first = _parse()
+    assert _parse() == first
+    conf_d.join('b.conf').write('server {}\n')
+    assert b'b.conf' in _parse()
+
+
+def test_server_errors(server, tmpdir):
+    response = call('parse', {'filename': str(tmpdir.join('missing.conf'))}, path=server.path)
+    assert response['status'] == 'ok'
+    assert b'No such file or directory' in response['output']
+
+    response = call('lex', {'filename': str(tmpdir.join('missing.conf'))}, path=server.path)
+    assert response['status'] == 'failed'
+    assert response['exit'] == 1
+    assert 'IOError' in response['error'] or 'FileNotFoundError' in response['error']
+
+    # the server can't ask if it's okay to overwrite files
+    tmpdir.join('nginx.conf').write('events {}\n')
+    call('parse', {'filename': 'nginx.conf', 'out': 'payload.json'}, path=server.path, cwd=str(tmpdir))
+    response = call('build', {'filename': 'payload.json'}, path=server.path, cwd=str(tmpdir))
+    assert response['exit'] == 1
+    assert response['output'].startswith(b'building payload.json would overwrite')
+
+    response = call('serve', path=server.path)
+    assert response['status'] == 'refused'
+
+
+def test_main_uses_server(server, tmpdir, monkeypatch):
+    config = os.path.join(here, 'configs', 'simple', 'nginx.conf')
+    out = tmpdir.join('payload.json')
+    monkeypatch.setattr(sys, 'argv', ['crossplane', 'parse', config, '-o', str(out)])
+    expected = _local(tmpdir, parse, filename=config)
+
+    # commands are run here if there's no server
+    monkeypatch.setenv(SOCKET_ENV, str(tmpdir.join('nothing.sock')))
+    main()
+    assert out.read_binary() == expected
+    assert server.cache.stats() == {'hits': 0, 'misses': 0}
+
+    out.remove()
+    monkeypatch.setenv(SOCKET_ENV, server.path)
+    main()
+    assert out.read_binary() == expected
+    assert server.cache.stats() == {'hits': 0, 'misses': 1}
+
+
+def test_main_needs_socket_env(server, tmpdir, monkeypatch):
+    config = os.path.join(here, 'configs', 'simple', 'nginx.conf')
+    out = tmpdir.join('payload.json')
+    monkeypatch.setattr(sys, 'argv', ['crossplane', 'parse', config, '-o', str(out)])
+    monkeypatch.delenv(SOCKET_ENV, raising=False)
+    main()
+    assert out.read_binary() == _local(tmpdir, parse, filename=config)
+    assert server.cache.stats() == {'hits': 0, 'misses': 0}
+
+
+def test_main_skips_full_server(tmpdir, monkeypatch):
+    config = os.path.join(here, 'configs', 'simple', 'nginx.conf')
+    out = tmpdir.join('payload.json')
+    path = str(tmpdir.join('full.sock'))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    waiting = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(0)
+        waiting.connect(path)  # nothing else can connect until it's accepted
+
+        monkeypatch.setattr(sys, 'argv', ['crossplane', 'parse', config, '-o', str(out)])
+        monkeypatch.setenv(SOCKET_ENV, path)
+        monkeypatch.setattr(crossplane_server, 'DEFAULT_TIMEOUT', 0.1)
+        main()
+        assert out.read_binary() == _local(tmpdir, parse, filename=config)
+    finally:
+        waiting.close()
+        listener.close()
+
+
+def test_main_waits_for_slow_server(server, tmpdir, monkeypatch):
+    config = os.path.join(here, 'configs', 'simple', 'nginx.conf')
+    out = tmpdir.join('tokens.json')
+    events = []
+
+    lex_buffer = crossplane_main.lex_buffer
+    def _lex_buffer(*args, **kwargs):
+        events.append('lex')
+        return lex_buffer(*args, **kwargs)
+    monkeypatch.setattr(crossplane_main, 'lex_buffer', _lex_buffer)
+
+    def _slow_lex(**kwargs):
+        events.append('server-start')
+        time.sleep(0.5)
+        lex(**kwargs)
+        events.append('server-done')
+    server.commands['lex'] = _slow_lex
+
+    # the command isn't run again here when the server takes longer than
+    # the timeout to answer
+    monkeypatch.setattr(sys, 'argv', ['crossplane', 'lex', config, '-o', str(out)])
+    monkeypatch.setenv(SOCKET_ENV, server.path)
+    monkeypatch.setattr(crossplane_server, 'DEFAULT_TIMEOUT', 0.1)
+    main()
+    assert events == ['server-start', 'lex', 'server-done']
+    assert out.read_binary() == _local(tmpdir, lex, filename=config)
+
+
+def test_main_reports_lost_server(tmpdir, monkeypatch, capsys):
+    config = os.path.join(here, 'configs', 'simple', 'nginx.conf')
+    out = tmpdir.join('payload.json')
+    path = str(tmpdir.join('lost.sock'))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o600)
+    listener.listen(1)
+
+    def _hang_up():
+        conn, addr = listener.accept()
+        conn.makefile('rb').readline()
+        conn.close()  # the request was taken but never answered
+    thread = threading.Thread(target=_hang_up)
+    thread.start()
+
+    try:
+        monkeypatch.setattr(sys, 'argv', ['crossplane', 'parse', config, '-o', str(out)])
+        monkeypatch.setenv(SOCKET_ENV, path)
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 1
+        assert 'closed the connection' in capsys.readouterr().err
+        assert not out.check()
+    finally:
+        thread.join()
+        listener.close()
+
+
+def test_call_checks_socket(server, tmpdir):
+    os.chmod(server.path, 0o666)
+    with pytest.raises(EnvironmentError):
+        call('parse', {'filename': 'nginx.conf'}, path=server.path)
+
+    regular = tmpdir.join('regular.sock')
+    regular.write('')
+    os.chmod(str(regular), 0o600)
+    with pytest.raises(EnvironmentError):
+        call('parse', {'filename': 'nginx.conf'}, path=str(regular))
+
+
+def test_bind_leaves_other_files(tmpdir):
+    path = tmpdir.join('crossplane.sock')
+    path.write('not a socket')
+    server = _make_server(str(path))
+    with pytest.raises(EnvironmentError):
+        server.bind()
+    assert path.read() == 'not a socket'
+
+
+def test_terminate_stops_request(tmpdir):
+    server = _make_server(str(tmpdir.join('crossplane.sock')))
+    server.commands['parse'] = lambda **kwargs: server.terminate()
+    with pytest.raises(SystemExit):
+        server.handle({'command': 'parse', 'args': {}, 'cwd': str(tmpdir), 'version': crossplane_server.__version__})
+
+    # commands that exit themselves are still answered
+    server._stopping = False
+    server.commands['parse'] = lambda **kwargs: sys.exit(3)
+    response, output = server.handle({'command': 'parse', 'args': {}, 'cwd': str(tmpdir), 'version': crossplane_server.__version__})
+    assert response['exit'] == 3